@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -65,6 +66,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {
+            # A file rather than the in-memory default, which fails concurrent
+            # writers at once; per process so parallel runs do not collide.
+            'NAME': os.path.join(tempfile.gettempdir(), f'docmanager_test_{os.getpid()}.sqlite3'),
+        },
     }
 }
 
@@ -98,6 +104,22 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Hash, size and MIME-sniff uploads while they stream in (documents.uploads)
+FILE_UPLOAD_HANDLERS = [
+    'documents.uploads.FingerprintingMemoryFileUploadHandler',
+    'documents.uploads.FingerprintingTemporaryFileUploadHandler',
+]
+
+# Who sends document files once a view has authorized the download
+# (documents.delivery). Behind nginx use XAccelRedirectBackend with an
+# internal location at PROTECTED_FILE_INTERNAL_URL aliased to MEDIA_ROOT;
+# behind Apache mod_xsendfile use XSendfileBackend.
+PROTECTED_FILE_DELIVERY = 'documents.delivery.FileResponseBackend'
+PROTECTED_FILE_INTERNAL_URL = '/protected/'
+# Repeated fetches of one file by one user (ranges, resumes) within this many
+# seconds are audit-logged once; 0 logs every response.
+DELIVERY_LOG_THROTTLE_SECONDS = 60
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -117,4 +139,46 @@ AUTHENTICATION_BACKENDS = (
 )
 
 DEFAULT_USER_ROLE = 'czytelnik' 
-DEFAULT_USER_ACTIVE = True
\ No newline at end of file
+DEFAULT_USER_ACTIVE = True
+# Activity log: views queue events for a background writer that bulk-inserts
+# them. Set ACTIVITY_LOG_SYNC = True to write each row inside the request.
+ACTIVITY_LOG_SYNC = False
+ACTIVITY_LOG_BUFFER_SIZE = 10000
+ACTIVITY_LOG_BATCH_SIZE = 200
+ACTIVITY_LOG_FLUSH_INTERVAL = 2.0  # seconds
+ACTIVITY_LOG_SPILL_DIR = BASE_DIR / 'var'
+ACTIVITY_LOG_RETENTION_MONTHS = 12  # archive_activity_logs keeps this many months in the database
+ACTIVITY_LOG_ARCHIVE_DIR = BASE_DIR / 'var' / 'activity_archive'
+# Text extraction for search: new versions are extracted in a process pool
+# after commit. Set TEXT_EXTRACTION_EAGER = True to extract inside save().
+TEXT_EXTRACTION_EAGER = False
+TEXT_EXTRACTION_WORKERS = 2
+TEXT_EXTRACTION_TIMEOUT = 60  # seconds per file
+TEXT_EXTRACTION_MEMORY_MB = 512  # per worker, on top of the interpreter
+# Document files live in a content-addressed store (documents.storage);
+# gc_blobs removes blobs unreferenced for at least this long.
+BLOB_GC_GRACE_HOURS = 24
+# Previews (documents.previews): thumbnails are cached under MEDIA_ROOT/previews,
+# rendered after upload on the text extraction pool, least recently used
+# files evicted past the quota.
+PREVIEW_ON_UPLOAD = True
+PREVIEW_CACHE_MAX_MB = 512
+# Old versions (documents.chunked): with VERSION_CHUNKING, versions superseded
+# by an upload are stored as deduplicated compressed chunks once it commits;
+# compact_versions converts existing history. Smaller files stay whole.
+VERSION_CHUNKING = False
+VERSION_CHUNKING_MIN_KB = 64
+# Cold tier (documents.tiering): tier_cold_versions compresses with zstd old
+# versions not downloaded for this many days.
+COLD_STORAGE_AFTER_DAYS = 180
+COLD_STORAGE_LEVEL = 10
+# Resumable uploads (documents.resumable): chunks are staged here until the
+# upload is finalized. Keep it on the same filesystem as MEDIA_ROOT so that
+# finalizing moves the file instead of copying it.
+UPLOAD_STAGING_DIR = BASE_DIR / 'var' / 'uploads'
+UPLOAD_MAX_SIZE = 1024 * 1024 * 1024  # 1 GB; rozmiar_pliku is a 32-bit column
+UPLOAD_CHUNK_MAX_SIZE = 16 * 1024 * 1024  # per PATCH request
+UPLOAD_SESSION_TTL_HOURS = 24  # cleanup_uploads discards sessions idle for longer
+# System settings (documents.settings_cache): each process checks for changes
+# made by the others at most this often.
+SETTINGS_GENERATION_CHECK_INTERVAL = 1  # seconds
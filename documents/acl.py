@@ -0,0 +1,128 @@
+"""
+Typed per-user ACL tables mirroring guardian's user object permissions.
+
+Guardian keeps object permissions in generic rows (``content_type`` plus a
+text ``object_pk``), which the hot listing and permission-check paths can only
+join through casts. DocumentACL/FolderACL hold the same information as one
+integer bitmask per (user, object) behind composite indexes. Rows are kept in
+sync by signals on guardian's UserObjectPermission (see documents.signals), so
+every assign_perm/remove_perm call site is covered. Bulk guardian operations
+(assign_perm with a queryset) skip signals; ``manage.py backfill_acl``
+recomputes the tables from scratch.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import F
+
+from .models import Document, DocumentACL, Folder, FolderACL
+
+
+ACL_MODELS = {
+    Document: (DocumentACL, 'dokument_id'),
+    Folder: (FolderACL, 'folder_id'),
+}
+
+
+def acl_for_model(model):
+    """Return ``(acl_model, object_field)`` for Document/Folder, else ``None``."""
+    return ACL_MODELS.get(model)
+
+
+def acl_permission_bit(model, codename):
+    acl = acl_for_model(model)
+    if acl is None:
+        return None
+    return acl[0].PERMISSION_BITS.get(codename)
+
+
+def acl_all_bits(acl_model):
+    mask = 0
+    for bit in acl_model.PERMISSION_BITS.values():
+        mask |= bit
+    return mask
+
+
+def grant_acl_bit(user_id, model, object_pk, codename):
+    bit = acl_permission_bit(model, codename)
+    if bit is None:
+        return
+    acl_model, field = acl_for_model(model)
+    with transaction.atomic():
+        row, created = acl_model.objects.get_or_create(
+            uzytkownik_id=user_id, **{field: object_pk}, defaults={'uprawnienia': bit}
+        )
+        if not created:
+            acl_model.objects.filter(pk=row.pk).update(uprawnienia=F('uprawnienia').bitor(bit))
+
+
+def revoke_acl_bit(user_id, model, object_pk, codename):
+    bit = acl_permission_bit(model, codename)
+    if bit is None:
+        return
+    acl_model, field = acl_for_model(model)
+    rows = acl_model.objects.filter(uzytkownik_id=user_id, **{field: object_pk})
+    with transaction.atomic():
+        rows.update(uprawnienia=F('uprawnienia').bitand(acl_all_bits(acl_model) ^ bit))
+        rows.filter(uprawnienia=0).delete()
+
+
+def acl_object_ids(user, model, codename):
+    """Queryset of object ids for which ``user`` holds ``codename`` according to the ACL."""
+    acl_model, field = acl_for_model(model)
+    bit = acl_model.PERMISSION_BITS[codename]
+    return (acl_model.objects.filter(uzytkownik=user)
+            .alias(masked=F('uprawnienia').bitand(bit))
+            .filter(masked=bit)
+            .values_list(field, flat=True))
+
+
+def compute_acl_masks(model):
+    """Expected ``{(user_id, object_id): mask}`` for ``model`` from guardian's rows."""
+    from guardian.models import UserObjectPermission
+
+    acl_model, _ = acl_for_model(model)
+    content_type = ContentType.objects.get_for_model(model)
+    masks = {}
+    rows = UserObjectPermission.objects.filter(
+        content_type=content_type,
+        permission__codename__in=list(acl_model.PERMISSION_BITS),
+    ).values_list('user_id', 'object_pk', 'permission__codename')
+    for user_id, object_pk, codename in rows.iterator(chunk_size=5000):
+        key = (user_id, int(object_pk))
+        masks[key] = masks.get(key, 0) | acl_model.PERMISSION_BITS[codename]
+    return masks
+
+
+def rebuild_acl(model, dry_run=False, batch_size=1000):
+    """Bring the ACL table for ``model`` in line with guardian.
+
+    Returns a ``(created, updated, deleted)`` tuple of row counts.
+    """
+    acl_model, field = acl_for_model(model)
+    expected = compute_acl_masks(model)
+    existing_ids = set(model.objects.filter(
+        pk__in={object_id for _, object_id in expected}
+    ).values_list('pk', flat=True)) if expected else set()
+    expected = {key: mask for key, mask in expected.items() if key[1] in existing_ids}
+
+    to_update, to_delete = [], []
+    for row in acl_model.objects.all().iterator(chunk_size=5000):
+        key = (row.uzytkownik_id, getattr(row, field))
+        mask = expected.pop(key, None)
+        if mask is None:
+            to_delete.append(row.pk)
+        elif mask != row.uprawnienia:
+            row.uprawnienia = mask
+            to_update.append(row)
+    to_create = [
+        acl_model(uzytkownik_id=user_id, uprawnienia=mask, **{field: object_id})
+        for (user_id, object_id), mask in expected.items()
+    ]
+
+    if not dry_run:
+        with transaction.atomic():
+            acl_model.objects.bulk_create(to_create, batch_size=batch_size)
+            acl_model.objects.bulk_update(to_update, ['uprawnienia'], batch_size=batch_size)
+            for start in range(0, len(to_delete), batch_size):
+                acl_model.objects.filter(pk__in=to_delete[start:start + batch_size]).delete()
+    return len(to_create), len(to_update), len(to_delete)
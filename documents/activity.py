@@ -0,0 +1,414 @@
+"""
+Batched, asynchronous ActivityLog writer.
+
+Views call ``log_activity``, which only appends the event to an in-process
+ring buffer; a daemon thread drains it with ``bulk_create`` once
+ACTIVITY_LOG_BATCH_SIZE events are queued or every
+ACTIVITY_LOG_FLUSH_INTERVAL seconds. Events that cannot be written (full
+buffer, database error) are appended as JSON lines to a spill file in
+ACTIVITY_LOG_SPILL_DIR and replayed by the flusher once the database accepts
+writes again; several processes may share the spill directory, see the
+spill file section of ActivityLogWriter. Remaining events are flushed at
+interpreter exit.
+
+With ``ACTIVITY_LOG_SYNC = True`` every event is written inside the request,
+as before, for deployments that require the audit row to exist before the
+response is sent.
+
+The helpers at the bottom keep the table bounded: ActivityDailyRollup holds
+per-day counts (rollup_activity_logs) and archive_activity_logs moves whole
+months past the retention period to gzip JSONL files.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class ActivityLogWriter:
+    """Ring buffer of pending ActivityLog rows plus the thread that flushes it."""
+
+    def __init__(self, capacity=None, batch_size=None, flush_interval=None, spill_dir=None, autostart=True):
+        self.capacity = capacity or _setting('ACTIVITY_LOG_BUFFER_SIZE', 10000)
+        self.batch_size = batch_size or _setting('ACTIVITY_LOG_BATCH_SIZE', 200)
+        self.flush_interval = flush_interval or _setting('ACTIVITY_LOG_FLUSH_INTERVAL', 2.0)
+        self.spill_path = os.path.join(
+            str(spill_dir or _setting('ACTIVITY_LOG_SPILL_DIR', os.path.join(settings.BASE_DIR, 'var'))),
+            'activity_log_spill.jsonl',
+        )
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local_locks = {'.lock': threading.Lock(), '.replay.lock': threading.Lock()}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.autostart = autostart
+        self.enqueued = 0
+        self.flushed = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    # Producer side
+
+    def enqueue(self, event):
+        """Queue one event (ActivityLog field values by attname) without touching the database."""
+        with self._lock:
+            self.enqueued += 1
+            if len(self._buffer) >= self.capacity:
+                overflow = True
+            else:
+                overflow = False
+                self._buffer.append(event)
+                depth = len(self._buffer)
+        if overflow:
+            self._spill([event])
+            return
+        if self.autostart:
+            self._ensure_started()
+        if depth >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+            self._thread.start()
+
+    # Consumer side
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                close_old_connections()
+                self.flush()
+        finally:
+            connection.close()
+
+    def _take_batch(self):
+        with self._lock:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def flush(self):
+        """Write everything queued so far (and any spilled events). Returns the number of rows written."""
+        written = 0
+        with self._flush_lock:
+            written += self._replay_spill()
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                try:
+                    written += self._write(batch)
+                except Exception:
+                    self.failed_flushes += 1
+                    logger.exception('Writing %d activity log events failed, spilling to %s', len(batch), self.spill_path)
+                    self._spill(batch)
+                    break
+        self.flushed += written
+        return written
+
+    def _write(self, events):
+        from .models import ActivityLog, Document, Folder
+        from django.contrib.auth.models import User
+
+        # Objects may have been deleted since the event was queued (the delete
+        # views log before deleting); mirror the FK on_delete behaviour.
+        user_ids = set(User.objects.filter(pk__in={e['uzytkownik_id'] for e in events}).values_list('pk', flat=True))
+        document_ids = set(Document.objects.filter(
+            pk__in={e['dokument_id'] for e in events if e['dokument_id']}
+        ).values_list('pk', flat=True))
+        folder_ids = set(Folder.objects.filter(
+            pk__in={e['folder_id'] for e in events if e['folder_id']}
+        ).values_list('pk', flat=True))
+
+        rows = []
+        for event in events:
+            if event['uzytkownik_id'] not in user_ids:
+                continue
+            rows.append(ActivityLog(
+                uzytkownik_id=event['uzytkownik_id'],
+                typ_aktywnosci=event['typ_aktywnosci'],
+                dokument_id=event['dokument_id'] if event['dokument_id'] in document_ids else None,
+                folder_id=event['folder_id'] if event['folder_id'] in folder_ids else None,
+                szczegoly=event['szczegoly'],
+                adres_ip=event['adres_ip'] or None,
+                znacznik_czasu=event['znacznik_czasu'],
+            ))
+        ActivityLog.objects.bulk_create(rows, batch_size=self.batch_size)
+        return len(rows)
+
+    # Spill file
+    #
+    # The spill file is shared by every process using the same spill
+    # directory. Appends and the rename that starts a replay hold an
+    # exclusive flock on ``<spill>.lock``; a replay holds ``<spill>.replay.lock``
+    # for its whole run, so only one process replays at a time. Without
+    # fcntl (Windows) the locks only serialize this writer's threads.
+
+    @contextmanager
+    def _file_lock(self, suffix, blocking=True):
+        """Exclusive flock on ``<spill><suffix>``; yields False when ``blocking`` is off and it is taken."""
+        if fcntl is None:
+            lock = self._local_locks[suffix]
+            if not lock.acquire(blocking):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                lock.release()
+            return
+        with open(self.spill_path + suffix, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def _spill(self, events):
+        try:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            with self._file_lock('.lock'), open(self.spill_path, 'a', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(dict(event, znacznik_czasu=event['znacznik_czasu'].isoformat())) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            with self._lock:
+                self.dropped += len(events)
+            logger.exception('Dropped %d activity log events, spill file %s is not writable', len(events), self.spill_path)
+            return
+        with self._lock:
+            self.spilled += len(events)
+
+    def _read_spill(self, path):
+        """
+        Events in the spill file at ``path``. Lines that do not parse (a write
+        cut short by a crash) are appended to ``<spill>.bad`` and dropped from
+        the file, so they are reported once and do not block the rest.
+        """
+        events, good, bad = [], [], []
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                    event['znacznik_czasu'] = parse_datetime(event['znacznik_czasu'])
+                    if event['znacznik_czasu'] is None:
+                        raise ValueError('missing timestamp')
+                except (ValueError, TypeError, KeyError):
+                    bad.append(line if line.endswith('\n') else line + '\n')
+                    continue
+                events.append(event)
+                good.append(line)
+        if bad:
+            with open(self.spill_path + '.bad', 'a', encoding='utf-8') as f:
+                f.writelines(bad)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.writelines(good)
+            os.replace(path + '.tmp', path)
+            logger.error('Moved %d unreadable spilled activity log events to %s', len(bad), self.spill_path + '.bad')
+        return events
+
+    def _replay_spill(self):
+        replaying = self.spill_path + '.replay'
+        if not (os.path.exists(replaying) or os.path.exists(self.spill_path)):
+            return 0
+        with self._file_lock('.replay.lock', blocking=False) as acquired:
+            if not acquired:
+                return 0  # Another process is replaying
+            if not os.path.exists(replaying):
+                with self._file_lock('.lock'):
+                    if not os.path.exists(self.spill_path):
+                        return 0
+                    os.replace(self.spill_path, replaying)
+            events = self._read_spill(replaying)
+            written = 0
+            try:
+                with transaction.atomic():
+                    for start in range(0, len(events), self.batch_size):
+                        written += self._write(events[start:start + self.batch_size])
+            except Exception:
+                # Leave the file in place; the next flush retries all of it.
+                self.failed_flushes += 1
+                logger.exception('Replaying spilled activity log events failed')
+                return 0
+            os.remove(replaying)
+        self.replayed += len(events)
+        return written
+
+    # Lifecycle and metrics
+
+    def stop(self, timeout=5.0):
+        """Stop the flusher thread and write whatever is still queued."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        try:
+            self.flush()
+        except Exception:
+            self._spill(self._take_batch())
+            logger.exception('Final activity log flush failed')
+
+    def stats(self):
+        with self._lock:
+            depth = len(self._buffer)
+        return {
+            'queue_depth': depth,
+            'capacity': self.capacity,
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'spilled': self.spilled,
+            'replayed': self.replayed,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes,
+            'spill_pending': os.path.exists(self.spill_path) or os.path.exists(self.spill_path + '.replay'),
+            'thread_alive': bool(self._thread and self._thread.is_alive()),
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_activity_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ActivityLogWriter()
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def log_activity(user, action_type, document=None, folder=None, details="", ip_address=""):
+    """Record an ActivityLog entry, batched in the background unless ACTIVITY_LOG_SYNC is set."""
+    if _setting('ACTIVITY_LOG_SYNC', False):
+        from .models import ActivityLog
+        return ActivityLog.objects.create(
+            uzytkownik=user,
+            typ_aktywnosci=action_type,
+            dokument=document,
+            folder=folder,
+            szczegoly=details,
+            adres_ip=ip_address or None,
+        )
+    get_activity_writer().enqueue({
+        'uzytkownik_id': user.pk,
+        'typ_aktywnosci': action_type,
+        'dokument_id': document.pk if document is not None else None,
+        'folder_id': folder.pk if folder is not None else None,
+        'szczegoly': details,
+        'adres_ip': ip_address or None,
+        'znacznik_czasu': timezone.now(),
+    })
+
+
+# --- Retention and rollups ---
+
+def day_bounds(day):
+    """Aware [start, end) datetimes of ``day`` in the current time zone."""
+    start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+
+def month_bounds(year, month):
+    """Aware [start, end) datetimes of a calendar month in the current time zone."""
+    start = timezone.make_aware(datetime(year, month, 1))
+    end = timezone.make_aware(datetime(year + month // 12, month % 12 + 1, 1))
+    return start, end
+
+
+def rollup_activity_day(day, archived=None):
+    """
+    Recompute ActivityDailyRollup rows for ``day`` from ActivityLog. Returns the number of rows.
+
+    Counts of rows already moved out of ActivityLog by archive_activity_logs
+    are kept in ``liczba_zarchiwizowana`` and added back; ``archived``
+    ({(uzytkownik_id, typ_aktywnosci, dokument_id): count}) adds the rows
+    being archived now, which the caller deletes in the same transaction.
+    """
+    from collections import Counter
+    from django.db.models import Count
+    from .models import ActivityDailyRollup, ActivityLog
+
+    start, end = day_bounds(day)
+    with transaction.atomic():
+        archived_counts = Counter(archived or {})
+        for *key, count in (ActivityDailyRollup.objects.select_for_update()
+                            .filter(data=day, liczba_zarchiwizowana__gt=0)
+                            .values_list('uzytkownik_id', 'typ_aktywnosci', 'dokument_id', 'liczba_zarchiwizowana')):
+            archived_counts[tuple(key)] += count
+        live_counts = Counter({
+            (row['uzytkownik_id'], row['typ_aktywnosci'], row['dokument_id']): row['liczba']
+            for row in (ActivityLog.objects.filter(znacznik_czasu__gte=start, znacznik_czasu__lt=end)
+                        .order_by()
+                        .values('uzytkownik_id', 'typ_aktywnosci', 'dokument_id')
+                        .annotate(liczba=Count('id')))
+        })
+        rows = []
+        for key in archived_counts.keys() | live_counts.keys():
+            user_id, action, document_id = key
+            rows.append(ActivityDailyRollup(
+                data=day, uzytkownik_id=user_id, typ_aktywnosci=action, dokument_id=document_id,
+                liczba=archived_counts[key] + live_counts[key], liczba_zarchiwizowana=archived_counts[key],
+            ))
+        ActivityDailyRollup.objects.filter(data=day).delete()
+        ActivityDailyRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def export_activity_logs(queryset, path, chunk_size=5000, on_row=None):
+    """
+    Write ``queryset`` as gzip-compressed JSON lines to ``path`` (atomically).
+    ``on_row(row)`` is called with every exported row's values. Returns the row count.
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        rows = queryset.order_by('pk').values(
+            'id', 'uzytkownik_id', 'typ_aktywnosci', 'dokument_id', 'folder_id',
+            'szczegoly', 'znacznik_czasu', 'adres_ip',
+        )
+        for row in rows.iterator(chunk_size=chunk_size):
+            if on_row is not None:
+                on_row(dict(row))
+            row['znacznik_czasu'] = row['znacznik_czasu'].isoformat()
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            count += 1
+    os.replace(tmp_path, path)
+    return count
@@ -1,11 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.utils import timezone
 from guardian.admin import GuardedModelAdmin
 from guardian.shortcuts import assign_perm, remove_perm, get_perms
+from users.permissions import PermissionIndex
 from .models import (
     Document, DocumentVersion, Folder, Tag, 
-    DocumentMetadata, Comment, ActivityLog, DocumentShare, SystemSettings
+    DocumentMetadata, Comment, ActivityLog, ActivityDailyRollup, DocumentShare, SystemSettings
 )
+from .activity import month_bounds
 
 
 @admin.register(Document)
@@ -45,7 +48,7 @@ class DocumentAdmin(GuardedModelAdmin):
         if request.user.is_superuser:
             return qs
         # For non-superusers, show only documents they can view
-        return get_objects_for_user(request.user, 'documents.browse_document', qs)
+        return PermissionIndex(request.user).filter_documents(qs)
 
 
 @admin.register(Folder)
@@ -78,16 +81,16 @@ class FolderAdmin(GuardedModelAdmin):
         if request.user.is_superuser:
             return qs.select_related('wlasciciel', 'rodzic')
         # For non-superusers, show only folders they can view
-        return get_objects_for_user(request.user, 'documents.browse_folder', qs).select_related('wlasciciel', 'rodzic')
+        return PermissionIndex(request.user).filter_folders(qs).select_related('wlasciciel', 'rodzic')
 
 
 @admin.register(DocumentVersion)
 class DocumentVersionAdmin(admin.ModelAdmin):
     """Document version administration"""
     list_display = ['dokument', 'numer_wersji', 'utworzony_przez', 'data_utworzenia', 'get_comment_preview']
-    list_filter = ['data_utworzenia']
+    list_filter = ['data_utworzenia', 'sposob_przechowywania']
     search_fields = ['dokument__nazwa', 'utworzony_przez__username', 'komentarz']
-    readonly_fields = ['data_utworzenia']
+    readonly_fields = ['data_utworzenia', 'sposob_przechowywania', 'ostatni_dostep']
     
     def get_comment_preview(self, obj):
         return obj.komentarz[:50] + "..." if len(obj.komentarz) > 50 else obj.komentarz
@@ -130,14 +133,43 @@ class CommentAdmin(admin.ModelAdmin):
     get_content_preview.short_description = 'Treść'
 
 
+class ActivityMonthFilter(admin.SimpleListFilter):
+    """
+    Month filter computed from the calendar instead of date_hierarchy's
+    aggregate over the whole table; filters with an indexed range.
+    """
+    title = 'miesiąc'
+    parameter_name = 'miesiac'
+    MONTHS = 12
+
+    def lookups(self, request, model_admin):
+        today = timezone.localdate()
+        year, month = today.year, today.month
+        choices = []
+        for _ in range(self.MONTHS):
+            choices.append((f'{year:04d}-{month:02d}', f'{year:04d}-{month:02d}'))
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        return choices
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            year, month = (int(part) for part in self.value().split('-'))
+            start, end = month_bounds(year, month)
+        except ValueError:
+            return queryset.none()
+        return queryset.filter(znacznik_czasu__gte=start, znacznik_czasu__lt=end)
+
+
 @admin.register(ActivityLog)
 class ActivityLogAdmin(admin.ModelAdmin):
     """Activity log administration"""
     list_display = ['uzytkownik', 'typ_aktywnosci', 'dokument', 'folder', 'znacznik_czasu', 'adres_ip']
-    list_filter = ['typ_aktywnosci', 'znacznik_czasu']
+    list_filter = ['typ_aktywnosci', ActivityMonthFilter]
     search_fields = ['uzytkownik__username', 'szczegoly', 'adres_ip']
     readonly_fields = ['znacznik_czasu']
-    date_hierarchy = 'znacznik_czasu'
+    show_full_result_count = False  # Avoid an unfiltered COUNT(*) on every changelist load
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('uzytkownik', 'dokument', 'folder')
@@ -147,6 +179,22 @@ class ActivityLogAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(ActivityDailyRollup)
+class ActivityDailyRollupAdmin(admin.ModelAdmin):
+    """Daily activity statistics (maintained by rollup_activity_logs)"""
+    list_display = ['data', 'uzytkownik', 'typ_aktywnosci', 'dokument', 'liczba']
+    list_filter = ['typ_aktywnosci', 'data']
+    search_fields = ['uzytkownik__username', 'dokument__nazwa']
+    date_hierarchy = 'data'
+    list_select_related = ['uzytkownik', 'dokument']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(DocumentShare)
 class DocumentShareAdmin(admin.ModelAdmin):
     """Document sharing administration"""
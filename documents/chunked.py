@@ -0,0 +1,294 @@
+"""
+Chunked storage of old document versions.
+
+Successive versions of a document are mostly the same bytes, and only the
+latest one is downloaded, previewed and searched in practice. A version that
+has been superseded can be stored as content-defined chunks instead of a
+whole file: every chunk is zlib-compressed and stored once under
+``MEDIA_ROOT/chunks/`` by the SHA-256 of its bytes, so a 40 MB spreadsheet
+changed in a few cells only adds the chunks around the changes.
+
+Boundaries depend on the content, not on offsets: a candidate is every byte
+matching CHUNK_CANDIDATE_RE (found by the regex engine) and it is cut when
+the CRC-32 of the CHUNK_WINDOW bytes before it has the bits of CHUNK_MASK at
+zero, keeping chunks between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE. Bytes
+inserted or removed therefore only change the chunks they fall in; the rest
+of the file is cut at the same places as before and dedupes.
+
+The version's ``plik`` then names a manifest,
+``blobs/manifests/<aa>/<bb>/<sha256><ext>`` with the digest and extension
+of the file it replaces (downloads keep their name and type), which lists
+the chunks. The manifest is a blob like any other, reference counted, and
+the whole file is left to gc_blobs once no row uses it. Downloads rebuild
+the file chunk by chunk (documents.delivery.serve_stream), holding one
+chunk in memory at a time.
+
+Only files that no document and no latest version uses are converted. With
+VERSION_CHUNKING the versions a new upload supersedes are converted on the
+text extraction pool once it commits; ``manage.py compact_versions``
+converts existing history. ``manage.py gc_blobs`` deletes the chunks no
+manifest lists any more.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import re
+import time
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+
+from .storage import BLOB_PREFIX, blob_digest, blob_storage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_PREFIX = 'chunks/'
+MANIFEST_PREFIX = BLOB_PREFIX + 'manifests/'
+MANIFEST_HEADER = 'docmanager-chunks 1'
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+CHUNK_WINDOW = 32
+CHUNK_MASK = 0x3f
+# Line ends and the padding bytes of binary formats: frequent enough in any file
+CHUNK_CANDIDATE_RE = re.compile(rb'[\n\x00\xff]')
+COMPRESSION_LEVEL = 6
+
+
+def manifest_name(name):
+    """Name of the manifest replacing the whole blob ``name`` (same digest and extension)."""
+    return MANIFEST_PREFIX + name[len(BLOB_PREFIX):]
+
+
+def is_manifest(name):
+    return bool(name) and name.startswith(MANIFEST_PREFIX)
+
+
+def chunk_name(digest):
+    return f'{CHUNK_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def _media_root():
+    return blob_storage.path('')
+
+
+def _min_size():
+    return getattr(settings, 'VERSION_CHUNKING_MIN_KB', 64) * 1024
+
+
+# --- Chunking (also runs in pool workers: no Django models here) ---
+
+def chunk_boundaries(data):
+    """End offsets of the chunks of ``data`` (bytes or an mmap); the last one is ``len(data)``."""
+    size = len(data)
+    last = 0
+    crc32 = zlib.crc32
+    for match in CHUNK_CANDIDATE_RE.finditer(data, CHUNK_MIN_SIZE):
+        end = match.end()
+        while end - last > CHUNK_MAX_SIZE:
+            last += CHUNK_MAX_SIZE
+            yield last
+        if end - last >= CHUNK_MIN_SIZE and not crc32(data[end - CHUNK_WINDOW:end]) & CHUNK_MASK:
+            last = end
+            yield end
+    while size - last > CHUNK_MAX_SIZE:
+        last += CHUNK_MAX_SIZE
+        yield last
+    if last < size:
+        yield size
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _store_chunk(media_root, digest, data):
+    """Store one chunk unless it already is; returns the bytes written."""
+    path = os.path.join(media_root, chunk_name(digest))
+    try:
+        os.utime(path)  # Used again: not garbage for another grace period
+        return 0
+    except FileNotFoundError:
+        pass
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    _write_atomic(path, compressed)
+    return len(compressed)
+
+
+def write_chunked(source_path, manifest_path, media_root):
+    """
+    Store the file at ``source_path`` as chunks under ``media_root`` and its
+    manifest at ``manifest_path``. Returns ``(size, digest, written)``: the
+    file's size and SHA-256, and the bytes of new chunks and manifest.
+    """
+    digest = hashlib.sha256()
+    lines = []
+    written = 0
+    with open(source_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            start = 0
+            for end in chunk_boundaries(data):
+                chunk = data[start:end]
+                digest.update(chunk)
+                chunk_digest = hashlib.sha256(chunk).hexdigest()
+                written += _store_chunk(media_root, chunk_digest, chunk)
+                lines.append(f'{chunk_digest} {len(chunk)}\n')
+                start = end
+        finally:
+            if size:
+                data.close()
+    manifest = f'{MANIFEST_HEADER}\n{size} {digest.hexdigest()}\n{"".join(lines)}'.encode('ascii')
+    _write_atomic(manifest_path, manifest)
+    return size, digest.hexdigest(), written + len(manifest)
+
+
+class ChunkedContent:
+    """The bytes a manifest describes, iterated one chunk at a time; ``size`` is their length."""
+
+    def __init__(self, manifest_path, media_root):
+        with open(manifest_path, encoding='ascii') as f:
+            header, totals, *lines = f.read().splitlines()
+        if header != MANIFEST_HEADER:
+            raise ValueError(f'{manifest_path} is not a chunk manifest')
+        size, self.digest = totals.split()
+        self.size = int(size)
+        self.chunks = [(digest, int(length)) for digest, length in (line.split() for line in lines)]
+        self.media_root = media_root
+
+    def __iter__(self):
+        for digest, length in self.chunks:
+            with open(os.path.join(self.media_root, chunk_name(digest)), 'rb') as f:
+                data = zlib.decompress(f.read())
+            if len(data) != length:
+                raise OSError(f'Chunk {digest} is damaged')
+            yield data
+
+
+def open_chunked(name):
+    """ChunkedContent of the stored manifest ``name``; FileNotFoundError when it is missing."""
+    return ChunkedContent(blob_storage.path(name), _media_root())
+
+
+# --- Converting versions ---
+
+def compactable_blobs(min_size=None):
+    """Names of the blobs superseded_versions use, of at least ``min_size`` bytes (default VERSION_CHUNKING_MIN_KB)."""
+    from .storage import superseded_versions
+
+    min_size = _min_size() if min_size is None else min_size
+    return (superseded_versions().filter(rozmiar_pliku__gte=min_size)
+            .order_by('plik').values_list('plik', flat=True).distinct())
+
+
+def replace_with_manifest(name, size, digest):
+    """
+    Point every version stored as the whole blob ``name`` at its manifest,
+    once write_chunked returned ``size`` and ``digest`` for it. Returns the
+    number of versions converted: 0 when the content does not match the
+    name or the blob has become the latest version's meanwhile.
+    """
+    from .models import DocumentVersion
+    from .storage import repoint_versions
+
+    if digest != blob_digest(name):
+        logger.error('Blob %s does not match its digest, left whole', name)
+        return 0
+    return repoint_versions(name, manifest_name(name), DocumentVersion.STORAGE_CHUNKED)
+
+
+def compact_blob(name):
+    """
+    Store the blob ``name`` as chunks and convert the versions using it.
+    Returns ``(versions, size, written)``, None when the file is missing.
+    """
+    source = blob_storage.path(name)
+    if not os.path.isfile(source):
+        return None
+    size, digest, written = write_chunked(source, blob_storage.path(manifest_name(name)), _media_root())
+    return replace_with_manifest(name, size, digest), size, written
+
+
+def schedule_compaction(version):
+    """With VERSION_CHUNKING, convert the versions superseded by a new ``version`` once the transaction commits."""
+    if not getattr(settings, 'VERSION_CHUNKING', False):
+        return
+    document_id = version.dokument_id
+
+    def submit():
+        from .extraction import _background_pool
+
+        for name in compactable_blobs().filter(dokument_id=document_id):
+            future = _background_pool().submit(
+                write_chunked, blob_storage.path(name), blob_storage.path(manifest_name(name)), _media_root()
+            )
+            future.add_done_callback(lambda f, name=name: _on_chunked(name, f))
+
+    transaction.on_commit(submit)
+
+
+def _on_chunked(name, future):
+    from django.db import connection
+
+    try:
+        size, digest, _ = future.result()
+        replace_with_manifest(name, size, digest)
+    except Exception:
+        logger.exception('Storing %s as chunks failed', name)
+    finally:
+        connection.close()
+
+
+# --- Garbage collection ---
+
+def referenced_chunks():
+    """Digests of the chunks listed by every manifest on disk."""
+    root = blob_storage.path(MANIFEST_PREFIX)
+    digests = set()
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            if filename.endswith('.tmp'):
+                continue
+            try:
+                content = ChunkedContent(os.path.join(directory, filename), '')
+            except (FileNotFoundError, ValueError):
+                continue
+            digests.update(digest for digest, _ in content.chunks)
+    return digests
+
+
+def collect_chunk_garbage(grace=None, dry_run=False):
+    """
+    Delete the chunks no manifest lists that are older than ``grace``
+    (default BLOB_GC_GRACE_HOURS): a conversion writes its chunks before its
+    manifest. Returns ``(chunks, bytes)`` removed.
+    """
+    if grace is None:
+        grace = timedelta(hours=getattr(settings, 'BLOB_GC_GRACE_HOURS', 24))
+    cutoff = time.time() - grace.total_seconds()
+    referenced = referenced_chunks()
+    removed = freed = 0
+    for directory, _, files in os.walk(blob_storage.path(CHUNK_PREFIX)):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if filename in referenced or stat.st_mtime >= cutoff:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+            freed += stat.st_size
+    return removed, freed
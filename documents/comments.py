@@ -0,0 +1,70 @@
+"""
+Comment threads of a document.
+
+load_comment_thread() reads every active comment of a document and of its
+versions in one query and assembles the reply tree and the per-version
+grouping in memory, so the detail page costs the same number of queries
+whatever the number of versions and replies.
+"""
+from collections import defaultdict
+
+from django.db.models import Q
+
+
+class CommentThread:
+    """
+    The active comments of a document.
+
+    ``roots`` are the top-level comments, each with its ``replies`` (a list,
+    in order) and ``depth``; ``comments`` is the whole tree flattened in
+    display order (every reply right after its parent); ``by_version`` maps
+    a version id to its comments and ``document_comments`` holds those not
+    tied to a version. A reply whose parent is inactive is shown as a
+    top-level comment.
+    """
+
+    def __init__(self, comments):
+        by_id = {comment.pk: comment for comment in comments}
+        self.roots = []
+        self.by_version = defaultdict(list)
+        self.document_comments = []
+        for comment in comments:
+            comment.replies = []
+        for comment in comments:
+            parent = by_id.get(comment.rodzic_id)
+            if parent is not None:
+                parent.replies.append(comment)
+            else:
+                self.roots.append(comment)
+            if comment.wersja_dokumentu_id:
+                self.by_version[comment.wersja_dokumentu_id].append(comment)
+            else:
+                self.document_comments.append(comment)
+
+        self.comments = []
+        stack = [(comment, 0) for comment in reversed(self.roots)]
+        while stack:
+            comment, depth = stack.pop()
+            comment.depth = depth
+            self.comments.append(comment)
+            stack.extend((reply, depth + 1) for reply in reversed(comment.replies))
+
+    def __len__(self):
+        return len(self.comments)
+
+    def __iter__(self):
+        return iter(self.comments)
+
+    def for_version(self, version):
+        return self.by_version.get(version.pk, [])
+
+
+def load_comment_thread(document):
+    from .models import Comment
+
+    comments = list(
+        Comment.objects.filter(Q(dokument=document) | Q(wersja_dokumentu__dokument=document), aktywny=True)
+        .select_related('uzytkownik__profile', 'wersja_dokumentu')
+        .order_by('data_utworzenia', 'pk')
+    )
+    return CommentThread(comments)
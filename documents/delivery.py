@@ -0,0 +1,278 @@
+"""
+Protected file delivery for downloads and previews.
+
+Views check permissions, then hand the file to the backend named by
+PROTECTED_FILE_DELIVERY and write the audit log (see audits_delivery):
+
+- ``FileResponseBackend`` (default) sends the file from the worker. The WSGI
+  server gets the open file through ``wsgi.file_wrapper`` and uses
+  os.sendfile where it can (gunicorn, uWSGI), so no bytes pass through
+  Python, but the worker stays busy until the client has the last byte.
+- ``XAccelRedirectBackend`` returns an empty response with an
+  ``X-Accel-Redirect`` header; nginx serves the file (ranges included) from
+  an ``internal`` location mapped onto MEDIA_ROOT and the worker is free as
+  soon as the headers are written::
+
+      location /protected/ {
+          internal;
+          alias /srv/docmanager/media/;
+      }
+
+- ``XSendfileBackend`` does the same through an ``X-Sendfile`` header with
+  the absolute path (Apache mod_xsendfile, lighttpd).
+
+Every backend answers conditional requests first: stored files never change
+under a name, so the SHA-256 of the content is a strong ETag and a matching
+If-None-Match / If-Modified-Since gets a 304 without touching the file.
+FileResponseBackend also serves single and multiple byte ranges (206/416);
+the proxies behind the other two do that themselves.
+
+ZIP downloads are built on the fly (documents.zip_stream) and old versions
+stored as chunks are rebuilt on the fly (serve_stream): both always stream
+from the worker. ``manage.py loadtest_downloads`` measures worker
+occupancy for each backend.
+"""
+import mimetypes
+import os
+import re
+import secrets
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils.module_loading import import_string
+
+RANGE_CHUNK_SIZE = 64 * 1024
+# More ranges than this in one request is not a resumed download or a PDF
+# viewer; such requests get the whole file (RFC 9110 allows ignoring Range).
+MAX_RANGES = 32
+_RANGE_RE = re.compile(r'^(\d*)-(\d*)$')
+
+
+def content_disposition(filename, as_attachment=True):
+    """Content-Disposition value with an ASCII fallback and the UTF-8 name (RFC 6266)."""
+    disposition = 'attachment' if as_attachment else 'inline'
+    ascii_filename = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '')
+    if not os.path.splitext(ascii_filename)[0]:
+        ascii_filename = 'download' + os.path.splitext(filename)[1]
+    return f"{disposition}; filename=\"{ascii_filename}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def parse_range_header(header, size):
+    """
+    Byte ranges of a ``Range`` header as sorted, merged ``(start, end)`` pairs
+    (``end`` inclusive). ``None`` means "send the whole file" (no header, an
+    unknown unit, bad syntax, too many ranges); ``[]`` means nothing in the
+    header is satisfiable (416).
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        match = _RANGE_RE.match(part.strip())
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:  # Suffix range: the last N bytes
+            if int(last) == 0:
+                continue
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_passes(request, etag, last_modified):
+    """False when an If-Range validator no longer matches: the client must get the whole file."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag is not None and if_range == etag  # Strong comparison only
+    return last_modified is not None and parse_http_date_safe(if_range) == last_modified
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining:
+        chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _stream_ranges(path, parts):
+    """Yield ``parts``, a list of either bytes or ``(start, end)`` ranges of the file at ``path``."""
+    with open(path, 'rb') as f:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from _read_range(f, *part)
+
+
+def _validators(etag, last_modified):
+    return (quote_etag(etag) if etag else None,
+            int(last_modified.timestamp()) if last_modified else None)
+
+
+def _content_headers(response, filename, as_attachment):
+    response['Content-Disposition'] = content_disposition(filename, as_attachment)
+    # Stored files are user content: never let the browser guess another type
+    response['X-Content-Type-Options'] = 'nosniff'
+
+
+def _cache_headers(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Downloads are permission-checked: browsers may keep them but must revalidate.
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+class DeliveryBackend:
+    """Turns an authorized FieldFile into the response that delivers it."""
+
+    def serve(self, request, file, filename, content_type=None, as_attachment=True, etag=None, last_modified=None):
+        """
+        ``etag`` is the content hash of ``file`` and ``last_modified`` (a
+        datetime) when it was stored; either enables conditional requests.
+        """
+        etag, last_modified = _validators(etag, last_modified)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            if not file or not os.path.exists(file.path):
+                raise Http404("Plik nie został znaleziony na serwerze.")
+            if content_type is None:
+                content_type = mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+            response = self.response(request, file, content_type, etag, last_modified)
+            _content_headers(response, filename, as_attachment)
+        return _cache_headers(response, etag, last_modified)
+
+    def response(self, request, file, content_type, etag, last_modified):
+        raise NotImplementedError
+
+
+class FileResponseBackend(DeliveryBackend):
+    def response(self, request, file, content_type, etag, last_modified):
+        size = os.path.getsize(file.path)
+        ranges = None
+        if request.method in ('GET', 'HEAD') and _if_range_passes(request, etag, last_modified):
+            ranges = parse_range_header(request.headers.get('Range'), size)
+
+        if ranges is None:
+            response = FileResponse(open(file.path, 'rb'), content_type=content_type)
+        elif not ranges:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = StreamingHttpResponse(_stream_ranges(file.path, ranges), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            boundary = secrets.token_hex(16)
+            parts = []
+            for start, end in ranges:
+                parts.append((f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                              f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode())
+                parts.append((start, end))
+                parts.append(b'\r\n')
+            parts.append(f'--{boundary}--\r\n'.encode())
+            response = StreamingHttpResponse(_stream_ranges(file.path, parts), status=206,
+                                             content_type=f'multipart/byteranges; boundary={boundary}')
+            response['Content-Length'] = str(sum(
+                len(part) if isinstance(part, bytes) else part[1] - part[0] + 1 for part in parts
+            ))
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+
+class XAccelRedirectBackend(DeliveryBackend):
+    def response(self, request, file, content_type, etag, last_modified):
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(settings.PROTECTED_FILE_INTERNAL_URL + file.name)
+        return response
+
+
+class XSendfileBackend(DeliveryBackend):
+    def response(self, request, file, content_type, etag, last_modified):
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = file.path
+        return response
+
+
+def get_delivery_backend():
+    return import_string(settings.PROTECTED_FILE_DELIVERY)()
+
+
+def serve_file(request, file, filename, content_type=None, as_attachment=True, etag=None, last_modified=None):
+    """Response delivering the stored ``file`` to the client as ``filename``, through the configured backend."""
+    return get_delivery_backend().serve(request, file, filename, content_type, as_attachment, etag, last_modified)
+
+
+def serve_stream(request, open_content, filename, content_type=None, as_attachment=True, etag=None, last_modified=None):
+    """
+    Like serve_file, for content that is not stored as one file (an old
+    version kept in chunks, see documents.chunked). ``open_content()``
+    returns an iterable of bytes with their total length as ``size``; it is
+    only called when the body is sent, and FileNotFoundError means 404. The
+    content always streams from the worker, whatever the backend, and Range
+    is ignored: the whole file is sent.
+    """
+    etag, last_modified = _validators(etag, last_modified)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        try:
+            content = open_content()
+        except FileNotFoundError:
+            raise Http404("Plik nie został znaleziony na serwerze.")
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = StreamingHttpResponse(iter(content), content_type=content_type)
+        response['Content-Length'] = str(content.size)
+        response['Accept-Ranges'] = 'none'
+        _content_headers(response, filename, as_attachment)
+    return _cache_headers(response, etag, last_modified)
+
+
+def audits_delivery(request, response, action, obj):
+    """
+    Whether the view should write ``action`` to the audit log for delivering
+    ``obj`` (a document or a version). Every 200/206 counts, whatever its
+    Range header, but a user fetching the same file again within
+    DELIVERY_LOG_THROTTLE_SECONDS (a viewer reading pages by range, a
+    resumed download) is logged once. 304s deliver nothing and are not
+    logged.
+    """
+    if response.status_code not in (200, 206):
+        return False
+    timeout = getattr(settings, 'DELIVERY_LOG_THROTTLE_SECONDS', 60)
+    if not timeout:
+        return True
+    # A cache that is not shared between processes only logs more often
+    key = f'delivery:{request.user.pk}:{action}:{obj._meta.label_lower}:{obj.pk}'
+    return cache.add(key, True, timeout)
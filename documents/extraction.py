@@ -0,0 +1,504 @@
+"""
+Text extraction from document versions, feeding the search index.
+
+Saving a DocumentVersion schedules its file (after the transaction commits)
+on a process pool; each worker reads one file with the extractor for its
+extension, under a wall-clock timeout and an address-space cap, so a huge or
+malformed file cannot stall or exhaust a web worker. The normalized text is
+stored as a DocumentVersionText row and the document is reindexed.
+
+Extractors are pure Python (zipfile/ElementTree for docx and xlsx, a small
+content-stream parser for PDF). When pypdf is installed it is used for PDFs
+instead, as it understands font encodings the built-in parser does not.
+
+``TEXT_EXTRACTION_EAGER = True`` runs extraction in-process at save time
+(tests, management shells). ``manage.py extract_text`` processes existing
+versions in parallel and resumes where a previous run stopped.
+"""
+import logging
+import os
+import re
+import signal
+import threading
+import time
+import unicodedata
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .search import MAX_INDEXED_TEXT
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# DocumentVersionText.status values. Workers do not load the Django models.
+STATUS_OK = 'ok'
+STATUS_EMPTY = 'pusty'
+STATUS_UNSUPPORTED = 'nieobslugiwany'
+STATUS_LIMIT = 'limit'
+STATUS_ERROR = 'blad'
+
+
+class ExtractionLimitExceeded(Exception):
+    """The worker ran out of time or memory for this file."""
+
+
+# --- Normalization ---
+
+_CONTROL_RE = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+_SPACES_RE = re.compile(r'[ \t\xa0]+')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+
+
+def normalize_text(text, max_chars=MAX_INDEXED_TEXT):
+    """NFKC, no control characters, collapsed whitespace, at most ``max_chars``."""
+    text = unicodedata.normalize('NFKC', text.replace('\r\n', '\n').replace('\r', '\n'))
+    text = _CONTROL_RE.sub(' ', text)
+    text = _SPACES_RE.sub(' ', text)
+    text = _BLANK_LINES_RE.sub('\n\n', text)
+    return text.strip()[:max_chars]
+
+
+# --- Extractors ---
+#
+# Each takes a path and the maximum number of characters wanted and returns
+# text; they stop reading once they have enough.
+
+def extract_txt(path, max_chars):
+    with open(path, 'rb') as f:
+        data = f.read(max_chars * 4)
+    for encoding in ('utf-8', 'cp1250'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='ignore')
+
+
+_XML_CHUNK = 64 * 1024
+
+
+def _open_zip_member(archive, name, max_bytes):
+    """Open ``name`` unless its declared size is past ``max_bytes`` (zip bombs)."""
+    info = archive.getinfo(name)
+    if info.file_size > max_bytes:
+        raise ExtractionLimitExceeded(f'{name} is {info.file_size} bytes uncompressed')
+    return archive.open(info)
+
+
+def _iter_xml(member):
+    """Yield ('start'|'end', element) from a zip member, parsed incrementally."""
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    for chunk in iter(lambda: member.read(_XML_CHUNK), b''):
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def extract_docx(path, max_chars):
+    parts, size = [], 0
+    with zipfile.ZipFile(path) as archive:
+        with _open_zip_member(archive, 'word/document.xml', max_chars * 20) as member:
+            for event, element in _iter_xml(member):
+                if event != 'end':
+                    continue
+                tag = _local(element.tag)
+                if tag == 't' and element.text:
+                    parts.append(element.text)
+                    size += len(element.text)
+                elif tag == 'tab':
+                    parts.append('\t')
+                elif tag in ('br', 'p'):
+                    parts.append('\n')
+                    if tag == 'p':
+                        element.clear()
+                if size >= max_chars:
+                    break
+    return ''.join(parts)
+
+
+def extract_xlsx(path, max_chars):
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        shared = []
+        if 'xl/sharedStrings.xml' in names:
+            with _open_zip_member(archive, 'xl/sharedStrings.xml', max_chars * 20) as member:
+                current = []
+                for event, element in _iter_xml(member):
+                    if event != 'end':
+                        continue
+                    tag = _local(element.tag)
+                    if tag == 't' and element.text:
+                        current.append(element.text)
+                    elif tag == 'si':
+                        shared.append(''.join(current))
+                        current = []
+                        element.clear()
+
+        sheets = sorted(
+            (n for n in names if n.startswith('xl/worksheets/sheet') and n.endswith('.xml')),
+            key=lambda n: int(re.sub(r'\D', '', n) or 0),
+        )
+        lines, size = [], 0
+        for sheet in sheets:
+            with _open_zip_member(archive, sheet, max_chars * 50) as member:
+                row, cell_type, value = [], None, None
+                for event, element in _iter_xml(member):
+                    tag = _local(element.tag)
+                    if event == 'start':
+                        if tag == 'c':
+                            cell_type, value = element.get('t'), None
+                        continue
+                    if tag in ('v', 't') and element.text is not None:
+                        value = element.text
+                    elif tag == 'c':
+                        if value is not None:
+                            if cell_type == 's':
+                                index = int(value)
+                                value = shared[index] if index < len(shared) else ''
+                            row.append(value)
+                        element.clear()
+                    elif tag == 'row':
+                        if row:
+                            line = '\t'.join(row)
+                            lines.append(line)
+                            size += len(line)
+                        row = []
+                        element.clear()
+                        if size >= max_chars:
+                            return '\n'.join(lines)
+    return '\n'.join(lines)
+
+
+# Minimal PDF support: inflate FlateDecode streams and read the strings shown
+# by the text operators. Good enough for text-based PDFs with standard
+# encodings; scanned images and CID fonts yield nothing.
+
+_PDF_STREAM_RE = re.compile(rb'stream\r?\n')
+_PDF_TOKEN_RE = re.compile(
+    rb'\((?:\\.|[^\\)])*\)'                 # literal string
+    rb'|<[0-9A-Fa-f\s]*>'                   # hex string
+    rb'|\[|\]'
+    rb'|/[^\s/\[\]()<>{}%]+'                # name
+    rb'|[^\s/\[\]()<>{}%]+',                # number or operator
+    re.S,
+)
+_PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+_PDF_LINE_OPERATORS = {b'Td', b'TD', b'T*', b'ET'}
+_PDF_MAX_STREAM = 32 * 1024 * 1024
+
+
+def _pdf_literal(token):
+    body = token[1:-1]
+    out = bytearray()
+    i = 0
+    while i < len(body):
+        byte = body[i:i + 1]
+        if byte != b'\\':
+            out += byte
+            i += 1
+            continue
+        nxt = body[i + 1:i + 2]
+        octal = re.match(rb'[0-7]{1,3}', body[i + 1:i + 4])
+        if octal:
+            out.append(int(octal.group(), 8) & 0xFF)
+            i += 1 + len(octal.group())
+        else:
+            out += _PDF_ESCAPES.get(nxt, nxt if nxt not in (b'\n', b'\r') else b'')
+            i += 2
+    return _pdf_decode(bytes(out))
+
+
+def _pdf_hex(token):
+    digits = re.sub(rb'\s', b'', token[1:-1])
+    if len(digits) % 2:
+        digits += b'0'
+    return _pdf_decode(bytes.fromhex(digits.decode('ascii')))
+
+
+def _pdf_decode(data):
+    if data.startswith(b'\xfe\xff'):
+        return data[2:].decode('utf-16-be', errors='ignore')
+    return data.decode('latin-1')
+
+
+def _pdf_streams(data):
+    for match in _PDF_STREAM_RE.finditer(data):
+        end = data.find(b'endstream', match.end())
+        if end < 0:
+            break
+        header = data[data.rfind(b'obj', 0, match.start()):match.start()]
+        raw = data[match.end():end]
+        if b'/FlateDecode' in header:
+            inflater = zlib.decompressobj()
+            try:
+                content = inflater.decompress(raw, _PDF_MAX_STREAM)
+            except zlib.error:
+                continue
+        elif b'/Filter' in header:
+            continue  # Images and other encodings carry no text
+        else:
+            content = raw
+        if b'BT' in content:
+            yield content
+
+
+def _pdf_text(content):
+    parts, strings = [], []
+    for token in _PDF_TOKEN_RE.findall(content):
+        first = token[:1]
+        if first == b'(':
+            strings.append(_pdf_literal(token))
+        elif first == b'<':
+            strings.append(_pdf_hex(token))
+        elif token in (b'Tj', b'TJ'):
+            parts.append(''.join(strings))
+            strings = []
+        elif token in (b"'", b'"'):
+            parts.append('\n' + ''.join(strings))
+            strings = []
+        elif token in _PDF_LINE_OPERATORS:
+            parts.append('\n')
+            strings = []
+        elif first.isalpha():
+            strings = []
+    return ''.join(parts)
+
+
+def extract_pdf(path, max_chars):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        PdfReader = None
+
+    parts, size = [], 0
+    if PdfReader is not None:
+        for page in PdfReader(path).pages:
+            text = page.extract_text() or ''
+            parts.append(text)
+            size += len(text)
+            if size >= max_chars:
+                break
+        return '\n'.join(parts)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    for content in _pdf_streams(data):
+        text = _pdf_text(content)
+        parts.append(text)
+        size += len(text)
+        if size >= max_chars:
+            break
+    return '\n'.join(parts)
+
+
+EXTRACTORS = {
+    '.txt': extract_txt,
+    '.csv': extract_txt,
+    '.md': extract_txt,
+    '.pdf': extract_pdf,
+    '.docx': extract_docx,
+    '.xlsx': extract_xlsx,
+}
+
+
+def extractor_for(path):
+    return EXTRACTORS.get(os.path.splitext(path)[1].lower())
+
+
+# --- Worker side ---
+
+def _limit_memory(memory_mb):
+    """Pool initializer: cap the worker's address space at its current size plus ``memory_mb``."""
+    if resource is None or not memory_mb:
+        return
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        current = 0
+    limit = current + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _on_alarm(signum, frame):
+    raise ExtractionLimitExceeded('timed out')
+
+
+def extract_file(path, timeout=None, max_chars=MAX_INDEXED_TEXT):
+    """
+    Extract and normalize the text of ``path``.
+
+    Returns ``(status, text, message, elapsed_ms)`` with a
+    DocumentVersionText status. Never raises; runs in pool workers.
+    """
+    started = time.monotonic()
+    extractor = extractor_for(path)
+    if extractor is None:
+        return STATUS_UNSUPPORTED, '', '', 0
+
+    use_alarm = timeout and hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        text = normalize_text(extractor(path, max_chars), max_chars)
+        status, message = (STATUS_OK if text else STATUS_EMPTY), ''
+    except (ExtractionLimitExceeded, MemoryError) as exc:
+        text, status, message = '', STATUS_LIMIT, str(exc) or 'out of memory'
+    except Exception as exc:
+        text, status, message = '', STATUS_ERROR, f'{type(exc).__name__}: {exc}'
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return status, text, message[:255], int((time.monotonic() - started) * 1000)
+
+
+# --- Parent side ---
+
+def create_pool(workers=None):
+    """Process pool with the configured memory cap. Workers are spawned, not forked."""
+    return ProcessPoolExecutor(
+        max_workers=workers or _setting('TEXT_EXTRACTION_WORKERS', 2),
+        mp_context=get_context('spawn'),
+        initializer=_limit_memory,
+        initargs=(_setting('TEXT_EXTRACTION_MEMORY_MB', 512),),
+    )
+
+
+def _version_path(version):
+    if not version.plik or version.sposob_przechowywania != version.STORAGE_WHOLE:
+        return None  # Chunked versions were extracted while they were whole
+    try:
+        return version.plik.path
+    except NotImplementedError:  # Remote storage
+        return None
+
+
+def store_extraction(version_id, result):
+    """Save an ``extract_file`` result and reindex the version's document."""
+    from .models import DocumentVersion, DocumentVersionText
+    from .search import index_document
+
+    status, text, message, elapsed_ms = result
+    version = DocumentVersion.objects.select_related('dokument').filter(pk=version_id).first()
+    if version is None:
+        return None  # Deleted meanwhile
+    row, _ = DocumentVersionText.objects.update_or_create(
+        wersja=version,
+        defaults={'tekst': text, 'status': status, 'komunikat': message, 'czas_ms': elapsed_ms},
+    )
+    index_document(version.dokument)
+    return row
+
+
+def extract_versions(versions, workers=None, timeout=None, on_result=None):
+    """
+    Extract ``versions`` on a fresh process pool and store each result as it
+    finishes; ``on_result(version_id, result)`` is called after each one.
+
+    A worker that dies (e.g. killed at the memory cap) breaks the whole pool,
+    so the versions that were in flight are retried one at a time on a new
+    pool; only the one that kills its worker again is recorded as failed.
+    """
+    timeout = timeout or _setting('TEXT_EXTRACTION_TIMEOUT', 60)
+
+    def record(version_id, result):
+        store_extraction(version_id, result)
+        if on_result is not None:
+            on_result(version_id, result)
+
+    paths = {}
+    for version in versions:
+        path = _version_path(version)
+        if path is None or not os.path.exists(path):
+            record(version.pk, (STATUS_ERROR, '', 'file missing', 0))
+        else:
+            paths[version.pk] = path
+
+    died = []
+    with create_pool(workers) as pool:
+        pending = {pool.submit(extract_file, path, timeout): version_id for version_id, path in paths.items()}
+        for future in as_completed(pending):
+            try:
+                record(pending[future], future.result())
+            except BrokenProcessPool:
+                died.append(pending[future])
+
+    for version_id in died:
+        with create_pool(1) as pool:
+            try:
+                result = pool.submit(extract_file, paths[version_id], timeout).result()
+            except BrokenProcessPool:
+                result = (STATUS_LIMIT, '', 'worker died', 0)
+        record(version_id, result)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _background_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_pool()
+        return _pool
+
+
+def _store_in_background(version_id, future):
+    global _pool
+    try:
+        result = future.result()
+    except BrokenProcessPool:
+        with _pool_lock:
+            _pool = None
+        result = (STATUS_LIMIT, '', 'worker died', 0)
+    except Exception:
+        logger.exception('Text extraction of version %s failed', version_id)
+        return
+    try:
+        store_extraction(version_id, result)
+    except Exception:
+        logger.exception('Storing extracted text of version %s failed', version_id)
+    finally:
+        connection.close()
+
+
+def schedule_extraction(version):
+    """Extract ``version`` once the current transaction commits."""
+    if _setting('TEXT_EXTRACTION_EAGER', False):
+        path = _version_path(version)
+        if path is not None and os.path.exists(path):
+            store_extraction(version.pk, extract_file(path))
+        return
+
+    def submit():
+        path = _version_path(version)
+        if path is None:
+            return
+        future = _background_pool().submit(extract_file, path, _setting('TEXT_EXTRACTION_TIMEOUT', 60))
+        future.add_done_callback(lambda f: _store_in_background(version.pk, f))
+
+    transaction.on_commit(submit)
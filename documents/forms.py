@@ -1,9 +1,10 @@
 from django import forms
+from django.conf import settings
 from django.core.validators import FileExtensionValidator
 from django.core.exceptions import ValidationError
-from .models import Document, Folder, Tag, Comment
+from .models import Document, Folder, Tag, Comment, UploadSession
 import os
-from guardian.shortcuts import get_objects_for_user
+from users.permissions import PermissionIndex
 
 
 class DocumentUploadForm(forms.ModelForm):
@@ -66,7 +67,7 @@ class DocumentUploadForm(forms.ModelForm):
                 self.fields['folder'].queryset = Folder.objects.all()
             else:
                 # Get all folders the user can browse
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 self.fields['folder'].queryset = browseable_folders
             
             # Set default folder if user has any and no initial folder is set
@@ -155,7 +156,7 @@ class DocumentUpdateForm(forms.ModelForm):
             if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
                 self.fields['folder'].queryset = Folder.objects.all()
             else:
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 self.fields['folder'].queryset = browseable_folders
 
 
@@ -198,6 +199,50 @@ class DocumentVersionUploadForm(forms.Form):
         return plik
 
 
+class UploadSessionForm(forms.ModelForm):
+    """Announces a resumable upload (see documents.resumable): the file itself arrives later in chunks."""
+
+    class Meta:
+        model = UploadSession
+        fields = ['nazwa_pliku', 'rozmiar', 'folder', 'dokument', 'nazwa', 'opis', 'komentarz']
+
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
+        super().__init__(*args, **kwargs)
+        self.fields['dokument'].queryset = Document.objects.filter(usunieto=False)
+
+        if user:
+            # The same target folders as DocumentUploadForm offers
+            if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
+                self.fields['folder'].queryset = Folder.objects.all()
+            else:
+                self.fields['folder'].queryset = PermissionIndex(user).filter_folders(Folder.objects.all())
+
+    def clean_nazwa_pliku(self):
+        nazwa_pliku = os.path.basename(self.cleaned_data['nazwa_pliku'].replace('\\', '/'))
+        ext = os.path.splitext(nazwa_pliku)[1].lower().lstrip('.')
+        if ext not in Document.ALLOWED_EXTENSIONS:
+            raise ValidationError(f"Nieobsługiwany format pliku. Dozwolone formaty: {', '.join(Document.ALLOWED_EXTENSIONS)}")
+        return nazwa_pliku
+
+    def clean_rozmiar(self):
+        rozmiar = self.cleaned_data['rozmiar']
+        max_size = settings.UPLOAD_MAX_SIZE
+        if rozmiar < 1:
+            raise ValidationError("Plik jest pusty.")
+        if rozmiar > max_size:
+            raise ValidationError(f"Plik jest za duży! Maksymalny rozmiar to {max_size // 1024 // 1024}MB.")
+        return rozmiar
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('dokument'):
+            cleaned_data['folder'] = cleaned_data['dokument'].folder
+        elif not cleaned_data.get('nazwa') and cleaned_data.get('nazwa_pliku'):
+            cleaned_data['nazwa'] = cleaned_data['nazwa_pliku']
+        return cleaned_data
+
+
 class FolderCreateForm(forms.ModelForm):
     class Meta:
         model = Folder
@@ -222,7 +267,7 @@ class FolderCreateForm(forms.ModelForm):
                 self.fields['rodzic'].queryset = Folder.objects.all()
             else:
                 # Get all folders the user can browse
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 self.fields['rodzic'].queryset = browseable_folders
 
 
@@ -341,7 +386,7 @@ class BulkActionForm(forms.Form):
                 self.fields['target_folder'].queryset = Folder.objects.all()
             else:
                 # Get all folders the user can browse
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 self.fields['target_folder'].queryset = browseable_folders
 
 class FolderUpdateForm(forms.ModelForm):
@@ -372,7 +417,7 @@ class FolderUpdateForm(forms.ModelForm):
                 queryset = Folder.objects.all()
             else:
                 # Get all folders the user can browse
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 queryset = browseable_folders
             
             # Exclude current folder and its descendants to prevent circular references
@@ -385,13 +430,7 @@ class FolderUpdateForm(forms.ModelForm):
     
     def _get_descendants(self, folder):
         """Get all descendants of a folder"""
-        descendants = Folder.objects.filter(rodzic=folder)
-        all_descendants = descendants
-        
-        for descendant in descendants:
-            all_descendants = all_descendants | self._get_descendants(descendant)
-        
-        return all_descendants
+        return folder.get_descendants()
     
     def clean_nazwa(self):
         """Validate folder name"""
@@ -453,7 +492,7 @@ class FolderDeleteForm(forms.Form):
                 queryset = Folder.objects.all()
             else:
                 # Get all folders the user can browse
-                browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
+                browseable_folders = PermissionIndex(user).filter_folders(Folder.objects.all())
                 queryset = browseable_folders
             
             # Exclude the folder being deleted and its descendants
@@ -473,13 +512,7 @@ class FolderDeleteForm(forms.Form):
     
     def _get_descendants(self, folder):
         """Get all descendants of a folder"""
-        descendants = Folder.objects.filter(rodzic=folder)
-        all_descendants = descendants
-        
-        for descendant in descendants:
-            all_descendants = all_descendants | self._get_descendants(descendant)
-        
-        return all_descendants
+        return folder.get_descendants()
     
     def clean(self):
         cleaned_data = super().clean()
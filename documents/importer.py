@@ -0,0 +1,261 @@
+"""
+Bulk import of a directory tree.
+
+``manage.py import_documents <dir>`` mirrors the directory as folders
+(the directory itself becomes a folder, under ``--folder`` or at the top
+level) and every file with an allowed extension as a document with its
+first version, owned by one user. The upload views do a handful of
+INSERTs, guardian grants and an activity log row per file; here:
+
+* a process pool copies every file into the blob store and hashes it in
+  the same pass (store_file, no Django models in the workers);
+* every IMPORT_BATCH_SIZE files are inserted with bulk_create in one
+  transaction: documents, versions, the owner's guardian permissions and
+  their DocumentACL rows, activity log rows, blob references, statistics
+  and the search index, which the signals would otherwise maintain.
+
+Folders are created one by one through save() (they are few and it keeps
+their paths, statistics and permissions); existing folders with the same
+name under the same parent are reused.
+
+Every committed batch is appended to a manifest (JSON lines, the file's
+path relative to the directory and its document id): an interrupted
+import run again with the same manifest skips what is already in. Text
+extraction and previews are left to ``manage.py extract_text`` and
+``warm_previews``.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.db import transaction
+
+from .storage import BLOB_PREFIX, blob_name
+from .uploads import sniff_mime
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_READ_SIZE = 1024 * 1024
+SNIFF_SIZE = 2048
+
+
+# --- Copying (runs in pool workers: no Django models here) ---
+
+def store_file(source, media_root):
+    """
+    Copy the file at ``source`` into the blob store under ``media_root``,
+    hashing it on the way. Returns ``(name, size, digest, mime)``, or
+    ``(None, error)`` when the file cannot be read.
+    """
+    tmp_dir = os.path.join(media_root, BLOB_PREFIX, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    digest = hashlib.sha256()
+    head = b''
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(IMPORT_READ_SIZE), b''):
+                if not head:
+                    head = chunk[:SNIFF_SIZE]
+                digest.update(chunk)
+                dst.write(chunk)
+            size = dst.tell()
+        name = blob_name(digest.hexdigest(), source)
+        target = os.path.join(media_root, name)
+        if os.path.exists(target):
+            os.remove(tmp_path)  # Same content is already stored
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp_path, target)
+    except OSError as exc:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, str(exc)
+    return name, size, digest.hexdigest(), sniff_mime(head, source)
+
+
+def create_pool(workers=None):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+
+
+# --- Manifest ---
+
+def default_manifest_path(directory):
+    """``<dir>.import.jsonl`` next to the imported directory."""
+    return os.path.abspath(directory).rstrip(os.sep) + '.import.jsonl'
+
+
+def read_manifest(path):
+    """Relative paths already imported according to the manifest at ``path``."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return {json.loads(line)['sciezka'] for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def append_manifest(path, entries):
+    with open(path, 'a', encoding='utf-8') as f:
+        for relative_path, document_id in entries:
+            f.write(json.dumps({'sciezka': relative_path, 'dokument': document_id}, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# --- Folders and files ---
+
+def _folder(name, parent, owner):
+    from guardian.shortcuts import assign_perm
+    from .models import Folder
+
+    folder = Folder.objects.filter(rodzic=parent, nazwa=name).order_by('pk').first()
+    if folder is None:
+        folder = Folder.objects.create(nazwa=name, rodzic=parent, wlasciciel=owner)
+        assign_perm('browse_folder', owner, folder)
+    return folder
+
+
+def scan(directory, owner, parent=None, done=()):
+    """
+    Create the folders mirroring ``directory`` and list the files to import
+    as ``(relative_path, absolute_path, folder)``, skipping the paths in
+    ``done``. Returns ``(files, skipped)``, ``skipped`` being the files
+    whose extension or name documents do not allow.
+    """
+    from .models import Document
+
+    directory = os.path.abspath(directory)
+    root = _folder(os.path.basename(directory.rstrip(os.sep)) or directory, parent, owner)
+    folders = {'.': root}
+    files, skipped = [], []
+    for current, subdirectories, filenames in os.walk(directory):
+        subdirectories.sort()
+        relative_dir = os.path.relpath(current, directory)
+        folder = folders[relative_dir]
+        for subdirectory in subdirectories:
+            folders[os.path.normpath(os.path.join(relative_dir, subdirectory))] = _folder(subdirectory, folder, owner)
+        for filename in sorted(filenames):
+            relative_path = os.path.normpath(os.path.join(relative_dir, filename))
+            if relative_path in done:
+                continue
+            extension = os.path.splitext(filename)[1].lower().lstrip('.')
+            if extension not in Document.ALLOWED_EXTENSIONS or len(filename) > 255:
+                skipped.append(relative_path)
+                continue
+            files.append((relative_path, os.path.join(current, filename), folder))
+    return files, skipped
+
+
+# --- Inserting ---
+
+def insert_batch(rows, owner):
+    """
+    Create the documents and first versions of ``rows`` (``(relative_path,
+    folder, stored)`` with ``stored`` as returned by store_file) in one
+    transaction. Returns ``[(relative_path, document_id)]``.
+    """
+    from collections import Counter
+
+    from django.contrib.contenttypes.models import ContentType
+    from guardian.models import UserObjectPermission
+
+    from .acl import acl_permission_bit
+    from .models import ActivityLog, Document, DocumentACL, DocumentVersion
+    from .search import index_documents
+    from .stats import document_state, documents_added
+    from .storage import add_blob_references
+    from .versions import latest_version_id
+
+    permissions = ['browse_document', 'download_document']
+    with transaction.atomic():
+        documents = Document.objects.bulk_create([
+            Document(
+                nazwa=os.path.basename(relative_path),
+                typ_pliku=os.path.splitext(relative_path)[1].lower().lstrip('.'),
+                rozmiar_pliku=size,
+                plik=name,
+                hash_pliku=digest,
+                typ_mime=mime,
+                wlasciciel=owner,
+                folder=folder,
+                licznik_wersji=1,
+            )
+            for relative_path, folder, (name, size, digest, mime) in rows
+        ])
+        DocumentVersion.objects.bulk_create([
+            DocumentVersion(
+                dokument=document,
+                numer_wersji=1,
+                plik=document.plik.name,
+                oryginalna_nazwa_pliku=document.nazwa,
+                rozmiar_pliku=document.rozmiar_pliku,
+                hash_pliku=document.hash_pliku,
+                typ_mime=document.typ_mime,
+                utworzony_przez=owner,
+            )
+            for document in documents
+        ])
+        ids = [document.pk for document in documents]
+        Document.objects.filter(pk__in=ids).update(aktualna_wersja=latest_version_id())
+
+        # What DocumentUploadView's assign_perm calls and their signals do
+        content_type = ContentType.objects.get_for_model(Document)
+        mask = 0
+        for codename in permissions:
+            permission = content_type.permission_set.get(codename=codename)
+            UserObjectPermission.objects.bulk_create([
+                UserObjectPermission(permission=permission, user=owner, content_type=content_type, object_pk=str(pk))
+                for pk in ids
+            ])
+            mask |= acl_permission_bit(Document, codename)
+        DocumentACL.objects.bulk_create([DocumentACL(uzytkownik=owner, dokument_id=pk, uprawnienia=mask) for pk in ids])
+
+        ActivityLog.objects.bulk_create([
+            ActivityLog(uzytkownik=owner, typ_aktywnosci='tworzenie', dokument=document,
+                        szczegoly=f"Zaimportował dokument '{document.nazwa}'")
+            for document in documents
+        ])
+        references = Counter()
+        for document in documents:
+            references[document.plik.name] += 2  # The document and its version
+        add_blob_references(references)
+        documents_added([document_state(document) for document in documents])
+        index_documents(list(Document.objects.filter(pk__in=ids).prefetch_related('tagi', 'metadane')))
+    return [(relative_path, document.pk) for (relative_path, _, _), document in zip(rows, documents)]
+
+
+def import_files(files, owner, media_root, manifest_path, workers=None, batch_size=IMPORT_BATCH_SIZE,
+                 progress=None):
+    """
+    Store and insert ``files`` (as listed by scan) in batches, appending
+    each committed batch to the manifest. ``progress(files, bytes)`` is
+    called after every batch. Returns ``(imported, bytes, failed)``,
+    ``failed`` being ``[(relative_path, error)]``.
+    """
+    imported = total_bytes = 0
+    failed = []
+    batch = []
+
+    def flush():
+        nonlocal imported, total_bytes
+        append_manifest(manifest_path, insert_batch(batch, owner))
+        imported += len(batch)
+        total_bytes += sum(stored[1] for _, _, stored in batch)
+        batch.clear()
+        if progress is not None:
+            progress(imported, total_bytes)
+
+    with create_pool(workers) as pool:
+        results = pool.map(store_file, [path for _, path, _ in files], [media_root] * len(files), chunksize=16)
+        for (relative_path, _, folder), result in zip(files, results):
+            if result[0] is None:
+                failed.append((relative_path, result[1]))
+                continue
+            batch.append((relative_path, folder, result))
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    return imported, total_bytes, failed
@@ -0,0 +1,72 @@
+"""
+Keyset pagination for folder listings.
+
+A listing is made of sections (folders, then documents), each ordered by
+``(nazwa, id)`` in the database. A page continues from a cursor, the kind,
+name and id of the last item shown, with ``WHERE nazwa >= x AND (nazwa > x
+OR id > y)`` on the ``(parent, nazwa, id)`` indexes, so fetching a page
+costs the same whatever its position and the size of the folder, unlike
+OFFSET. Items added or removed meanwhile never shift a page.
+"""
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+
+
+def encode_cursor(kind, nazwa, pk):
+    return base64.urlsafe_b64encode(json.dumps([kind, nazwa, pk]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """``(kind, nazwa, id)`` of a cursor from the query string, None when missing or malformed."""
+    if not value:
+        return None
+    try:
+        kind, nazwa, pk = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if not isinstance(kind, str) or not isinstance(nazwa, str) or not isinstance(pk, int):
+        return None
+    return kind, nazwa, pk
+
+
+def keyset_after(queryset, nazwa=None, pk=None):
+    """``queryset`` in ``(nazwa, id)`` order, starting after the given row when there is one."""
+    queryset = queryset.order_by('nazwa', 'id')
+    if nazwa is None:
+        return queryset
+    # The redundant nazwa >= x lets the index seek instead of scanning from the start
+    return queryset.filter(Q(nazwa__gte=nazwa), Q(nazwa__gt=nazwa) | Q(id__gt=pk))
+
+
+def listing_page(sections, cursor, size):
+    """
+    One page of at most ``size`` items of ``sections``, a list of
+    ``(kind, queryset)`` listed one after another. Returns ``{kind: [items]}``
+    and the cursor of the next page (None on the last one).
+    """
+    kinds = [kind for kind, _ in sections]
+    start = kinds.index(cursor[0]) if cursor and cursor[0] in kinds else 0
+    if cursor and cursor[0] not in kinds:
+        cursor = None
+    page = {kind: [] for kind in kinds}
+    taken = 0
+    last = None
+    for position, (kind, queryset) in enumerate(sections[start:], start):
+        after = cursor[1:] if cursor and position == start else ()
+        queryset = keyset_after(queryset, *after)
+        remaining = size - taken
+        if remaining == 0:
+            if queryset.exists():
+                return page, encode_cursor(*last)
+            continue
+        rows = list(queryset[:remaining + 1])
+        page[kind] = rows[:remaining]
+        taken += len(page[kind])
+        if page[kind]:
+            last = (kind, page[kind][-1].nazwa, page[kind][-1].pk)
+        if len(rows) > remaining:
+            return page, encode_cursor(*last)
+    return page, None
@@ -0,0 +1,102 @@
+import os
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from documents.activity import export_activity_logs, month_bounds, rollup_activity_day
+from documents.models import ActivityLog
+
+
+class Command(BaseCommand):
+    help = ('Export ActivityLog months older than the retention period to gzip JSONL files '
+            'and delete them from the database (daily rollups are kept)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months',
+            type=int,
+            default=getattr(settings, 'ACTIVITY_LOG_RETENTION_MONTHS', 12),
+            help='Number of most recent calendar months (including the current one) to keep in the database',
+        )
+        parser.add_argument(
+            '--output-dir',
+            default=str(getattr(settings, 'ACTIVITY_LOG_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'var', 'activity_archive'))),
+            help='Directory for the activity_log_YYYY-MM.jsonl.gz files',
+        )
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows deleted per statement')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report which months would be archived',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.localtime()
+        year, month = now.year, now.month - (max(options['keep_months'], 1) - 1)
+        while month < 1:
+            year, month = year - 1, month + 12
+        cutoff, _ = month_bounds(year, month)
+
+        oldest = ActivityLog.objects.order_by('znacznik_czasu').values_list('znacznik_czasu', flat=True).first()
+        if oldest is None or oldest >= cutoff:
+            self.stdout.write(self.style.SUCCESS(f'✓ Nothing older than {cutoff.date()} to archive.'))
+            return
+
+        os.makedirs(options['output_dir'], exist_ok=True)
+        oldest = timezone.localtime(oldest)
+        year, month = oldest.year, oldest.month
+        archived = 0
+        while True:
+            start, end = month_bounds(year, month)
+            if start >= cutoff:
+                break
+            archived += self._archive_month(year, month, start, end, options)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(f'✓ {verb} {archived} activity log rows older than {cutoff.date()}.'))
+
+    def _archive_month(self, year, month, start, end, options):
+        rows = ActivityLog.objects.filter(znacznik_czasu__gte=start, znacznik_czasu__lt=end)
+        label = f'{year:04d}-{month:02d}'
+        if options['dry_run']:
+            count = rows.count()
+            self.stdout.write(f'- {label}: {count} rows')
+            return count
+
+        # Never overwrite an earlier export: rows may have been added to an
+        # already archived month since (e.g. replayed spill files).
+        path = os.path.join(options['output_dir'], f'activity_log_{label}.jsonl.gz')
+        part = 1
+        while os.path.exists(path):
+            part += 1
+            path = os.path.join(options['output_dir'], f'activity_log_{label}.{part}.jsonl.gz')
+
+        # Only the rows that went into the file are deleted and counted as
+        # archived; rows arriving meanwhile stay for the next run.
+        exported = []
+        archived = defaultdict(Counter)
+
+        def collect(row):
+            exported.append(row['id'])
+            day = timezone.localdate(row['znacznik_czasu'])
+            archived[day][row['uzytkownik_id'], row['typ_aktywnosci'], row['dokument_id']] += 1
+
+        count = export_activity_logs(rows, path, on_row=collect)
+        deleted = 0
+        try:
+            with transaction.atomic():
+                for offset in range(0, len(exported), options['batch_size']):
+                    batch = exported[offset:offset + options['batch_size']]
+                    deleted += ActivityLog.objects.filter(pk__in=batch).delete()[0]
+                # Make sure the month's statistics survive the raw rows.
+                for day, counts in sorted(archived.items()):
+                    rollup_activity_day(day, archived=counts)
+        except Exception:
+            os.remove(path)  # Nothing was deleted; the next run exports the rows again
+            raise
+        self.stdout.write(f'- {label}: exported {count} rows to {path}, deleted {deleted}')
+        return count
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from documents.acl import ACL_MODELS, rebuild_acl
+
+
+class Command(BaseCommand):
+    help = 'Rebuild DocumentACL/FolderACL bitmasks from guardian user object permissions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report out-of-sync ACL rows, do not modify anything',
+        )
+
+    def handle(self, *args, **options):
+        out_of_sync = 0
+        for model, (acl_model, _) in ACL_MODELS.items():
+            created, updated, deleted = rebuild_acl(model, dry_run=options['check'])
+            out_of_sync += created + updated + deleted
+            self.stdout.write(
+                f'- {acl_model._meta.db_table}: {created} missing, {updated} wrong mask, {deleted} stale'
+            )
+
+        if not out_of_sync:
+            self.stdout.write(self.style.SUCCESS('✓ ACL tables are in sync with guardian.'))
+        elif options['check']:
+            self.stdout.write(self.style.ERROR('ACL tables are out of sync, run without --check to repair.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✓ Repaired {out_of_sync} ACL rows.'))
@@ -0,0 +1,91 @@
+import random
+import time
+
+from django.contrib.auth.models import Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from guardian.core import ObjectPermissionChecker
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import get_objects_for_user
+
+from documents.acl import acl_object_ids, rebuild_acl
+from documents.models import Document
+from users.permissions import PermissionResolver
+
+
+class Command(BaseCommand):
+    help = 'Compare guardian generic lookups with the DocumentACL table on synthetic data (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--grants-per-user', type=int, default=200)
+        parser.add_argument('--sample-users', type=int, default=50,
+                            help='Number of users the lookups are timed for')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self._populate(options)
+            self._measure(options['sample_users'])
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS('✓ Synthetic data rolled back.'))
+
+    def _populate(self, options):
+        started = time.perf_counter()
+        owner = User.objects.create_user('benchmark_acl_owner')
+        users = User.objects.bulk_create([
+            User(username=f'benchmark_acl_{i}') for i in range(options['users'])
+        ], batch_size=1000)
+        documents = Document.objects.bulk_create([
+            Document(nazwa=f'benchmark_{i}.txt', wlasciciel=owner) for i in range(options['documents'])
+        ], batch_size=1000)
+
+        content_type = ContentType.objects.get_for_model(Document)
+        browse = Permission.objects.get(content_type=content_type, codename='browse_document')
+        rng = random.Random(0)
+        grants = []
+        for user in users:
+            for document in rng.sample(documents, min(options['grants_per_user'], len(documents))):
+                grants.append(UserObjectPermission(
+                    user=user, permission=browse, content_type=content_type, object_pk=str(document.pk)
+                ))
+        UserObjectPermission.objects.bulk_create(grants, batch_size=5000)
+        rebuild_acl(Document)
+        self.users, self.documents = users, documents
+        self.stdout.write(
+            f'Created {len(documents)} documents, {len(users)} users and {len(grants)} grants '
+            f'in {time.perf_counter() - started:.1f}s'
+        )
+
+    def _time(self, label, func, users):
+        started = time.perf_counter()
+        total = 0
+        for user in users:
+            total += func(user)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'- {label}: {elapsed * 1000 / len(users):.2f} ms/user (total {total})')
+        return total
+
+    def _measure(self, sample_size):
+        users = self.users[:sample_size]
+        probes = random.Random(1).sample(self.documents, min(20, len(self.documents)))
+
+        self.stdout.write('Browseable document ids:')
+        before = self._time('guardian get_objects_for_user', lambda user: len(list(
+            get_objects_for_user(user, 'documents.browse_document', klass=Document, accept_global_perms=False)
+            .values_list('pk', flat=True)
+        )), users)
+        after = self._time('DocumentACL', lambda user: len(list(
+            acl_object_ids(user, Document, 'browse_document')
+        )), users)
+        if before != after:
+            self.stdout.write(self.style.ERROR('Results differ between guardian and the ACL table!'))
+
+        self.stdout.write(f'Single-object checks ({len(probes)} documents per user):')
+        self._time('guardian ObjectPermissionChecker',
+                   lambda user: sum(ObjectPermissionChecker(user).has_perm('browse_document', d) for d in probes),
+                   users)
+        self._time('PermissionResolver (ACL)',
+                   lambda user: sum(PermissionResolver(user).has_perm('browse_document', d) for d in probes),
+                   users)
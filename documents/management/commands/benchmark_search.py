@@ -0,0 +1,119 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from documents.models import Document, DocumentACL
+from documents.search import COLUMNS, analyzed, get_search_backend, search_documents
+from users.permissions import PermissionIndex
+
+WORDS = (
+    'umowa faktura raport sprawozdanie projekt budżet zamówienie protokół oferta aneks '
+    'regulamin instrukcja polityka wniosek decyzja notatka harmonogram kosztorys specyfikacja '
+    'rozliczenie dostawa serwis licencja audyt kontrola szkolenie rekrutacja wynagrodzenie '
+    'urlop delegacja magazyn sprzedaż marketing klient dostawca inwestycja kredyt leasing '
+    'podatek księgowość bilans archiwum pełnomocnictwo reklamacja gwarancja certyfikat'
+).split()
+
+
+SYLLABLES = 'ba be bi bo bu ka ke ki ko ku ma me mi mo mu na ne ni no nu ra re ri ro ru sta ste sto tra tre kro wie dzi szo'.split()
+
+
+def vocabulary(size, rng):
+    """Domain words followed by ``size`` synthetic ones, with Zipf-like weights."""
+    words = list(WORDS)
+    seen = set(words)
+    while len(words) < len(WORDS) + size:
+        word = ''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** 1.07 for rank in range(len(words))))
+    return words, cum_weights
+
+
+class Command(BaseCommand):
+    help = 'Measure search latency on synthetic documents (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--vocabulary', type=int, default=50000, help='Number of distinct synthetic words')
+
+    def handle(self, *args, **options):
+        if get_search_backend() is None:
+            raise CommandError('This database has no full-text index.')
+
+        self.words, self.cum_weights = vocabulary(options['vocabulary'], random.Random(0))
+        with transaction.atomic():
+            self._populate(options['documents'], options['batch_size'])
+            self._measure(options['queries'])
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS('✓ Synthetic data rolled back.'))
+
+    def _populate(self, count, batch_size):
+        started = time.perf_counter()
+        rng = random.Random(0)
+        owner = User.objects.create_user('benchmark_search_owner')
+        created = 0
+        while created < count:
+            size = min(batch_size, count - created)
+            texts = [
+                (' '.join(rng.choices(self.words, cum_weights=self.cum_weights, k=3)),
+                 ' '.join(rng.choices(self.words, cum_weights=self.cum_weights, k=30)))
+                for _ in range(size)
+            ]
+            documents = Document.objects.bulk_create([
+                Document(nazwa=name, opis=description, wlasciciel=owner) for name, description in texts
+            ])
+            # bulk_create skips the indexing signals; feed the index directly.
+            if connection.vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.executemany(
+                        f'INSERT INTO dokument_fts (rowid, {", ".join(COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)',
+                        [(d.pk, analyzed(d.nazwa), analyzed(d.opis), '', '', '') for d in documents],
+                    )
+            else:
+                backend = get_search_backend()
+                for d in documents:
+                    backend.index(d.pk, (analyzed(d.nazwa), analyzed(d.opis), '', '', ''))
+            created += size
+            self.stdout.write(f'- {created} documents')
+        self.stdout.write(f'Created {count} documents in {time.perf_counter() - started:.1f}s')
+
+    def _measure(self, queries):
+        visible = Document.objects.filter(usunieto=False)
+        self._measure_for('all documents', visible, queries)
+        # A reader with explicit grants on a share of the documents, filtered
+        # through PermissionIndex like the search view does.
+        reader = User.objects.create_user('benchmark_search_reader')
+        ids = list(visible.order_by('?').values_list('pk', flat=True)[:max(visible.count() // 10, 1)])
+        DocumentACL.objects.bulk_create([
+            DocumentACL(uzytkownik=reader, dokument_id=pk, uprawnienia=DocumentACL.BROWSE) for pk in ids
+        ], batch_size=5000)
+        self._measure_for(f'reader with {len(ids)} permitted documents',
+                          PermissionIndex(reader).filter_documents(visible), queries)
+
+    def _measure_for(self, label, visible, queries):
+        rng = random.Random(1)
+        timings = []
+        for _ in range(queries):
+            # Query terms follow the corpus distribution, one to three words.
+            query = ' '.join(rng.choices(self.words, cum_weights=self.cum_weights, k=rng.choice((1, 2, 2, 3))))
+            started = time.perf_counter()
+            results = search_documents(query, visible, Document.objects.all())
+            page = list(results[:25])
+            total = results.count()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f'{label}, {queries} queries (first page of 25 + total count): '
+            f'p50={statistics.median(timings) * 1000:.1f} ms p95={p95 * 1000:.1f} ms '
+            f'max={timings[-1] * 1000:.1f} ms (last query: {total} hits, {len(page)} on page)'
+        )
@@ -0,0 +1,105 @@
+import io
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from hashlib import sha256
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.core.management.base import BaseCommand
+from django.http.multipartparser import MultiPartParser
+
+from documents.storage import ContentAddressedStorage
+from documents.uploads import (UPLOAD_CHUNK_SIZE, FingerprintingMemoryFileUploadHandler,
+                               FingerprintingTemporaryFileUploadHandler, upload_digest)
+
+BOUNDARY = 'benchmarkboundary'
+
+
+def _io_counters():
+    """(bytes read, bytes written) by this process so far, from /proc/self/io (Linux)."""
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class Command(BaseCommand):
+    help = ('Compare the old upload path (64 KB chunks, then a 4 KB hashing pass over the spooled file) '
+            'with the fingerprinting handlers and blob storage, for one large upload')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=50)
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--chunk-kb', type=int, default=UPLOAD_CHUNK_SIZE // 1024,
+                            help='Chunk size of the fingerprinting handlers')
+
+    def handle(self, *args, **options):
+        size = options['size_mb'] * 1024 * 1024
+        self.chunk_size = options['chunk_kb'] * 1024
+        body = self._multipart(os.urandom(size))
+        media_root = tempfile.mkdtemp()
+        try:
+            for label, run in (('before', self._old_path), ('after', self._new_path)):
+                cpu, wall, read, written = [], [], [], []
+                for i in range(options['runs']):
+                    # Fresh storage per run: the "after" path must not hit an existing blob.
+                    root = os.path.join(media_root, f'{label}_{i}')
+                    io_before = _io_counters()
+                    cpu_started, wall_started = time.process_time(), time.perf_counter()
+                    run(body, root)
+                    cpu.append(time.process_time() - cpu_started)
+                    wall.append(time.perf_counter() - wall_started)
+                    io_after = _io_counters()
+                    read.append(io_after[0] - io_before[0])
+                    written.append(io_after[1] - io_before[1])
+                    shutil.rmtree(root, ignore_errors=True)
+                self.stdout.write(
+                    f'{label:>6}: cpu {statistics.median(cpu) * 1000:.0f} ms, wall {statistics.median(wall) * 1000:.0f} ms, '
+                    f'read {statistics.median(read) / 2**20:.0f} MB, written {statistics.median(written) / 2**20:.0f} MB '
+                    f'(median of {options["runs"]} x {options["size_mb"]} MB)'
+                )
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+        self.stdout.write(self.style.SUCCESS('✓ Done.'))
+
+    def _multipart(self, data):
+        return b''.join([
+            f'--{BOUNDARY}\r\n'.encode(),
+            b'Content-Disposition: form-data; name="plik"; filename="benchmark.pdf"\r\n',
+            b'Content-Type: application/pdf\r\n\r\n',
+            data,
+            f'\r\n--{BOUNDARY}--\r\n'.encode(),
+        ])
+
+    def _parse(self, body, handlers):
+        meta = {
+            'CONTENT_TYPE': f'multipart/form-data; boundary={BOUNDARY}',
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        _, files = MultiPartParser(meta, io.BytesIO(body), handlers).parse()
+        return files['plik']
+
+    def _old_path(self, body, root):
+        upload = self._parse(body, [MemoryFileUploadHandler(), TemporaryFileUploadHandler()])
+        # What DocumentVersion.save() used to do before handing the file to storage
+        upload.seek(0)
+        file_hash = sha256()
+        for chunk in iter(lambda: upload.read(4096), b''):
+            file_hash.update(chunk)
+        upload.seek(0)
+        FileSystemStorage(location=root).save('document_versions/benchmark.pdf', upload)
+        upload.close()
+
+    def _new_path(self, body, root):
+        handlers = [FingerprintingMemoryFileUploadHandler(), FingerprintingTemporaryFileUploadHandler()]
+        for handler in handlers:
+            handler.chunk_size = self.chunk_size
+        upload = self._parse(body, handlers)
+        upload_digest(upload)
+        ContentAddressedStorage(location=root).save('benchmark.pdf', upload)
+        upload.close()
@@ -0,0 +1,113 @@
+import io
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from django.core.management.base import BaseCommand
+
+from documents.chunked import ChunkedContent, write_chunked
+
+
+def _csv(rows, rng):
+    return ''.join(f'{i};{rng.random():.6f};{rng.choice(["netto", "brutto", "vat"])};{i * 7}\n'
+                   for i in range(rows)).encode()
+
+
+def _edit_lines(data, rng, edits):
+    """A few cells changed and a row inserted, like a spreadsheet saved again."""
+    lines = data.split(b'\n')
+    for _ in range(edits):
+        lines[rng.randrange(len(lines) - 1)] = f'{rng.randrange(10**6)};zmiana;{rng.random():.3f};0'.encode()
+    lines.insert(rng.randrange(len(lines)), b'nowy;wiersz;0;0')
+    return b'\n'.join(lines)
+
+
+def _edit_bytes(data, rng, edits):
+    """A few bytes overwritten and a block inserted, like an uncompressed PDF edited in place."""
+    data = bytearray(data)
+    for _ in range(edits):
+        position = rng.randrange(len(data))
+        data[position:position + 16] = os.urandom(16)
+    position = rng.randrange(len(data))
+    data[position:position] = os.urandom(512)
+    return bytes(data)
+
+
+def _zipped(data):
+    """The same content as an .xlsx would store it: deflated inside a ZIP."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('xl/worksheets/sheet1.xml', data)
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = ('Store a synthetic version history as chunks (documents.chunked) and report the storage ratio, '
+            'the conversion speed and the latency and memory of rebuilding a version')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=40)
+        parser.add_argument('--versions', type=int, default=10)
+        parser.add_argument('--edits', type=int, default=5, help='Changes between two versions')
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        size = options['size_mb'] * 1024 * 1024
+        text = _csv(size // 40, rng)[:size]
+        kinds = (
+            ('text (csv)', text, _edit_lines, False),
+            ('binary', os.urandom(size), _edit_bytes, False),
+            ('zip (xlsx)', text, _edit_lines, True),
+        )
+        for label, data, edit, zipped in kinds:
+            self._run(label, data, edit, zipped, rng, options)
+        self.stdout.write(self.style.SUCCESS('✓ Done.'))
+
+    def _run(self, label, data, edit, zipped, rng, options):
+        root = tempfile.mkdtemp()
+        try:
+            whole = written = 0
+            convert, manifests = [], []
+            for number in range(options['versions']):
+                if number:
+                    data = edit(data, rng, options['edits'])
+                content = _zipped(data) if zipped else data
+                source = os.path.join(root, 'source')
+                with open(source, 'wb') as f:
+                    f.write(content)
+                manifest = os.path.join(root, 'manifests', f'v{number}')
+                started = time.perf_counter()
+                file_size, _, file_written = write_chunked(source, manifest, root)
+                convert.append(file_size / (time.perf_counter() - started))
+                whole += file_size
+                written += file_written
+                manifests.append(manifest)
+
+            first_byte, total, peak = [], [], []
+            for manifest in manifests:
+                tracemalloc.start()
+                started = time.perf_counter()
+                content = ChunkedContent(manifest, root)
+                chunks = iter(content)
+                next(chunks)
+                first_byte.append(time.perf_counter() - started)
+                for _ in chunks:
+                    pass
+                total.append(time.perf_counter() - started)
+                peak.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+            self.stdout.write(
+                f'{label:>11}: {options["versions"]} versions, {whole / 2**20:.0f} MB whole -> '
+                f'{written / 2**20:.1f} MB chunked ({written / whole:.1%}); '
+                f'convert {statistics.median(convert) / 2**20:.0f} MB/s; rebuild first byte '
+                f'{statistics.median(first_byte) * 1000:.1f} ms, whole file {statistics.median(total) * 1000:.0f} ms, '
+                f'peak memory {max(peak) / 2**20:.1f} MB (medians)'
+            )
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
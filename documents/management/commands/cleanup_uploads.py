@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from documents.resumable import cleanup_expired
+
+
+class Command(BaseCommand):
+    help = 'Discard resumable uploads that were abandoned and delete old finished upload sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl-hours',
+            type=float,
+            default=getattr(settings, 'UPLOAD_SESSION_TTL_HOURS', 24),
+            help='Discard sessions idle for at least this long',
+        )
+
+    def handle(self, *args, **options):
+        discarded, deleted = cleanup_expired(timedelta(hours=options['ttl_hours']))
+        self.stdout.write(f'- discarded {discarded} abandoned uploads')
+        self.stdout.write(self.style.SUCCESS(f'✓ Deleted {deleted} finished upload sessions.'))
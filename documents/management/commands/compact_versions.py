@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from documents.chunked import compact_blob, compactable_blobs
+from documents.storage import superseded_versions
+
+
+class Command(BaseCommand):
+    help = ('Store old document versions as deduplicated compressed chunks. The latest version of every '
+            'document stays whole; the replaced files are deleted by gc_blobs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-kb', type=int, default=getattr(settings, 'VERSION_CHUNKING_MIN_KB', 64),
+                            help='Leave smaller files whole')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be converted')
+
+    def handle(self, *args, **options):
+        min_size = options['min_kb'] * 1024
+        if options['dry_run']:
+            names = compactable_blobs(min_size)
+            versions = superseded_versions().filter(plik__in=names)
+            size = versions.aggregate(total=Sum('rozmiar_pliku'))['total'] or 0
+            self.stdout.write(self.style.SUCCESS(
+                f'✓ Would convert {versions.count()} versions ({names.count()} files, {size} bytes).'
+            ))
+            return
+
+        names = list(compactable_blobs(min_size))
+        converted = files = size = written = missing = 0
+        for i, name in enumerate(names, 1):
+            result = compact_blob(name)
+            if result is None:
+                missing += 1
+                self.stdout.write(self.style.WARNING(f'- missing file: {name}'))
+                continue
+            versions, file_size, file_written = result
+            converted += versions
+            if versions:
+                files += 1
+                size += file_size
+                written += file_written
+            if i % 100 == 0:
+                self.stdout.write(f'- {i}/{len(names)} files')
+
+        ratio = f'{written / size:.1%}' if size else '-'
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Converted {converted} versions ({files} files, {size} bytes) into {written} bytes of '
+            f'new chunks and manifests ({ratio}); {missing} files missing. Run gc_blobs to delete the whole files.'
+        ))
@@ -0,0 +1,69 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from documents.models import Document, DocumentVersion
+from documents.storage import BLOB_PREFIX, blob_storage, move_into_store
+
+
+class Command(BaseCommand):
+    help = ('Move document files stored under per-upload paths into the content-addressed '
+            'blob store, keeping one copy of identical content')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deduplicated')
+        parser.add_argument(
+            '--delete-orphans',
+            action='store_true',
+            help='Also delete files under documents/ and document_versions/ that no row references',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        names = set()
+        for model in (Document, DocumentVersion):
+            names.update(model.objects.exclude(plik='').exclude(plik__isnull=True)
+                         .exclude(plik__startswith=BLOB_PREFIX).values_list('plik', flat=True).distinct())
+
+        moved = missing = 0
+        total_bytes = stored_bytes = 0
+        seen = set()
+        for index, name in enumerate(sorted(names), 1):
+            result = move_into_store(name, dry_run=dry_run)
+            if result is None:
+                missing += 1
+                self.stdout.write(self.style.WARNING(f'- missing file: {name}'))
+                continue
+            target, size, stored = result
+            moved += 1
+            total_bytes += size
+            if stored and target not in seen:
+                stored_bytes += size
+            seen.add(target)
+            if index % 500 == 0:
+                self.stdout.write(f'- {index}/{len(names)} files')
+
+        orphans = orphan_bytes = 0
+        for top in ('documents', 'document_versions'):
+            root = blob_storage.path(top)
+            for directory, _, files in os.walk(root):
+                for filename in files:
+                    path = os.path.join(directory, filename)
+                    name = os.path.relpath(path, blob_storage.location).replace(os.sep, '/')
+                    if name in names:
+                        continue
+                    orphans += 1
+                    orphan_bytes += os.path.getsize(path)
+                    if options['delete_orphans'] and not dry_run:
+                        os.remove(path)
+
+        verb = 'Would move' if dry_run else 'Moved'
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ {verb} {moved} files ({total_bytes} bytes) into {len(seen)} blobs; '
+            f'{total_bytes - stored_bytes} bytes of duplicates {"to free" if dry_run else "freed"}.'
+        ))
+        if missing:
+            self.stdout.write(self.style.WARNING(f'{missing} referenced files are missing from MEDIA_ROOT.'))
+        if orphans:
+            action = 'deleted' if options['delete_orphans'] and not dry_run else 'found (use --delete-orphans)'
+            self.stdout.write(f'{orphans} unreferenced files ({orphan_bytes} bytes) {action}.')
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from documents.extraction import STATUS_ERROR, STATUS_LIMIT, STATUS_OK, extract_versions
+from documents.models import DocumentVersion
+
+
+class Command(BaseCommand):
+    help = ('Extract text from document versions for the search index. '
+            'Versions that already have text are skipped, so an interrupted run resumes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'TEXT_EXTRACTION_WORKERS', 2))
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Versions handed to the worker pool at a time')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also redo versions whose extraction failed or hit a limit')
+        parser.add_argument('--force', action='store_true', help='Redo every version')
+
+    def handle(self, *args, **options):
+        # Versions stored as chunks keep the text extracted while they were whole
+        versions = (DocumentVersion.objects.exclude(plik='').exclude(plik__isnull=True)
+                    .filter(sposob_przechowywania=DocumentVersion.STORAGE_WHOLE).order_by('pk'))
+        if options['retry_failed']:
+            versions = versions.filter(Q(tekst__isnull=True) | Q(tekst__status__in=[STATUS_ERROR, STATUS_LIMIT]))
+        elif not options['force']:
+            versions = versions.filter(tekst__isnull=True)
+
+        total = versions.count()
+        if not total:
+            self.stdout.write(self.style.SUCCESS('✓ Nothing to extract.'))
+            return
+        self.stdout.write(f'Extracting text from {total} versions with {options["workers"]} workers...')
+
+        counts = {'done': 0, 'ok': 0}
+
+        def on_result(version_id, result):
+            counts['done'] += 1
+            counts['ok'] += result[0] == STATUS_OK
+            if counts['done'] % options['batch_size'] == 0 or counts['done'] == total:
+                self.stdout.write(f'- {counts["done"]}/{total} versions, {counts["ok"]} with text')
+
+        # Keyset over pk rather than OFFSET: finished versions drop out of the
+        # default filter as we go, and --force must not revisit them.
+        last_pk = 0
+        while True:
+            batch = list(versions.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            extract_versions(batch, workers=options['workers'], on_result=on_result)
+            last_pk = batch[-1].pk
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Processed {counts["done"]} versions, {counts["ok"]} with text.'
+        ))
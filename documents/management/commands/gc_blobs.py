@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from documents.chunked import collect_chunk_garbage
+from documents.storage import collect_garbage, recount_blob_references
+
+
+class Command(BaseCommand):
+    help = ('Delete content-addressed blobs that no Document or DocumentVersion references any more, '
+            'and the version chunks no manifest lists')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-hours',
+            type=float,
+            default=getattr(settings, 'BLOB_GC_GRACE_HOURS', 24),
+            help='Only delete blobs unreferenced for at least this long',
+        )
+        parser.add_argument('--recount', action='store_true',
+                            help='Recompute reference counts from the document tables first')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            fixed = recount_blob_references()
+            self.stdout.write(f'- corrected {fixed} reference counts')
+
+        grace = timedelta(hours=options['grace_hours'])
+        removed, freed = collect_garbage(grace, dry_run=options['dry_run'])
+        # After the blobs: chunks only listed by manifests deleted above go too
+        chunks, chunk_bytes = collect_chunk_garbage(grace, dry_run=options['dry_run'])
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ {verb} {removed} blobs ({freed} bytes) and {chunks} chunks ({chunk_bytes} bytes).'
+        ))
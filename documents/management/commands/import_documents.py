@@ -0,0 +1,65 @@
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import importer
+from documents.models import Folder
+from documents.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = ('Import a directory tree as folders and documents, hashing files in parallel and inserting them in '
+            'batches. Resumable: run it again with the same manifest to skip what is already imported.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--owner', required=True, help='Username owning the imported folders and documents')
+        parser.add_argument('--folder', type=int, help='Id of the folder to import into (default: top level)')
+        parser.add_argument('--manifest', help='Manifest of imported files (default: <directory>.import.jsonl)')
+        parser.add_argument('--workers', type=int, default=None, help='Hashing processes (default: one per CPU)')
+        parser.add_argument('--batch-size', type=int, default=importer.IMPORT_BATCH_SIZE,
+                            help='Files inserted per transaction')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f'{directory} is not a directory.')
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError(f'User {options["owner"]} does not exist.')
+        parent = None
+        if options['folder'] is not None:
+            parent = Folder.objects.filter(pk=options['folder']).first()
+            if parent is None:
+                raise CommandError(f'Folder {options["folder"]} does not exist.')
+        manifest = options['manifest'] or importer.default_manifest_path(directory)
+
+        done = importer.read_manifest(manifest)
+        files, skipped = importer.scan(directory, owner, parent, done)
+        for relative_path in skipped:
+            self.stdout.write(self.style.WARNING(f'- unsupported file: {relative_path}'))
+        self.stdout.write(f'{len(files)} files to import, {len(done)} already imported ({manifest}).')
+
+        started = time.perf_counter()
+
+        def progress(count, size):
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            self.stdout.write(f'- {count}/{len(files)} files, {count / elapsed:.0f} files/s, '
+                              f'{size / 2**20 / elapsed:.1f} MB/s')
+
+        imported, size, failed = importer.import_files(
+            files, owner, blob_storage.path(''), manifest,
+            workers=options['workers'], batch_size=options['batch_size'], progress=progress,
+        )
+        for relative_path, error in failed:
+            self.stdout.write(self.style.WARNING(f'- unreadable file: {relative_path} ({error})'))
+
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Imported {imported} files ({size} bytes) in {elapsed:.1f} s: {imported / elapsed:.0f} files/s, '
+            f'{size / 2**20 / elapsed:.1f} MB/s; {len(failed)} unreadable, {len(skipped)} unsupported. '
+            f'Run extract_text to make their content searchable.'
+        ))
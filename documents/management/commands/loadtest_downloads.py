@@ -0,0 +1,125 @@
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.utils.module_loading import import_string
+
+from documents.models import Document
+from documents.storage import blob_name
+
+BACKENDS = {
+    'file': 'documents.delivery.FileResponseBackend',
+    'x-accel': 'documents.delivery.XAccelRedirectBackend',
+    'x-sendfile': 'documents.delivery.XSendfileBackend',
+}
+READ_SIZE = 256 * 1024
+
+
+def _send_file(sock, path):
+    """What the WSGI server (wsgi.file_wrapper) or the front proxy does with a file: sendfile it."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            offset += os.sendfile(sock.fileno(), f.fileno(), offset, size - offset)
+
+
+def _percentile(values, p):
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1] if len(values) > 1 else values[0]
+
+
+class Command(BaseCommand):
+    help = ('Download one large file with many concurrent, bandwidth-limited clients through each '
+            'delivery backend (documents.delivery) and report how long the worker pool is occupied')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--size-mb', type=int, default=50)
+        parser.add_argument('--workers', type=int, default=8, help='WSGI workers serving requests')
+        parser.add_argument('--client-mb-per-s', type=float, default=20.0, help='Bandwidth of each client')
+        parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                            help='Backend to test (repeatable); all by default')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            name = blob_name('0' * 64, 'loadtest.bin')
+            path = os.path.join(media_root, name)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                for _ in range(options['size_mb']):
+                    f.write(os.urandom(1024 * 1024))
+            file = Document(plik=name).plik
+
+            self.stdout.write(
+                f'{options["clients"]} clients x {options["size_mb"]} MB at {options["client_mb_per_s"]:g} MB/s each, '
+                f'{options["workers"]} workers'
+            )
+            for label in options['backend'] or sorted(BACKENDS):
+                self._run(label, import_string(BACKENDS[label])(), file, options)
+        self.stdout.write(self.style.SUCCESS('✓ Done.'))
+
+    def _run(self, label, backend, file, options):
+        rate = options['client_mb_per_s'] * 1024 * 1024
+        occupancy, waited, finished = [], [], []
+        lock = threading.Lock()
+        proxy = ThreadPoolExecutor(max_workers=options['clients'])  # nginx: transfers off the workers
+        download = RequestFactory().get('/')
+        started = time.perf_counter()
+
+        def client(sock):
+            received = 0
+            with sock:
+                while True:
+                    data = sock.recv(READ_SIZE)
+                    if not data:
+                        break
+                    if not received:
+                        client_started = time.perf_counter()  # The link is idle until the first byte
+                    received += len(data)
+                    ahead = received / rate - (time.perf_counter() - client_started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            with lock:
+                finished.append(time.perf_counter() - started)
+
+        def request(server_side, submitted):
+            busy_from = time.perf_counter()
+            response = backend.serve(download, file, 'loadtest.bin')
+            offloaded = response.get('X-Accel-Redirect') or response.get('X-Sendfile')
+            if offloaded:
+                proxy.submit(self._proxy_transfer, server_side, file.path)
+            else:
+                with server_side:
+                    _send_file(server_side, response.file_to_stream.name)
+                response.close()
+            busy_until = time.perf_counter()
+            with lock:
+                occupancy.append(busy_until - busy_from)
+                waited.append(busy_from - submitted)
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as workers:
+            for _ in range(options['clients']):
+                # The connection exists before a worker picks the request up
+                server_side, client_side = socket.socketpair()
+                threading.Thread(target=client, args=(client_side,), daemon=True).start()
+                workers.submit(request, server_side, time.perf_counter())
+        proxy.shutdown(wait=True)
+        while len(finished) < options['clients']:
+            time.sleep(0.01)
+
+        self.stdout.write(
+            f'{label:>10}: worker busy {sum(occupancy):.1f} s total, '
+            f'{statistics.mean(occupancy) * 1000:.0f} ms per download (p95 {_percentile(occupancy, 95) * 1000:.0f} ms); '
+            f'wait for a worker p95 {_percentile(waited, 95):.2f} s; '
+            f'all downloads done in {max(finished):.1f} s'
+        )
+
+    def _proxy_transfer(self, sock, path):
+        with sock:
+            _send_file(sock, path)
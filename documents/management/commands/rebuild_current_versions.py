@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+from documents.versions import inconsistent_documents, repair_current_version
+
+
+class Command(BaseCommand):
+    help = ('Check and repair the current version pointer (aktualna_wersja) of documents and the file fields '
+            'copied from it')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report inconsistent documents, do not modify anything',
+        )
+
+    def handle(self, *args, **options):
+        broken = list(inconsistent_documents().values_list('pk', 'nazwa', 'aktualna_wersja', 'najnowsza'))
+        for pk, name, pointer, latest in broken:
+            self.stdout.write(f'- Document {pk} ({name}): version {pointer} -> {latest}')
+
+        self.stdout.write(f'Checked {Document.objects.count()} documents, {len(broken)} inconsistent.')
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('✓ Current versions are consistent.'))
+            return
+        if options['check']:
+            self.stdout.write(self.style.ERROR('Current versions are inconsistent, run without --check to repair.'))
+            return
+
+        for pk, *_ in broken:
+            repair_current_version(pk)
+        self.stdout.write(self.style.SUCCESS(f'✓ Repaired {len(broken)} documents.'))
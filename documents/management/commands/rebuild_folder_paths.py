@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.models import Folder
+from documents.tree import compute_folder_paths
+
+
+class Command(BaseCommand):
+    help = 'Check and repair the materialized path index (sciezka, sciezka_nazw, poziom) on folders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report inconsistent folders, do not modify anything',
+        )
+
+    def handle(self, *args, **options):
+        folders = list(Folder.objects.only('id', 'rodzic_id', 'nazwa', 'sciezka', 'sciezka_nazw', 'poziom'))
+        expected = compute_folder_paths(folders)
+
+        broken = []
+        for folder in folders:
+            if (folder.sciezka, folder.sciezka_nazw, folder.poziom) != expected[folder.pk]:
+                broken.append(folder)
+                self.stdout.write(f'- Folder {folder.pk} ({folder.nazwa}): "{folder.sciezka}" -> "{expected[folder.pk][0]}"')
+
+        self.stdout.write(f'Checked {len(folders)} folders, {len(broken)} inconsistent.')
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('✓ Folder path index is consistent.'))
+            return
+        if options['check']:
+            self.stdout.write(self.style.ERROR('Folder path index is inconsistent, run without --check to repair.'))
+            return
+
+        for folder in broken:
+            folder.sciezka, folder.sciezka_nazw, folder.poziom = expected[folder.pk]
+        with transaction.atomic():
+            Folder.objects.bulk_update(broken, ['sciezka', 'sciezka_nazw', 'poziom'], batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f'✓ Repaired {len(broken)} folders.'))
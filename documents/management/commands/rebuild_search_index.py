@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.search import get_search_backend, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for all documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if get_search_backend() is None:
+            self.stdout.write(self.style.WARNING('This database has no full-text index, search uses icontains.'))
+            return
+
+        def progress(done):
+            self.stdout.write(f'- {done} documents indexed')
+
+        with transaction.atomic():
+            total = rebuild_index(batch_size=options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'✓ Indexed {total} documents.'))
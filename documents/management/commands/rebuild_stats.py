@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the precomputed folder and user statistics (FolderStats, UserStats) from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report missing or wrong rows, do not modify anything',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            results = rebuild_stats(dry_run=options['check'])
+        out_of_sync = 0
+        for table, (missing, wrong) in results.items():
+            out_of_sync += missing + wrong
+            self.stdout.write(f'- {table}: {missing} missing, {wrong} wrong')
+
+        if not out_of_sync:
+            self.stdout.write(self.style.SUCCESS('✓ Statistics are up to date.'))
+        elif options['check']:
+            self.stdout.write(self.style.ERROR('Statistics are out of date, run without --check to repair.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✓ Repaired {out_of_sync} statistics rows.'))
@@ -0,0 +1,41 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from documents.activity import rollup_activity_day
+
+
+class Command(BaseCommand):
+    help = 'Recompute daily ActivityLog rollups (counts by user, action and document)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=2,
+            help='Number of days to recompute, ending today (default: yesterday and today)',
+        )
+        parser.add_argument(
+            '--since',
+            help='Recompute every day from this date (YYYY-MM-DD) until today; overrides --days',
+        )
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if options['since']:
+            try:
+                first = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid --since date: {options['since']}")
+        else:
+            first = today - timedelta(days=max(options['days'], 1) - 1)
+
+        day = first
+        total = 0
+        while day <= today:
+            rows = rollup_activity_day(day)
+            total += rows
+            self.stdout.write(f'- {day}: {rows} rollup rows')
+            day += timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f'✓ Rolled up {(today - first).days + 1} days ({total} rows).'))
@@ -0,0 +1,71 @@
+import os
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import tiering
+from documents.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = ('Compress with zstd the old document versions nobody has downloaded for a while. The latest '
+            'version of every document stays as it is; the replaced files are deleted by gc_blobs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'COLD_STORAGE_AFTER_DAYS', 180),
+                            help='Only versions not downloaded for this many days')
+        parser.add_argument('--min-kb', type=int, default=16, help='Leave smaller files as they are')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the expected savings, estimated from a sample of each file')
+
+    def handle(self, *args, **options):
+        if tiering.zstandard is None:
+            raise CommandError('zstandard is not installed.')
+        names = list(tiering.cold_candidates(options['days'], options['min_kb'] * 1024))
+        if options['dry_run']:
+            self._estimate(names)
+            return
+
+        versions = files = size = compressed = skipped = 0
+        for i, name in enumerate(names, 1):
+            result = tiering.tier_blob(name)
+            if result is None:
+                skipped += 1
+            else:
+                file_versions, file_size, file_compressed = result
+                if file_versions:
+                    versions += file_versions
+                    files += 1
+                    size += file_size
+                    compressed += file_compressed
+            if i % 100 == 0:
+                self.stdout.write(f'- {i}/{len(names)} files')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Compressed {versions} versions ({files} files): {size} -> {compressed} bytes, '
+            f'{skipped} files left as they are. Run gc_blobs to delete the originals.'
+        ))
+
+    def _estimate(self, names):
+        totals = defaultdict(lambda: [0, 0, 0])
+        missing = 0
+        for name in names:
+            if not os.path.isfile(blob_storage.path(name)):
+                missing += 1
+                continue
+            size, compressed = tiering.estimate_saving(name)
+            if compressed > size * tiering.COLD_STORAGE_MIN_SAVING:
+                compressed = size  # Would stay as it is
+            row = totals[os.path.splitext(name)[1].lstrip('.') or '-']
+            row[0] += 1
+            row[1] += size
+            row[2] += compressed
+        for extension, (count, size, compressed) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            self.stdout.write(f'- {extension}: {count} files, {size} -> ~{compressed} bytes')
+        size = sum(row[1] for row in totals.values())
+        saving = size - sum(row[2] for row in totals.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Would compress {len(names) - missing} files ({size} bytes), saving ~{saving} bytes; '
+            f'{missing} files missing.'
+        ))
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from documents.extraction import create_pool
+from documents.models import Document
+from documents.previews import (can_render, enforce_quota, file_extension, missing_thumbnails, record_rendered,
+                                render_thumbnails)
+from documents.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = ("Render missing thumbnails of documents' current files, in parallel, "
+            "then trim the preview cache to its quota")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'TEXT_EXTRACTION_WORKERS', 2))
+        parser.add_argument('--limit', type=int, help='Warm at most this many files, newest documents first')
+
+    def handle(self, *args, **options):
+        # One render per distinct content, newest documents first: they are the likeliest to be viewed
+        rows = (Document.objects.filter(usunieto=False).exclude(hash_pliku='')
+                .order_by('-ostatnia_modyfikacja').values_list('plik', 'hash_pliku'))
+        jobs, seen = [], set()
+        for name, digest in rows.iterator(chunk_size=2000):
+            if digest in seen or not name or not can_render(file_extension(name)):
+                continue
+            seen.add(digest)
+            targets = missing_thumbnails(digest)
+            if targets:
+                jobs.append((blob_storage.path(name), file_extension(name), targets))
+            if options['limit'] and len(jobs) >= options['limit']:
+                break
+
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS('✓ All previews are cached.'))
+            return
+        self.stdout.write(f'Rendering previews of {len(jobs)} files with {options["workers"]} workers...')
+
+        rendered = failed = 0
+        with create_pool(options['workers']) as pool:
+            futures = [pool.submit(render_thumbnails, *job) for job in jobs]
+            for index, future in enumerate(futures, 1):
+                try:
+                    record_rendered(future.result())
+                    rendered += 1
+                except Exception as exc:
+                    failed += 1
+                    self.stdout.write(self.style.WARNING(f'- {jobs[index - 1][0]}: {exc}'))
+                if index % 100 == 0:
+                    self.stdout.write(f'- {index}/{len(jobs)} files')
+
+        removed, freed = enforce_quota()
+        if removed:
+            self.stdout.write(f'- evicted {removed} cached previews ({freed} bytes) over the quota')
+        self.stdout.write(self.style.SUCCESS(f'✓ Rendered previews of {rendered} files, {failed} failed.'))
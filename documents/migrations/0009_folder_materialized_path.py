@@ -0,0 +1,54 @@
+# Generated by Django 5.2.3 on 2026-10-17 20:38
+
+from django.db import migrations, models
+
+
+def backfill_folder_paths(apps, schema_editor):
+    Folder = apps.get_model('documents', 'Folder')
+    rows = {f.pk: f for f in Folder.objects.only('id', 'rodzic_id', 'nazwa')}
+    paths = {}
+
+    def resolve(folder):
+        # Iterative walk up to the first folder with a known path
+        chain = []
+        while folder is not None and folder.pk not in paths:
+            chain.append(folder)
+            folder = rows.get(folder.rodzic_id)
+        for item in reversed(chain):
+            parent = paths.get(item.rodzic_id)
+            if parent:
+                paths[item.pk] = (f"{parent[0]}{item.pk}/", f"{parent[1]} / {item.nazwa}")
+            else:
+                paths[item.pk] = (f"/{item.pk}/", item.nazwa)
+
+    for folder in rows.values():
+        resolve(folder)
+        folder.sciezka, folder.sciezka_nazw = paths[folder.pk]
+        folder.poziom = folder.sciezka.count('/') - 2
+    Folder.objects.bulk_update(rows.values(), ['sciezka', 'sciezka_nazw', 'poziom'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_documentversion_oryginalna_nazwa_pliku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='poziom',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='sciezka',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='sciezka_nazw',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill_folder_paths, migrations.RunPython.noop),
+    ]
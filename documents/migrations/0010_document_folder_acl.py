@@ -0,0 +1,87 @@
+# Generated by Django 5.2.3 on 2026-10-17 20:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+ACL_BITS = {
+    'document': ('DocumentACL', 'dokument_id', {
+        'browse_document': 1, 'change_document': 2, 'delete_document': 4,
+        'share_document': 8, 'download_document': 16, 'comment_document': 32,
+    }),
+    'folder': ('FolderACL', 'folder_id', {
+        'browse_folder': 1, 'change_folder': 2, 'delete_folder': 4,
+        'add_document_to_folder': 8, 'add_subfolder_to_folder': 16,
+    }),
+}
+
+
+def backfill_acl(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    UserObjectPermission = apps.get_model('guardian', 'UserObjectPermission')
+
+    for model_name, (acl_name, field, bits) in ACL_BITS.items():
+        content_type = ContentType.objects.filter(app_label='documents', model=model_name).first()
+        if content_type is None:
+            continue
+        model = apps.get_model('documents', model_name)
+        acl_model = apps.get_model('documents', acl_name)
+        masks = {}
+        rows = UserObjectPermission.objects.filter(
+            content_type=content_type, permission__codename__in=list(bits),
+        ).values_list('user_id', 'object_pk', 'permission__codename')
+        for user_id, object_pk, codename in rows.iterator():
+            key = (user_id, int(object_pk))
+            masks[key] = masks.get(key, 0) | bits[codename]
+        existing = set(model.objects.values_list('pk', flat=True))
+        acl_model.objects.bulk_create([
+            acl_model(uzytkownik_id=user_id, uprawnienia=mask, **{field: object_id})
+            for (user_id, object_id), mask in masks.items() if object_id in existing
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_folder_materialized_path'),
+        ('guardian', '0002_generic_permissions_index'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentACL',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uprawnienia', models.PositiveIntegerField(default=0)),
+                ('dokument', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='acl', to='documents.document')),
+                ('uzytkownik', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='document_acl', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Uprawnienia do dokumentu',
+                'verbose_name_plural': 'Uprawnienia do dokumentów',
+                'db_table': 'dokument_acl',
+                'indexes': [models.Index(fields=['dokument', 'uzytkownik'], name='dokument_acl_dok_uzyt_idx')],
+                'unique_together': {('uzytkownik', 'dokument')},
+            },
+        ),
+        migrations.CreateModel(
+            name='FolderACL',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uprawnienia', models.PositiveIntegerField(default=0)),
+                ('folder', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='acl', to='documents.folder')),
+                ('uzytkownik', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='folder_acl', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Uprawnienia do folderu',
+                'verbose_name_plural': 'Uprawnienia do folderów',
+                'db_table': 'folder_acl',
+                'indexes': [models.Index(fields=['folder', 'uzytkownik'], name='folder_acl_folder_uzyt_idx')],
+                'unique_together': {('uzytkownik', 'folder')},
+            },
+        ),
+        migrations.RunPython(backfill_acl, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-17 20:50
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_document_folder_acl'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activitylog',
+            name='znacznik_czasu',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.3 on 2026-10-17 20:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_activitylog_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField()),
+                ('typ_aktywnosci', models.CharField(choices=[('logowanie', 'Logowanie'), ('tworzenie', 'Tworzenie'), ('edycja', 'Edycja'), ('usuniecie', 'Usunięcie'), ('pobieranie', 'Pobieranie'), ('udostepnianie', 'Udostępnianie'), ('komentowanie', 'Komentowanie'), ('zmiana_uprawnien', 'Zmiana uprawnień'), ('zmiana_hasla', 'Zmiana hasła')], max_length=50)),
+                ('liczba', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Dzienne podsumowanie aktywności',
+                'verbose_name_plural': 'Dzienne podsumowania aktywności',
+                'db_table': 'log_aktywnosci_dzienne',
+                'ordering': ['-data'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='activitylog',
+            index=models.Index(fields=['znacznik_czasu'], name='log_akt_czas_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activitylog',
+            index=models.Index(fields=['uzytkownik', 'znacznik_czasu'], name='log_akt_uzyt_czas_idx'),
+        ),
+        migrations.AddField(
+            model_name='activitydailyrollup',
+            name='dokument',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='documents.document'),
+        ),
+        migrations.AddField(
+            model_name='activitydailyrollup',
+            name='uzytkownik',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dzienne_podsumowania_aktywnosci', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='activitydailyrollup',
+            index=models.Index(fields=['data', 'typ_aktywnosci'], name='log_dzien_data_typ_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activitydailyrollup',
+            index=models.Index(fields=['uzytkownik', 'data'], name='log_dzien_uzyt_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activitydailyrollup',
+            index=models.Index(fields=['dokument', 'data'], name='log_dzien_dok_data_idx'),
+        ),
+    ]
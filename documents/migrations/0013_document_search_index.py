@@ -0,0 +1,62 @@
+from django.db import migrations
+
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS dokument_fts "
+    "USING fts5(nazwa, opis, tagi, metadane, tresc, tokenize='unicode61')"
+)
+SQLITE_DROP = 'DROP TABLE IF EXISTS dokument_fts'
+
+POSTGRES_CREATE = [
+    'CREATE TABLE IF NOT EXISTS dokument_search ('
+    ' dokument_id bigint PRIMARY KEY REFERENCES dokument (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,'
+    ' wektor tsvector NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS dokument_search_wektor_idx ON dokument_search USING GIN (wektor)',
+]
+POSTGRES_DROP = ['DROP TABLE IF EXISTS dokument_search']
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+    elif vendor == 'postgresql':
+        for statement in POSTGRES_CREATE:
+            schema_editor.execute(statement)
+    else:
+        return
+
+    # Index existing documents by name, description, tags and metadata;
+    # file contents are picked up by `manage.py rebuild_search_index`.
+    from documents.search import get_search_backend, analyzed
+
+    backend = get_search_backend()
+    Document = apps.get_model('documents', 'Document')
+    for document in Document.objects.prefetch_related('tagi', 'metadane').iterator(chunk_size=500):
+        backend.index(document.pk, (
+            analyzed(document.nazwa),
+            analyzed(document.opis),
+            analyzed(' '.join(tag.nazwa for tag in document.tagi.all())),
+            analyzed(' '.join(f'{item.klucz} {item.wartosc}' for item in document.metadane.all())),
+            '',
+        ))
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_DROP)
+    elif vendor == 'postgresql':
+        for statement in POSTGRES_DROP:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0012_activitylog_indexes_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-17 21:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0013_document_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentVersionText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tekst', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('ok', 'Wyodrębniono'), ('pusty', 'Brak tekstu'), ('nieobslugiwany', 'Nieobsługiwany format'), ('limit', 'Przekroczony limit czasu lub pamięci'), ('blad', 'Błąd')], max_length=20)),
+                ('komunikat', models.CharField(blank=True, max_length=255)),
+                ('czas_ms', models.PositiveIntegerField(default=0)),
+                ('data_ekstrakcji', models.DateTimeField(auto_now=True)),
+                ('wersja', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tekst', to='documents.documentversion')),
+            ],
+            options={
+                'verbose_name': 'Tekst wersji',
+                'verbose_name_plural': 'Teksty wersji',
+                'db_table': 'tekst_wersji',
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-17 21:35
+
+import django.core.validators
+import django.utils.timezone
+import documents.models
+import documents.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0014_document_version_text'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='plik',
+            field=models.FileField(blank=True, help_text='Obsługiwane formaty: PDF, DOCX, DOC, XLSX, XLS, TXT, PNG, JPG, JPEG', null=True, storage=documents.storage.get_blob_storage, upload_to=documents.models.document_upload_path, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'docx', 'doc', 'xlsx', 'xls', 'txt', 'png', 'jpg', 'jpeg'])]),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='plik',
+            field=models.FileField(blank=True, null=True, storage=documents.storage.get_blob_storage, upload_to='document_versions/%Y/%m/%d/'),
+        ),
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sciezka', models.CharField(max_length=255, unique=True)),
+                ('hash_pliku', models.CharField(db_index=True, max_length=64)),
+                ('rozmiar', models.BigIntegerField(default=0)),
+                ('liczba_odwolan', models.PositiveIntegerField(default=0)),
+                ('data_utworzenia', models.DateTimeField(auto_now_add=True)),
+                ('ostatnia_zmiana', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Blob',
+                'verbose_name_plural': 'Bloby',
+                'db_table': 'blob',
+                'indexes': [models.Index(fields=['liczba_odwolan', 'ostatnia_zmiana'], name='blob_odwolania_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 21:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_content_addressed_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='typ_mime',
+            field=models.CharField(blank=True, help_text='MIME type sniffed from the file content', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='typ_mime',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
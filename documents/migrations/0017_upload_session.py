@@ -0,0 +1,41 @@
+# Generated by Django 5.2.3 on 2026-10-17 21:45
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0016_upload_mime_type'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('nazwa_pliku', models.CharField(max_length=255)),
+                ('rozmiar', models.BigIntegerField()),
+                ('przeslano', models.BigIntegerField(default=0)),
+                ('nazwa', models.CharField(blank=True, max_length=255)),
+                ('opis', models.TextField(blank=True)),
+                ('komentarz', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('aktywna', 'W toku'), ('zakonczona', 'Zakończona'), ('anulowana', 'Anulowana')], default='aktywna', max_length=20)),
+                ('data_utworzenia', models.DateTimeField(auto_now_add=True)),
+                ('ostatnia_aktywnosc', models.DateTimeField(auto_now=True)),
+                ('dokument', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sesje_przesylania', to='documents.document')),
+                ('folder', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='documents.folder')),
+                ('uzytkownik', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sesje_przesylania', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Sesja przesyłania',
+                'verbose_name_plural': 'Sesje przesyłania',
+                'db_table': 'sesja_przesylania',
+                'indexes': [models.Index(fields=['status', 'ostatnia_aktywnosc'], name='sesja_przes_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0017_upload_session'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['folder', 'usunieto', 'nazwa', 'id'], name='dokument_folder_nazwa_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['rodzic', 'nazwa', 'id'], name='folder_rodzic_nazwa_idx'),
+        ),
+    ]
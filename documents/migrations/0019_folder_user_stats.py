@@ -0,0 +1,78 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def backfill_stats(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Folder = apps.get_model('documents', 'Folder')
+    FolderStats = apps.get_model('documents', 'FolderStats')
+    UserStats = apps.get_model('documents', 'UserStats')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+
+    documents = Document.objects.filter(usunieto=False).order_by()
+    paths = {pk: [int(part) for part in sciezka.strip('/').split('/') if part] or [pk]
+             for pk, sciezka in Folder.objects.values_list('pk', 'sciezka')}
+    folders = {pk: FolderStats(folder_id=pk) for pk in paths}
+    for parent_id, count in Folder.objects.filter(rodzic__isnull=False).order_by().values_list('rodzic').annotate(Count('pk')):
+        folders[parent_id].liczba_podfolderow = count
+    rows = documents.filter(folder__isnull=False).values_list('folder').annotate(Count('pk'), Sum('rozmiar_pliku'), Max('ostatnia_modyfikacja'))
+    for folder_id, count, size, changed in rows:
+        folders[folder_id].liczba_dokumentow = count
+        for pk in paths[folder_id]:
+            stats = folders[pk]
+            stats.rozmiar_calkowity += size or 0
+            stats.ostatnia_aktywnosc = max(stats.ostatnia_aktywnosc or changed, changed)
+    FolderStats.objects.bulk_create(folders.values(), batch_size=500)
+
+    users = {pk: UserStats(uzytkownik_id=pk) for pk in User.objects.values_list('pk', flat=True)}
+    for owner_id, count, size, changed in documents.values_list('wlasciciel').annotate(Count('pk'), Sum('rozmiar_pliku'), Max('ostatnia_modyfikacja')):
+        users[owner_id].liczba_dokumentow, users[owner_id].rozmiar_calkowity, users[owner_id].ostatnia_aktywnosc = count, size or 0, changed
+    for owner_id, count in Folder.objects.order_by().values_list('wlasciciel').annotate(Count('pk')):
+        users[owner_id].liczba_folderow = count
+    UserStats.objects.bulk_create(users.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('documents', '0018_listing_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderStats',
+            fields=[
+                ('folder', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='statystyki', serialize=False, to='documents.folder')),
+                ('liczba_dokumentow', models.IntegerField(default=0)),
+                ('liczba_podfolderow', models.IntegerField(default=0)),
+                ('rozmiar_calkowity', models.BigIntegerField(default=0)),
+                ('ostatnia_aktywnosc', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Statystyki folderu',
+                'verbose_name_plural': 'Statystyki folderów',
+                'db_table': 'statystyki_folderu',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('uzytkownik', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='statystyki', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('liczba_dokumentow', models.IntegerField(default=0)),
+                ('liczba_folderow', models.IntegerField(default=0)),
+                ('rozmiar_calkowity', models.BigIntegerField(default=0)),
+                ('ostatnia_aktywnosc', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Statystyki użytkownika',
+                'verbose_name_plural': 'Statystyki użytkowników',
+                'db_table': 'statystyki_uzytkownika',
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
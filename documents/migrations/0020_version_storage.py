@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0019_folder_user_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='sposob_przechowywania',
+            field=models.CharField(choices=[('calosc', 'Cały plik'), ('fragmenty', 'Fragmenty')], default='calosc', max_length=20),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:28
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+def backfill_last_access(apps, schema_editor):
+    # The activity log only names the document: every version of a downloaded
+    # document counts as accessed at its last download, which errs on the hot side.
+    ActivityLog = apps.get_model('documents', 'ActivityLog')
+    DocumentVersion = apps.get_model('documents', 'DocumentVersion')
+
+    last_download = (ActivityLog.objects.filter(dokument=OuterRef('dokument'), typ_aktywnosci='pobieranie')
+                     .order_by().values('dokument').annotate(ostatni=Max('znacznik_czasu')).values('ostatni'))
+    DocumentVersion.objects.update(ostatni_dostep=Subquery(last_download))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0020_version_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='ostatni_dostep',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='sposob_przechowywania',
+            field=models.CharField(choices=[('calosc', 'Cały plik'), ('fragmenty', 'Fragmenty'), ('zstd', 'Archiwum (zstd)')], default='calosc', max_length=20),
+        ),
+        migrations.RunPython(backfill_last_access, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:31
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_version_counter(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    DocumentVersion = apps.get_model('documents', 'DocumentVersion')
+
+    highest = (DocumentVersion.objects.filter(dokument=OuterRef('pk')).order_by()
+               .values('dokument').annotate(numer=Max('numer_wersji')).values('numer'))
+    Document.objects.update(licznik_wersji=Coalesce(Subquery(highest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0021_cold_storage_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='licznik_wersji',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_version_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-17 22:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_current_version(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    DocumentVersion = apps.get_model('documents', 'DocumentVersion')
+
+    latest = DocumentVersion.objects.filter(dokument=OuterRef('pk')).order_by('-numer_wersji').values('pk')[:1]
+    Document.objects.update(aktualna_wersja=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0022_document_version_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='aktualna_wersja',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.documentversion'),
+        ),
+        migrations.RunPython(backfill_current_version, migrations.RunPython.noop),
+    ]
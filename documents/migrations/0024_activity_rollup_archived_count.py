@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-17 23:40
+
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+
+def backfill_archived_counts(apps, schema_editor):
+    """Whatever a rollup counts beyond the rows still in ActivityLog was archived."""
+    ActivityDailyRollup = apps.get_model('documents', 'ActivityDailyRollup')
+    ActivityLog = apps.get_model('documents', 'ActivityLog')
+
+    for day in ActivityDailyRollup.objects.order_by('data').values_list('data', flat=True).distinct():
+        start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        end = timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+        live = {
+            (row['uzytkownik_id'], row['typ_aktywnosci'], row['dokument_id']): row['liczba']
+            for row in (ActivityLog.objects.filter(znacznik_czasu__gte=start, znacznik_czasu__lt=end).order_by()
+                        .values('uzytkownik_id', 'typ_aktywnosci', 'dokument_id').annotate(liczba=Count('id')))
+        }
+        changed = []
+        for rollup in ActivityDailyRollup.objects.filter(data=day):
+            archived = rollup.liczba - live.get((rollup.uzytkownik_id, rollup.typ_aktywnosci, rollup.dokument_id), 0)
+            if archived > 0:
+                rollup.liczba_zarchiwizowana = archived
+                changed.append(rollup)
+        ActivityDailyRollup.objects.bulk_update(changed, ['liczba_zarchiwizowana'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0023_document_current_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activitydailyrollup',
+            name='liczba_zarchiwizowana',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_archived_counts, migrations.RunPython.noop),
+    ]
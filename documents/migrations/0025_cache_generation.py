@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-17 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0024_activity_rollup_archived_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheGeneration',
+            fields=[
+                ('klucz', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('wartosc', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Generacja cache',
+                'verbose_name_plural': 'Generacje cache',
+                'db_table': 'generacja_cache',
+            },
+        ),
+    ]
@@ -1,14 +1,21 @@
-from django.db import models
+from django.db import IntegrityError, OperationalError, connection, models, transaction
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_init
 from django.contrib.auth.models import User # Direct import is fine if User is not customized extensively
 from django.core.validators import FileExtensionValidator
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.utils import timezone
 import os
+import time
 import uuid
 # Ensure users.models is loaded or use string references if circular dependency arises
 # For now, direct import is assumed to work based on your project structure.
 from users.models import Role, UserProfile
 
+from .storage import get_blob_storage
+
 
 def document_upload_path(instance, filename):
     ext = filename.split('.')[-1]
@@ -34,8 +41,24 @@ class Tag(models.Model):
         ordering = ['nazwa']
 
 
+# Tries of add_version's numbering transaction when the database stays locked
+VERSION_NUMBER_ATTEMPTS = 3
+
+
+def _apply_upload_digest(instance):
+    """Fill size, hash and MIME type of a newly assigned ``plik`` (see documents.uploads)."""
+    if instance.plik and not instance.plik._committed:
+        from .uploads import upload_digest
+        digest = upload_digest(instance.plik.file)
+        instance.rozmiar_pliku = digest.size
+        instance.hash_pliku = digest.sha256
+        instance.typ_mime = digest.mime
+
+
 class Folder(models.Model):
     """Folder structure for documents"""
+    PATH_SEPARATOR = ' / '
+
     nazwa = models.CharField(max_length=255)
     opis = models.TextField(blank=True)
     data_utworzenia = models.DateTimeField(auto_now_add=True)
@@ -43,17 +66,100 @@ class Folder(models.Model):
     wlasciciel = models.ForeignKey(User, on_delete=models.CASCADE, related_name='folders_owned') # Changed related_name for clarity
     tagi = models.ManyToManyField(Tag, blank=True, verbose_name='Tagi', related_name='folders')
 
+    # Denormalized materialized path, maintained in save():
+    # sciezka holds ancestor ids including self ("/1/5/9/"), sciezka_nazw the display path.
+    sciezka = models.CharField(max_length=1000, blank=True, default='', db_index=True, editable=False)
+    sciezka_nazw = models.TextField(blank=True, default='', editable=False)
+    poziom = models.PositiveIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.nazwa
 
+    def clean(self):
+        super().clean()
+        if self.pk and self.rodzic_id is not None:
+            parent_sciezka = Folder.objects.filter(pk=self.rodzic_id).values_list('sciezka', flat=True).first() or ''
+            if f"/{self.pk}/" in parent_sciezka:
+                raise ValidationError("Folder nie może być przeniesiony do własnego podfolderu.")
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            # Paths are read from the database under lock: the in-memory ones may be stale
+            # after another move, and concurrent moves of the same subtree are serialized.
+            parent_path = None
+            if self.rodzic_id is not None:
+                parent_path = Folder.objects.select_for_update().filter(pk=self.rodzic_id).values_list(
+                    'sciezka', 'sciezka_nazw').get()
+                if self.pk and f"/{self.pk}/" in parent_path[0]:
+                    # clean() reports this to forms and the admin
+                    raise IntegrityError("Folder nie może być przeniesiony do własnego podfolderu.")
+            stored = None
+            if self.pk:
+                stored = Folder.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'sciezka', 'sciezka_nazw').first()
+            if stored:
+                self._set_path(parent_path)
+            super().save(*args, **kwargs)
+            if not stored:
+                self._set_path(parent_path)
+            self._update_path(*(stored or ('', '')))
+
+    def _set_path(self, parent_path):
+        """Compute the materialized path from the parent's ``(sciezka, sciezka_nazw)``, None at the top level."""
+        if parent_path is not None:
+            self.sciezka = f"{parent_path[0]}{self.pk}/"
+            self.sciezka_nazw = f"{parent_path[1]}{self.PATH_SEPARATOR}{self.nazwa}"
+        else:
+            self.sciezka = f"/{self.pk}/"
+            self.sciezka_nazw = self.nazwa
+        self.poziom = self.sciezka.count('/') - 2
+
+    def _update_path(self, old_sciezka, old_sciezka_nazw):
+        """Store the path set by _set_path and, after a move or rename, rewrite the subtree's."""
+        sciezka, sciezka_nazw = self.sciezka, self.sciezka_nazw
+        if sciezka == old_sciezka and sciezka_nazw == old_sciezka_nazw:
+            return
+
+        Folder.objects.filter(pk=self.pk).update(
+            sciezka=self.sciezka, sciezka_nazw=self.sciezka_nazw, poziom=self.poziom
+        )
+
+        if not old_sciezka:
+            return  # Newly created folder, nothing below it yet
+        descendants = list(Folder.objects.select_for_update().filter(sciezka__startswith=old_sciezka)
+                           .exclude(pk=self.pk))
+        for descendant in descendants:
+            descendant.sciezka = sciezka + descendant.sciezka[len(old_sciezka):]
+            descendant.sciezka_nazw = sciezka_nazw + descendant.sciezka_nazw[len(old_sciezka_nazw):]
+            descendant.poziom = descendant.sciezka.count('/') - 2
+        Folder.objects.bulk_update(descendants, ['sciezka', 'sciezka_nazw', 'poziom'], batch_size=500)
+
     def get_full_path(self):
         """Get full folder path"""
+        if self.sciezka_nazw:
+            return self.sciezka_nazw
         path_parts = [self.nazwa]
         parent = self.rodzic
         while parent:
             path_parts.insert(0, parent.nazwa)
             parent = parent.rodzic
-        return ' / '.join(path_parts)
+        return self.PATH_SEPARATOR.join(path_parts)
+
+    def get_ancestor_ids(self):
+        """Ids of all ancestors, root first (without the folder itself)."""
+        return [int(part) for part in self.sciezka.strip('/').split('/') if part][:-1]
+
+    def get_ancestors(self, include_self=False):
+        ids = self.get_ancestor_ids()
+        if include_self:
+            ids.append(self.pk)
+        return Folder.objects.filter(pk__in=ids).order_by('poziom')
+
+    def get_descendants(self, include_self=False):
+        descendants = Folder.objects.filter(sciezka__startswith=self.sciezka)
+        if not include_self:
+            descendants = descendants.exclude(pk=self.pk)
+        return descendants
 
     class Meta:
         db_table = 'folder'
@@ -61,6 +167,10 @@ class Folder(models.Model):
         verbose_name_plural = "Foldery"
         unique_together = ['nazwa', 'rodzic', 'wlasciciel']
         ordering = ['nazwa']
+        indexes = [
+            # Keyset pages of a folder listing (documents.listing)
+            models.Index(fields=['rodzic', 'nazwa', 'id'], name='folder_rodzic_nazwa_idx'),
+        ]
         # Django automatically creates add_folder, change_folder, delete_folder, view_folder
         # We only define permissions that are *additional* to these.
         permissions = (
@@ -91,6 +201,7 @@ class Document(models.Model):
 
     plik = models.FileField(
         upload_to=document_upload_path,
+        storage=get_blob_storage,
         validators=[FileExtensionValidator(allowed_extensions=ALLOWED_EXTENSIONS)],
         help_text="Obsługiwane formaty: PDF, DOCX, DOC, XLSX, XLS, TXT, PNG, JPG, JPEG",
         blank=True,
@@ -109,6 +220,13 @@ class Document(models.Model):
 
     opis = models.TextField(blank=True, help_text="Opcjonalny opis dokumentu")
     hash_pliku = models.CharField(max_length=64, blank=True, help_text="SHA-256 hash for file integrity")
+    typ_mime = models.CharField(max_length=100, blank=True, help_text="MIME type sniffed from the file content")
+    # Last version number handed out by add_version
+    licznik_wersji = models.PositiveIntegerField(default=0)
+    # Latest version; rozmiar_pliku, hash_pliku etc. above are copied from it
+    # (kept by add_first_version/add_version, see check_current_versions)
+    aktualna_wersja = models.ForeignKey('DocumentVersion', on_delete=models.SET_NULL, null=True, blank=True,
+                                        related_name='+')
 
     def __str__(self):
         return self.nazwa
@@ -119,16 +237,92 @@ class Document(models.Model):
             raise ValidationError({"plik": "Plik nie może być większy niż 50MB."})
 
     def save(self, *args, **kwargs):
+        _apply_upload_digest(self)
         super().save(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        if self.plik and hasattr(self.plik, 'path'):
+    CURRENT_FILE_FIELDS = ['plik', 'rozmiar_pliku', 'hash_pliku', 'typ_mime', 'typ_pliku', 'aktualna_wersja',
+                           'ostatnia_modyfikacja']
+
+    def add_first_version(self, user, oryginalna_nazwa_pliku=None, komentarz=''):
+        """Record the document's own file as version 1 and point the document at it."""
+        with transaction.atomic():
+            version = DocumentVersion.objects.create(
+                dokument=self,
+                numer_wersji=1,
+                plik=self.plik,
+                oryginalna_nazwa_pliku=oryginalna_nazwa_pliku or self.plik.name,
+                komentarz=komentarz,
+                rozmiar_pliku=self.rozmiar_pliku,
+                hash_pliku=self.hash_pliku,
+                typ_mime=self.typ_mime,
+                utworzony_przez=user,
+            )
+            self.aktualna_wersja = version
+            self.licznik_wersji = 1
+            # Saved rather than updated: the search index reads the version's text through the pointer
+            self.save(update_fields=['aktualna_wersja', 'licznik_wersji'])
+        return version
+
+    def add_version(self, plik, user, komentarz='', oryginalna_nazwa_pliku=None):
+        """
+        Store ``plik`` as the next version and make it the document's current file.
+
+        The file goes to storage first. The number then comes from
+        licznik_wersji in one UPDATE, which locks the document row until the
+        short transaction creating the version commits: concurrent uploads
+        get consecutive numbers instead of an IntegrityError. The counter
+        never falls behind the highest existing number, so versions created
+        directly (the first one, imports) are taken into account. When the
+        database stays locked past its timeout, that transaction is retried
+        VERSION_NUMBER_ATTEMPTS times.
+        """
+        version = DocumentVersion(
+            dokument=self,
+            plik=plik,
+            oryginalna_nazwa_pliku=oryginalna_nazwa_pliku or plik.name,
+            komentarz=komentarz,
+            utworzony_przez=user,
+        )
+        _apply_upload_digest(version)
+        if not version.plik._committed:
+            version.plik.save(version.plik.name, version.plik.file, save=False)
+
+        for attempt in range(1, VERSION_NUMBER_ATTEMPTS + 1):
             try:
-                if os.path.isfile(self.plik.path):
-                    os.remove(self.plik.path)
-            except (ValueError, OSError, AttributeError): # Added AttributeError
-                pass
-        super().delete(*args, **kwargs)
+                self._number_and_save_version(version)
+                break
+            except OperationalError:
+                # The database stayed busy past its lock timeout (SQLite: many concurrent writers)
+                if attempt == VERSION_NUMBER_ATTEMPTS or connection.in_atomic_block:
+                    raise
+                version.pk, version._state.adding = None, True  # Rolled back
+        # The caller keeps using ``self``. refresh_from_db() does not send
+        # post_init: let the signals remember the new file and statistics.
+        self.refresh_from_db(fields=[*self.CURRENT_FILE_FIELDS, 'licznik_wersji'])
+        post_init.send(sender=Document, instance=self)
+        self.aktualna_wersja = version
+        return version
+
+    def _number_and_save_version(self, version):
+        """Take the next number from licznik_wersji, save ``version`` and make it current, in one transaction."""
+        highest = (DocumentVersion.objects.filter(dokument=OuterRef('pk')).order_by()
+                   .values('dokument').annotate(numer=Max('numer_wersji')).values('numer'))
+        with transaction.atomic():
+            Document.objects.filter(pk=self.pk).update(
+                licznik_wersji=Greatest(F('licznik_wersji'), Coalesce(Subquery(highest), 0)) + 1
+            )
+            # Reloaded under the lock: another upload may have changed the current file meanwhile
+            current = Document.objects.select_for_update().get(pk=self.pk)
+            version.numer_wersji = current.licznik_wersji
+            version.save()
+            # Point the document at the same stored blob
+            current.plik = version.plik.name
+            current.rozmiar_pliku = version.rozmiar_pliku
+            current.hash_pliku = version.hash_pliku
+            current.typ_mime = version.typ_mime
+            current.typ_pliku = os.path.splitext(version.oryginalna_nazwa_pliku)[1].lower().lstrip('.')
+            current.aktualna_wersja = version
+            current.save(update_fields=self.CURRENT_FILE_FIELDS)
 
     def get_file_size_display(self):
         """Return human readable file size"""
@@ -169,7 +363,8 @@ class Document(models.Model):
         return self.typ_pliku in ['png', 'jpg', 'jpeg']
 
     def can_preview(self):
-        return self.plik and self.typ_pliku in ['pdf', 'txt', 'png', 'jpg', 'jpeg']
+        # docx/xlsx are previewed from the text extracted for search (documents.previews)
+        return self.plik and self.typ_pliku in ['pdf', 'txt', 'png', 'jpg', 'jpeg', 'docx', 'xlsx']
 
     @property
     def download_url(self): # This should be handled by reverse in templates
@@ -186,6 +381,10 @@ class Document(models.Model):
         verbose_name = "Dokument"
         verbose_name_plural = "Dokumenty"
         ordering = ['-ostatnia_modyfikacja']
+        indexes = [
+            # Keyset pages of a folder listing (documents.listing)
+            models.Index(fields=['folder', 'usunieto', 'nazwa', 'id'], name='dokument_folder_nazwa_idx'),
+        ]
         # Django automatically creates add_document, change_document, delete_document, view_document
         # We only define permissions that are *additional* to these.
         permissions = (
@@ -199,15 +398,29 @@ class Document(models.Model):
 
 class DocumentVersion(models.Model):
     """Document version control"""
+    # Old versions can be stored as deduplicated chunks (documents.chunked)
+    # or compressed in the cold tier (documents.tiering)
+    STORAGE_WHOLE = 'calosc'
+    STORAGE_CHUNKED = 'fragmenty'
+    STORAGE_COLD = 'zstd'
+    STORAGE_CHOICES = [
+        (STORAGE_WHOLE, 'Cały plik'),
+        (STORAGE_CHUNKED, 'Fragmenty'),
+        (STORAGE_COLD, 'Archiwum (zstd)'),
+    ]
+
     dokument = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='wersje')
     numer_wersji = models.PositiveIntegerField()
     data_utworzenia = models.DateTimeField(auto_now_add=True)
     utworzony_przez = models.ForeignKey(User, on_delete=models.CASCADE)
-    plik = models.FileField(upload_to='document_versions/%Y/%m/%d/', blank=True, null=True)
+    plik = models.FileField(upload_to='document_versions/%Y/%m/%d/', storage=get_blob_storage, blank=True, null=True)
     oryginalna_nazwa_pliku = models.CharField(max_length=255, blank=True)
     komentarz = models.TextField(blank=True)
     rozmiar_pliku = models.PositiveIntegerField(default=0, null=True, blank=True)
     hash_pliku = models.CharField(max_length=64, blank=True)
+    typ_mime = models.CharField(max_length=100, blank=True)
+    sposob_przechowywania = models.CharField(max_length=20, choices=STORAGE_CHOICES, default=STORAGE_WHOLE)
+    ostatni_dostep = models.DateTimeField(null=True, blank=True)  # Last download, see documents.tiering
 
     def __str__(self):
         return f"{self.dokument.nazwa} v{self.numer_wersji}"
@@ -225,17 +438,7 @@ class DocumentVersion(models.Model):
         return f"{size:.1f} PB"
 
     def save(self, *args, **kwargs):
-        if self.plik and hasattr(self.plik, 'size') and not self.rozmiar_pliku:
-            self.rozmiar_pliku = self.plik.size
-
-            if self.plik.file:
-                import hashlib
-                self.plik.seek(0)
-                file_hash = hashlib.sha256()
-                for chunk in iter(lambda: self.plik.read(4096), b""):
-                    file_hash.update(chunk)
-                self.hash_pliku = file_hash.hexdigest()
-                self.plik.seek(0)
+        _apply_upload_digest(self)
         super().save(*args, **kwargs)
 
     class Meta:
@@ -243,6 +446,131 @@ class DocumentVersion(models.Model):
         unique_together = ['dokument', 'numer_wersji']
         ordering = ['-numer_wersji']
 
+class DocumentVersionText(models.Model):
+    """Normalized text extracted from a version's file (see documents.extraction)."""
+    STATUS_OK = 'ok'
+    STATUS_EMPTY = 'pusty'
+    STATUS_UNSUPPORTED = 'nieobslugiwany'
+    STATUS_LIMIT = 'limit'
+    STATUS_ERROR = 'blad'
+    STATUS_CHOICES = [
+        (STATUS_OK, 'Wyodrębniono'),
+        (STATUS_EMPTY, 'Brak tekstu'),
+        (STATUS_UNSUPPORTED, 'Nieobsługiwany format'),
+        (STATUS_LIMIT, 'Przekroczony limit czasu lub pamięci'),
+        (STATUS_ERROR, 'Błąd'),
+    ]
+
+    wersja = models.OneToOneField(DocumentVersion, on_delete=models.CASCADE, related_name='tekst')
+    tekst = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    komunikat = models.CharField(max_length=255, blank=True)
+    czas_ms = models.PositiveIntegerField(default=0)
+    data_ekstrakcji = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.wersja} ({self.status})"
+
+    class Meta:
+        db_table = 'tekst_wersji'
+        verbose_name = "Tekst wersji"
+        verbose_name_plural = "Teksty wersji"
+
+
+class Blob(models.Model):
+    """A file in the content-addressed store, shared by every Document/DocumentVersion with the same content."""
+    sciezka = models.CharField(max_length=255, unique=True)
+    hash_pliku = models.CharField(max_length=64, db_index=True)
+    rozmiar = models.BigIntegerField(default=0)
+    # Maintained by documents.signals; gc_blobs deletes blobs left at zero.
+    liczba_odwolan = models.PositiveIntegerField(default=0)
+    data_utworzenia = models.DateTimeField(auto_now_add=True)
+    ostatnia_zmiana = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sciezka} ({self.liczba_odwolan})"
+
+    class Meta:
+        db_table = 'blob'
+        verbose_name = "Blob"
+        verbose_name_plural = "Bloby"
+        indexes = [
+            models.Index(fields=['liczba_odwolan', 'ostatnia_zmiana'], name='blob_odwolania_idx'),
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable upload whose chunks are staged on disk until it is finalized (see documents.resumable)."""
+    STATUS_ACTIVE = 'aktywna'
+    STATUS_COMPLETE = 'zakonczona'
+    STATUS_CANCELLED = 'anulowana'
+    STATUS_CHOICES = [
+        (STATUS_ACTIVE, 'W toku'),
+        (STATUS_COMPLETE, 'Zakończona'),
+        (STATUS_CANCELLED, 'Anulowana'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uzytkownik = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sesje_przesylania')
+    nazwa_pliku = models.CharField(max_length=255)
+    rozmiar = models.BigIntegerField()
+    przeslano = models.BigIntegerField(default=0)
+    # A new document is created in ``folder``; with ``dokument`` set the upload becomes its next version.
+    folder = models.ForeignKey(Folder, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    dokument = models.ForeignKey(Document, on_delete=models.CASCADE, null=True, blank=True, related_name='sesje_przesylania')
+    nazwa = models.CharField(max_length=255, blank=True)
+    opis = models.TextField(blank=True)
+    komentarz = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_ACTIVE)
+    data_utworzenia = models.DateTimeField(auto_now_add=True)
+    ostatnia_aktywnosc = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.nazwa_pliku} ({self.przeslano}/{self.rozmiar})"
+
+    class Meta:
+        db_table = 'sesja_przesylania'
+        verbose_name = "Sesja przesyłania"
+        verbose_name_plural = "Sesje przesyłania"
+        indexes = [
+            models.Index(fields=['status', 'ostatnia_aktywnosc'], name='sesja_przes_status_idx'),
+        ]
+
+
+class FolderStats(models.Model):
+    """Precomputed folder counters, kept up to date by signals (see documents.stats)."""
+    folder = models.OneToOneField(Folder, on_delete=models.CASCADE, primary_key=True, related_name='statystyki')
+    liczba_dokumentow = models.IntegerField(default=0)  # Direct, not deleted
+    liczba_podfolderow = models.IntegerField(default=0)  # Direct
+    rozmiar_calkowity = models.BigIntegerField(default=0)  # Documents in the whole subtree
+    ostatnia_aktywnosc = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.folder_id}: {self.liczba_dokumentow} dok., {self.liczba_podfolderow} pod."
+
+    class Meta:
+        db_table = 'statystyki_folderu'
+        verbose_name = "Statystyki folderu"
+        verbose_name_plural = "Statystyki folderów"
+
+
+class UserStats(models.Model):
+    """Precomputed counters of what a user owns, kept up to date by signals (see documents.stats)."""
+    uzytkownik = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='statystyki')
+    liczba_dokumentow = models.IntegerField(default=0)  # Not deleted
+    liczba_folderow = models.IntegerField(default=0)
+    rozmiar_calkowity = models.BigIntegerField(default=0)
+    ostatnia_aktywnosc = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.uzytkownik_id}: {self.liczba_dokumentow} dok., {self.liczba_folderow} fold."
+
+    class Meta:
+        db_table = 'statystyki_uzytkownika'
+        verbose_name = "Statystyki użytkownika"
+        verbose_name_plural = "Statystyki użytkowników"
+
+
 class DocumentMetadata(models.Model):
     """Custom metadata for documents"""
     dokument = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='metadane')
@@ -331,7 +659,7 @@ class ActivityLog(models.Model):
     dokument = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True) # SET_NULL for document
     folder = models.ForeignKey(Folder, on_delete=models.SET_NULL, null=True, blank=True)     # SET_NULL for folder
     szczegoly = models.TextField(blank=True)
-    znacznik_czasu = models.DateTimeField(auto_now_add=True)
+    znacznik_czasu = models.DateTimeField(default=timezone.now) # Set when the event is queued, not when it is flushed
     adres_ip = models.GenericIPAddressField(null=True, blank=True) # Allow null for IP
 
     def __str__(self):
@@ -342,6 +670,35 @@ class ActivityLog(models.Model):
         verbose_name = "Log aktywności"
         verbose_name_plural = "Logi aktywności"
         ordering = ['-znacznik_czasu']
+        indexes = [
+            models.Index(fields=['znacznik_czasu'], name='log_akt_czas_idx'),
+            models.Index(fields=['uzytkownik', 'znacznik_czasu'], name='log_akt_uzyt_czas_idx'),
+        ]
+
+
+class ActivityDailyRollup(models.Model):
+    """Daily ActivityLog counts per user, action and document (see rollup_activity_logs)."""
+    data = models.DateField()
+    uzytkownik = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='dzienne_podsumowania_aktywnosci')
+    typ_aktywnosci = models.CharField(max_length=50, choices=ActivityLog.ACTION_CHOICES)
+    dokument = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True)
+    liczba = models.PositiveIntegerField(default=0)
+    # Part of liczba whose ActivityLog rows were moved to archive files (archive_activity_logs)
+    liczba_zarchiwizowana = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.data} - {self.typ_aktywnosci} - {self.liczba}"
+
+    class Meta:
+        db_table = 'log_aktywnosci_dzienne'
+        verbose_name = "Dzienne podsumowanie aktywności"
+        verbose_name_plural = "Dzienne podsumowania aktywności"
+        ordering = ['-data']
+        indexes = [
+            models.Index(fields=['data', 'typ_aktywnosci'], name='log_dzien_data_typ_idx'),
+            models.Index(fields=['uzytkownik', 'data'], name='log_dzien_uzyt_data_idx'),
+            models.Index(fields=['dokument', 'data'], name='log_dzien_dok_data_idx'),
+        ]
 
 
 class DocumentShare(models.Model):
@@ -371,6 +728,70 @@ class DocumentShare(models.Model):
         verbose_name_plural = "Udostępnienia dokumentów"
 
 
+class DocumentACL(models.Model):
+    """Denormalized per-user object permissions on documents (mirror of guardian's UserObjectPermission)"""
+    BROWSE = 1
+    CHANGE = 2
+    DELETE = 4
+    SHARE = 8
+    DOWNLOAD = 16
+    COMMENT = 32
+
+    PERMISSION_BITS = {
+        'browse_document': BROWSE,
+        'change_document': CHANGE,
+        'delete_document': DELETE,
+        'share_document': SHARE,
+        'download_document': DOWNLOAD,
+        'comment_document': COMMENT,
+    }
+
+    uzytkownik = models.ForeignKey(User, on_delete=models.CASCADE, related_name='document_acl')
+    dokument = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='acl')
+    uprawnienia = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.uzytkownik_id} -> {self.dokument_id}: {self.uprawnienia:#b}"
+
+    class Meta:
+        db_table = 'dokument_acl'
+        unique_together = ['uzytkownik', 'dokument']
+        indexes = [models.Index(fields=['dokument', 'uzytkownik'], name='dokument_acl_dok_uzyt_idx')]
+        verbose_name = "Uprawnienia do dokumentu"
+        verbose_name_plural = "Uprawnienia do dokumentów"
+
+
+class FolderACL(models.Model):
+    """Denormalized per-user object permissions on folders (mirror of guardian's UserObjectPermission)"""
+    BROWSE = 1
+    CHANGE = 2
+    DELETE = 4
+    ADD_DOCUMENT = 8
+    ADD_SUBFOLDER = 16
+
+    PERMISSION_BITS = {
+        'browse_folder': BROWSE,
+        'change_folder': CHANGE,
+        'delete_folder': DELETE,
+        'add_document_to_folder': ADD_DOCUMENT,
+        'add_subfolder_to_folder': ADD_SUBFOLDER,
+    }
+
+    uzytkownik = models.ForeignKey(User, on_delete=models.CASCADE, related_name='folder_acl')
+    folder = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='acl')
+    uprawnienia = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.uzytkownik_id} -> {self.folder_id}: {self.uprawnienia:#b}"
+
+    class Meta:
+        db_table = 'folder_acl'
+        unique_together = ['uzytkownik', 'folder']
+        indexes = [models.Index(fields=['folder', 'uzytkownik'], name='folder_acl_folder_uzyt_idx')]
+        verbose_name = "Uprawnienia do folderu"
+        verbose_name_plural = "Uprawnienia do folderów"
+
+
 class SystemSettings(models.Model):
     """Ustawienia systemowe"""
     # Renamed 'key' to 'klucz' and 'value' to 'wartosc' as per previous files
@@ -384,13 +805,27 @@ class SystemSettings(models.Model):
     def __str__(self):
         return f"{self.klucz}: {self.wartosc}"
 
+    # Lookups read a cached copy of all settings (documents.settings_cache);
+    # saving or deleting a setting invalidates it.
     @classmethod
     def get_setting(cls, klucz, default=None):
-        try:
-            setting = cls.objects.get(klucz=klucz)
-            return setting.wartosc
-        except cls.DoesNotExist:
-            return default
+        from .settings_cache import get_setting
+        return get_setting(klucz, default)
+
+    @classmethod
+    def get_int(cls, klucz, default=None):
+        from .settings_cache import get_int
+        return get_int(klucz, default)
+
+    @classmethod
+    def get_bool(cls, klucz, default=False):
+        from .settings_cache import get_bool
+        return get_bool(klucz, default)
+
+    @classmethod
+    def get_json(cls, klucz, default=None):
+        from .settings_cache import get_json
+        return get_json(klucz, default)
 
     @classmethod
     def set_setting(cls, klucz, wartosc, opis='', kategoria='general'):
@@ -413,4 +848,33 @@ class SystemSettings(models.Model):
         db_table = 'system_settings'
         verbose_name = 'Ustawienie systemowe'
         verbose_name_plural = 'Ustawienia systemowe'
-        ordering = ['kategoria', 'klucz']
\ No newline at end of file
+        ordering = ['kategoria', 'klucz']
+
+
+class CacheGeneration(models.Model):
+    """An invalidation counter shared by every process (see users.permissions and documents.settings_cache)."""
+    klucz = models.CharField(max_length=100, primary_key=True)
+    wartosc = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.klucz}: {self.wartosc}"
+
+    @classmethod
+    def current(cls, klucz):
+        """Current value of the ``klucz`` counter (0 before its first bump)."""
+        return cls.objects.filter(klucz=klucz).values_list('wartosc', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, klucz):
+        # Never below the clock: a bump rolled back with its transaction and
+        # redone later must not reuse the value entries were cached under.
+        value = Greatest(F('wartosc') + 1, models.Value(time.time_ns(), output_field=models.BigIntegerField()))
+        if not cls.objects.filter(klucz=klucz).update(wartosc=value):
+            _, created = cls.objects.get_or_create(klucz=klucz, defaults={'wartosc': time.time_ns()})
+            if not created:
+                cls.objects.filter(klucz=klucz).update(wartosc=value)
+
+    class Meta:
+        db_table = 'generacja_cache'
+        verbose_name = 'Generacja cache'
+        verbose_name_plural = 'Generacje cache'
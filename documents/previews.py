@@ -0,0 +1,294 @@
+"""
+Document previews: cached thumbnails and paged text.
+
+Thumbnails are JPEGs at THUMBNAIL_SIZES (longest side, in pixels) of an
+image or of the first page of a PDF (when pypdfium2 is installed). They are
+stored under ``MEDIA_ROOT/previews/`` keyed by the SHA-256 of the version's
+content, so every document and version with the same bytes shares them and
+a new version never sees a stale one. Because they live under MEDIA_ROOT
+they are delivered like downloads (documents.delivery), X-Accel-Redirect
+included.
+
+All sizes are rendered from one decode, either lazily by the first request
+or, with PREVIEW_ON_UPLOAD, after the upload commits on the text extraction
+process pool (with its memory cap). Images over MAX_IMAGE_PIXELS are not
+decoded at all, so a lazy render in a web worker stays bounded too.
+``manage.py warm_previews`` renders them for existing documents. The cache is bounded by PREVIEW_CACHE_MAX_MB:
+serving a thumbnail bumps its mtime, and the least recently used files are
+removed when the cache grows past the quota.
+
+Text is previewed a page at a time: plain text files straight from a byte
+offset, other formats from the text extracted for search.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_PREFIX = 'previews/'
+THUMBNAIL_SIZES = (160, 480, 1200)
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+TEXT_PAGE_BYTES = 64 * 1024
+TEXT_PAGE_CHARS = 20000
+# Eviction goes down to this fraction of the quota, so it does not run on every render.
+EVICTION_TARGET = 0.9
+# Larger images (after JPEG draft scaling) are not decoded: at 3 bytes a pixel
+# this bounds the memory of a render in the web worker to about 120 MB.
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+def preview_name(digest, size):
+    return f'{PREVIEW_PREFIX}{digest[:2]}/{digest}-{size}.jpg'
+
+
+def file_extension(name):
+    return os.path.splitext(name)[1].lower().lstrip('.')
+
+
+def can_render(extension):
+    return extension in IMAGE_EXTENSIONS or (extension == 'pdf' and pdfium is not None)
+
+
+class PreviewFile:
+    """A cached preview, shaped like the FieldFile the delivery backends expect."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def __bool__(self):
+        return True
+
+
+# --- Rendering (also runs in pool workers: no Django models here) ---
+
+def _first_page(source_path, extension, max_size):
+    from PIL import Image, ImageOps
+
+    if extension == 'pdf':
+        pdf = pdfium.PdfDocument(source_path)
+        try:
+            page = pdf[0]
+            scale = max_size / max(page.get_size())
+            image = page.render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(source_path)
+        # JPEG can decode straight at a fraction of the size, which is most of the work saved
+        image.draft('RGB', (max_size, max_size))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError(f'{image.width}x{image.height} pixels')
+        image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    return image.convert('RGB')
+
+
+def render_thumbnails(source_path, extension, targets):
+    """
+    Write a JPEG thumbnail to each ``{size: path}`` of ``targets`` from one
+    decode of the source. Returns the bytes written.
+    """
+    from PIL import Image
+
+    if not targets or not can_render(extension):
+        return 0
+    image = _first_page(source_path, extension, max(targets))
+    written = 0
+    for size in sorted(targets, reverse=True):  # Each size is scaled down from the previous one
+        image.thumbnail((size, size), Image.LANCZOS)
+        path = targets[size]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        image.save(tmp_path, 'JPEG', quality=85, optimize=True)
+        os.replace(tmp_path, path)
+        written += os.path.getsize(path)
+    return written
+
+
+# --- Cache ---
+
+def _storage():
+    from .storage import blob_storage
+    return blob_storage
+
+
+def missing_thumbnails(digest):
+    """``{size: path}`` of the thumbnails of content ``digest`` that are not cached yet."""
+    storage = _storage()
+    targets = {size: storage.path(preview_name(digest, size)) for size in THUMBNAIL_SIZES}
+    return {size: path for size, path in targets.items() if not os.path.exists(path)}
+
+
+def get_thumbnail(plik, digest, extension, size):
+    """The cached ``size`` thumbnail of the stored file ``plik`` (content hash ``digest``), rendered if missing."""
+    name = preview_name(digest, size)
+    path = _storage().path(name)
+    try:
+        os.utime(path)  # Recently used: evicted last
+        return PreviewFile(name, path)
+    except FileNotFoundError:
+        pass
+    if not can_render(extension) or not plik or not os.path.exists(plik.path):
+        return None
+    from PIL import Image
+    try:
+        record_rendered(render_thumbnails(plik.path, extension, missing_thumbnails(digest)))
+    except Image.DecompressionBombError as exc:
+        logger.warning('Not rendering previews of %s: %s', plik.name, exc)
+        return None
+    except Exception:
+        logger.warning('Rendering previews of %s failed', plik.name, exc_info=True)
+        return None
+    return PreviewFile(name, path) if os.path.exists(path) else None
+
+
+_cache_bytes = None
+_cache_lock = threading.Lock()
+
+
+def _quota():
+    return getattr(settings, 'PREVIEW_CACHE_MAX_MB', 512) * 1024 * 1024
+
+
+def record_rendered(added):
+    """Add ``added`` freshly rendered bytes to this process's idea of the cache size; evict past the quota."""
+    global _cache_bytes
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, size, _ in _cached_files())
+        _cache_bytes += added
+        over = _cache_bytes > _quota()
+    if over:
+        enforce_quota()
+
+
+def _cached_files():
+    """``(mtime, size, path)`` of every cached preview."""
+    root = _storage().path(PREVIEW_PREFIX)
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+
+def enforce_quota(max_bytes=None):
+    """
+    Delete the least recently used previews until the cache is under
+    EVICTION_TARGET of ``max_bytes`` (default PREVIEW_CACHE_MAX_MB).
+    Returns ``(files, bytes)`` removed.
+    """
+    global _cache_bytes
+    if max_bytes is None:
+        max_bytes = _quota()
+    files = sorted(_cached_files())
+    total = sum(size for _, size, _ in files)
+    removed = freed = 0
+    if total > max_bytes:
+        for _, size, path in files:
+            if total - freed <= max_bytes * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+    with _cache_lock:
+        _cache_bytes = total - freed
+    return removed, freed
+
+
+def schedule_previews(version):
+    """Render the thumbnails of a new version on the background pool once the transaction commits."""
+    from .extraction import _background_pool
+
+    extension = file_extension(version.plik.name)
+    if not getattr(settings, 'PREVIEW_ON_UPLOAD', False) or not version.hash_pliku or not can_render(extension):
+        return
+
+    def submit():
+        targets = missing_thumbnails(version.hash_pliku)
+        if not targets:
+            return
+        future = _background_pool().submit(render_thumbnails, version.plik.path, extension, targets)
+        future.add_done_callback(_on_rendered)
+
+    transaction.on_commit(submit)
+
+
+def _on_rendered(future):
+    try:
+        record_rendered(future.result())
+    except Exception:
+        logger.warning('Background preview rendering failed', exc_info=True)
+
+
+# --- Text ---
+
+def read_text_page(path, offset=0, length=TEXT_PAGE_BYTES):
+    """
+    ``(text, next_offset)`` for about ``length`` bytes of a UTF-8 file from
+    byte ``offset``, ending at a line break where there is one. ``next_offset``
+    is None on the last page. Only the page is read, whatever the file size.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        data = f.read(length)
+    start = 0
+    while start < min(3, len(data)) and 0x80 <= data[start] < 0xC0:
+        start += 1  # An offset inside a character: skip to the next one
+    end = len(data)
+    if offset + end < size:
+        newline = data.rfind(b'\n', start, end)
+        if newline >= length // 2:
+            end = newline + 1
+        else:
+            while end > start and 0x80 <= data[end - 1] < 0xC0:
+                end -= 1
+            if end > start and data[end - 1] >= 0xC0:
+                end -= 1  # Lead byte of a character cut at the end
+    text = data[start:end].decode('utf-8', errors='replace')
+    next_offset = offset + end if offset + end < size else None
+    return text, next_offset
+
+
+def extracted_text_page(document, offset=0, length=TEXT_PAGE_CHARS):
+    """
+    The same paging over the text extracted from the document's latest
+    version, by character offset; only the page is fetched from the
+    database. None when there is no extracted text.
+    """
+    from django.db.models.functions import Length, Substr
+    from .models import DocumentVersionText
+
+    row = (DocumentVersionText.objects.filter(wersja_id=document.aktualna_wersja_id)
+           .annotate(strona=Substr('tekst', offset + 1, length), dlugosc=Length('tekst'))
+           .values_list('strona', 'dlugosc').first())
+    if not row or not row[1]:
+        return None
+    page, total = row
+    end = len(page)
+    if offset + end < total:
+        newline = page.rfind('\n')
+        if newline >= length // 2:
+            end = newline + 1
+    return page[:end], offset + end if offset + end < total else None
@@ -0,0 +1,249 @@
+"""
+Resumable uploads for large documents, modelled on the tus protocol.
+
+A client announces the file (name, size, target folder or document) and gets
+an UploadSession, then PATCHes the bytes in any number of chunks, each
+starting at the offset the server has acknowledged so far. Chunks are
+streamed from the request straight onto the end of a staging file under
+UPLOAD_STAGING_DIR, so a worker never holds more than UPLOAD_CHUNK_SIZE of
+the body and a dropped connection only loses the unacknowledged tail: the
+client asks for the offset (HEAD) and carries on from there.
+
+``finalize`` hashes the complete staging file in one pass and hands it to the
+blob storage with its digest, which moves it into the store instead of
+copying it (keep UPLOAD_STAGING_DIR on the same filesystem as MEDIA_ROOT).
+A hashlib object cannot be carried from one request to the next, which is
+why hashing waits for the whole file. Sessions idle for longer than
+UPLOAD_SESSION_TTL_HOURS are removed by ``manage.py cleanup_uploads``.
+"""
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .uploads import UPLOAD_CHUNK_SIZE, _Fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; ``status`` is the HTTP status to answer with."""
+    status = 400
+
+
+class UploadOffsetMismatch(UploadError):
+    status = 409
+
+    def __init__(self, offset):
+        super().__init__(f"Oczekiwano przesunięcia {offset}.")
+        self.offset = offset
+
+
+class UploadLocked(UploadError):
+    status = 423
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class UploadGone(UploadError):
+    status = 410
+
+
+class StagedUpload(File):
+    """The assembled staging file, with the digest the blob storage and Document.save() expect."""
+
+    def __init__(self, path, name, digest):
+        super().__init__(open(path, 'rb'), name)
+        self.path = path
+        self.digest = digest
+        self.size = digest.size
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def staging_path(session):
+    return os.path.join(settings.UPLOAD_STAGING_DIR, f'{session.pk}.part')
+
+
+def create_session(user, **fields):
+    """Start an upload session and its (empty) staging file."""
+    from .models import UploadSession
+
+    session = UploadSession.objects.create(uzytkownik=user, **fields)
+    os.makedirs(settings.UPLOAD_STAGING_DIR, exist_ok=True)
+    open(staging_path(session), 'wb').close()
+    return session
+
+
+def _lock(f, session, unlock=False):
+    """
+    Lock the open staging file ``f`` without waiting; False when another
+    request holds it. msvcrt locks byte ranges, and a locked range cannot be
+    read through other handles: lock the byte past the declared size, which
+    no chunk writes and no reader reaches.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_UN if unlock else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    f.seek(session.rozmiar)
+    try:
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK if unlock else msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def _locked_staging_file(session):
+    """The staging file opened for writing, locked against concurrent requests for the same session."""
+    from .models import UploadSession
+
+    try:
+        f = open(staging_path(session), 'r+b')
+    except FileNotFoundError:
+        raise UploadGone("Dane sesji przesyłania nie istnieją.")
+    with f:
+        if not _lock(f, session):
+            raise UploadLocked("Inne żądanie zapisuje już tę sesję.")
+        try:
+            # The offset may have moved while we waited for the request to arrive.
+            session.refresh_from_db()
+            if session.status != UploadSession.STATUS_ACTIVE:
+                raise UploadGone("Sesja przesyłania została zakończona.")
+            yield f
+        finally:
+            f.flush()
+            _lock(f, session, unlock=True)
+
+
+def append_chunk(session, stream, offset, length):
+    """
+    Write ``length`` bytes read from ``stream`` at ``offset`` and return the
+    new offset. Whatever arrived before the client went away is kept, so the
+    upload resumes from there.
+    """
+    from .models import UploadSession
+
+    if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise UploadTooLarge(f"Fragment nie może być większy niż {settings.UPLOAD_CHUNK_MAX_SIZE} bajtów.")
+    with _locked_staging_file(session) as f:
+        if offset != session.przeslano:
+            raise UploadOffsetMismatch(session.przeslano)
+        if offset + length > session.rozmiar:
+            raise UploadTooLarge("Fragment wykracza poza zadeklarowany rozmiar pliku.")
+
+        f.truncate(offset)  # Drop bytes of an earlier, unacknowledged attempt
+        f.seek(offset)
+        written = 0
+        try:
+            while written < length:
+                chunk = stream.read(min(UPLOAD_CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+        finally:
+            f.flush()
+            os.fsync(f.fileno())
+            UploadSession.objects.filter(pk=session.pk, przeslano=offset).update(
+                przeslano=offset + written, ostatnia_aktywnosc=timezone.now()
+            )
+            session.przeslano = offset + written
+    return session.przeslano
+
+
+def finalize(session, user):
+    """
+    Turn a fully uploaded session into a new Document (with version 1) or the
+    next version of ``session.dokument``. Returns the document.
+    """
+    from guardian.shortcuts import assign_perm
+    from .models import Document, UploadSession
+
+    with _locked_staging_file(session) as f:
+        if session.przeslano != session.rozmiar:
+            raise UploadOffsetMismatch(session.przeslano)
+
+        fingerprint = _Fingerprint()
+        f.seek(0)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            fingerprint.update(chunk)
+        staged = StagedUpload(staging_path(session), session.nazwa_pliku, fingerprint.digest(session.nazwa_pliku))
+
+        with staged, transaction.atomic():
+            if session.dokument is not None:
+                document = session.dokument
+                document.add_version(staged, user, komentarz=session.komentarz,
+                                     oryginalna_nazwa_pliku=session.nazwa_pliku)
+            else:
+                document = Document.objects.create(
+                    nazwa=session.nazwa or session.nazwa_pliku,
+                    opis=session.opis,
+                    folder=session.folder,
+                    wlasciciel=user,
+                    plik=staged,
+                    typ_pliku=os.path.splitext(session.nazwa_pliku)[1].lower().lstrip('.'),
+                )
+                assign_perm('documents.browse_document', user, document)
+                assign_perm('documents.download_document', user, document)
+                document.add_first_version(user, oryginalna_nazwa_pliku=session.nazwa_pliku,
+                                           komentarz=session.komentarz)
+            session.dokument = document
+            session.status = UploadSession.STATUS_COMPLETE
+            session.save(update_fields=['dokument', 'status', 'ostatnia_aktywnosc'])
+
+    # The storage moved the staging file into place unless identical content was already stored.
+    _remove_staging_file(session)
+    return document
+
+
+def discard(session):
+    """Cancel an upload and delete what was staged for it."""
+    from .models import UploadSession
+
+    UploadSession.objects.filter(pk=session.pk).update(
+        status=UploadSession.STATUS_CANCELLED, ostatnia_aktywnosc=timezone.now()
+    )
+    session.status = UploadSession.STATUS_CANCELLED
+    _remove_staging_file(session)
+
+
+def _remove_staging_file(session):
+    try:
+        os.remove(staging_path(session))
+    except FileNotFoundError:
+        pass
+
+
+def cleanup_expired(ttl=None):
+    """
+    Discard active sessions idle for longer than ``ttl`` (default
+    UPLOAD_SESSION_TTL_HOURS) and delete finished ones of the same age.
+    Returns ``(discarded, deleted)``.
+    """
+    from .models import UploadSession
+
+    if ttl is None:
+        ttl = timedelta(hours=getattr(settings, 'UPLOAD_SESSION_TTL_HOURS', 24))
+    cutoff = timezone.now() - ttl
+    expired = UploadSession.objects.filter(ostatnia_aktywnosc__lt=cutoff)
+    discarded = 0
+    for session in expired.filter(status=UploadSession.STATUS_ACTIVE).iterator(chunk_size=500):
+        discard(session)
+        discarded += 1
+    deleted, _ = expired.exclude(status=UploadSession.STATUS_ACTIVE).delete()
+    return discarded, deleted
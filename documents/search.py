@@ -0,0 +1,389 @@
+"""
+Full-text search over documents.
+
+Name, description, tags, metadata and the extracted text of the latest
+version (documents.extraction) are normalised by ``analyze`` (lowercase,
+light Polish suffix stemming, diacritic folding) and stored in an inverted
+index:
+
+* SQLite: FTS5 virtual table ``dokument_fts`` (rowid = document id), ranked
+  with bm25() and per-column weights.
+* PostgreSQL: ``dokument_search`` with a weighted tsvector and a GIN index,
+  ranked with ts_rank_cd().
+* Other databases fall back to the old ``icontains`` filter.
+
+Permissions are applied by joining the index with the caller's Document
+queryset, so the same PermissionIndex filtering as in listings applies.
+
+The tables are created by migration 0013. The index is maintained by the
+signal receivers in documents.signals and can be rebuilt with
+``manage.py rebuild_search_index``.
+"""
+import re
+import unicodedata
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import F, Q
+
+# Column weights, in index column order.
+COLUMNS = ('nazwa', 'opis', 'tagi', 'metadane', 'tresc')
+BM25_WEIGHTS = (10.0, 4.0, 5.0, 3.0, 1.0)
+POSTGRES_WEIGHTS = ('A', 'B', 'A', 'C', 'D')
+
+# Only this much of a version's text is indexed.
+MAX_INDEXED_TEXT = 1024 * 1024
+
+# Number of best ranked matches that can be paged through.
+SEARCH_RANK_WINDOW = 1000
+# Only this many matches, the most recently created, are scored: ranking a
+# term found in most documents would otherwise cost a score per match. One
+# more than the window is enough to tell that the window was filled.
+SEARCH_RANK_CANDIDATES = SEARCH_RANK_WINDOW + 1
+
+
+# --- Analysis ---
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Common Polish inflectional endings, longest first. Stripping is deliberately
+# light (one suffix, stem of at least three letters): it merges the usual
+# case and number forms ("umowa", "umowy", "umowami") without the
+# over-stemming of a full morphological analyser.
+_SUFFIXES = sorted({
+    'ościami', 'ościach', 'owanie', 'owania', 'owaniu', 'ościom',
+    'ością', 'ości', 'ość', 'owie', 'owych', 'owymi', 'owego', 'owemu',
+    'owej', 'owa', 'owe', 'owy', 'ową', 'ami', 'ach', 'ego', 'emu', 'ymi',
+    'imi', 'ych', 'ich', 'iej', 'iem', 'ów', 'om', 'ej', 'ym', 'im', 'em',
+    'ie', 'ii', 'ia', 'iu', 'ię', 'ią', 'a', 'e', 'i', 'y', 'o', 'u', 'ą', 'ę',
+}, key=len, reverse=True)
+_MIN_STEM = 3
+
+STOP_WORDS = frozenset(
+    'a aby ale bez by być co czy dla do i ich jak jako jest jego jej już lub na nad nie '
+    'o od oraz po pod przez przy są się ta tak te tego tej ten to tu tym u w we z za ze że'.split()
+)
+
+_FOLD = str.maketrans('ąćęłńóśźż', 'acelnoszz')
+
+
+def stem(token):
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= _MIN_STEM:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text):
+    """Lowercased word tokens of ``text``; underscores and punctuation split words."""
+    text = unicodedata.normalize('NFKC', text or '').lower().replace('_', ' ')
+    return _TOKEN_RE.findall(text)
+
+
+def analyze(text):
+    """Index terms for ``text``: stemmed and diacritic-folded tokens, without stop words."""
+    return [stem(token).translate(_FOLD) for token in tokenize(text) if token not in STOP_WORDS]
+
+
+def analyzed(text):
+    return ' '.join(analyze(text))
+
+
+# --- Document fields ---
+
+def _latest_version_text(document):
+    """Extracted text of the latest version (see documents.extraction), or ''."""
+    from .models import DocumentVersionText
+
+    text = DocumentVersionText.objects.filter(wersja_id=document.aktualna_wersja_id).values_list('tekst', flat=True).first()
+    return (text or '')[:MAX_INDEXED_TEXT]
+
+
+def document_fields(document, text=None):
+    """Analyzed text for each of COLUMNS; ``text`` is the latest version's text when already loaded."""
+    tags = ' '.join(tag.nazwa for tag in document.tagi.all())
+    metadata = ' '.join(f'{item.klucz} {item.wartosc}' for item in document.metadane.all())
+    return (
+        analyzed(document.nazwa),
+        analyzed(document.opis),
+        analyzed(tags),
+        analyzed(metadata),
+        analyzed(_latest_version_text(document) if text is None else text[:MAX_INDEXED_TEXT]),
+    )
+
+
+# --- Backends ---
+
+def allowed_sql(allowed):
+    """
+    SQL selecting the permitted document ids as ``doc_id``, joined (not
+    IN-listed) by the backends, or ``None`` when ``allowed`` cannot match
+    anything (e.g. an empty permitted id list).
+    """
+    try:
+        sql, params = allowed.order_by().values(doc_id=F('pk')).query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return sql, list(params)
+
+
+class SearchBackend:
+    vendor = None
+
+    def index(self, document_id, fields):
+        raise NotImplementedError
+
+    def remove(self, document_ids):
+        raise NotImplementedError
+
+    def ranked_ids(self, terms, allowed, limit, candidates):
+        """
+        Ids of ``allowed`` documents matching every term, best first: the
+        ``limit`` best of the ``candidates`` matches with the highest ids.
+
+        ``allowed`` is an ``(sql, params)`` pair from ``allowed_sql``.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    vendor = 'sqlite'
+
+    def index(self, document_id, fields):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM dokument_fts WHERE rowid = %s', [document_id])
+            cursor.execute(
+                f'INSERT INTO dokument_fts (rowid, {", ".join(COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)',
+                [document_id, *fields],
+            )
+
+    def remove(self, document_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM dokument_fts WHERE rowid = %s', [[pk] for pk in document_ids])
+
+    # The joins below are CROSS JOINs because that makes SQLite keep the FTS
+    # table as the outer loop; probing FTS once per permitted document
+    # re-evaluates the MATCH every time.
+
+    def _match(self, terms, prefix=True):
+        # Every term must occur. Only the last one is a prefix query (the
+        # word still being typed); prefixing every term multiplies the hits.
+        quoted = [f'"{term}"' for term in terms]
+        if prefix:
+            quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def _is_common(self, term, cap):
+        # Counted over the whole index, like the document frequencies bm25() uses
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM dokument_fts WHERE dokument_fts MATCH %s LIMIT %s)',
+                [f'"{term}"', cap],
+            )
+            return cursor.fetchone()[0] >= cap
+
+    def ranked_ids(self, terms, allowed, limit, candidates):
+        sql, params = allowed
+        # A last word that ``limit`` documents contain is taken as complete:
+        # as a prefix, FTS5 would first merge the matches of every word it
+        # starts, which for a common word costs more than the ranking.
+        match = self._match(terms, prefix=not self._is_common(terms[-1], limit))
+        # FTS5 returns matches in rowid order without scoring them, so the
+        # inner query stops after ``candidates`` rows and bm25() only runs
+        # for those.
+        weights = ', '.join(str(w) for w in BM25_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT doc_id FROM ('
+                f' SELECT dokument_fts.rowid AS doc_id, bm25(dokument_fts, {weights}) AS score'
+                f' FROM dokument_fts CROSS JOIN ({sql}) AS allowed ON allowed.doc_id = dokument_fts.rowid'
+                ' WHERE dokument_fts MATCH %s ORDER BY dokument_fts.rowid DESC LIMIT %s'
+                ') ORDER BY score, doc_id DESC LIMIT %s',
+                [*params, match, candidates, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM dokument_fts')
+
+
+class PostgresSearchBackend(SearchBackend):
+    vendor = 'postgresql'
+
+    def index(self, document_id, fields):
+        vector = ' || '.join(
+            f"setweight(to_tsvector('simple', %s), '{weight}')" for weight in POSTGRES_WEIGHTS
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO dokument_search (dokument_id, wektor) VALUES (%s, {vector}) '
+                'ON CONFLICT (dokument_id) DO UPDATE SET wektor = EXCLUDED.wektor',
+                [document_id, *fields],
+            )
+
+    def remove(self, document_ids):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM dokument_search WHERE dokument_id = ANY(%s)', [list(document_ids)])
+
+    def _query(self, terms):
+        return ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+
+    def ranked_ids(self, terms, allowed, limit, candidates):
+        sql, params = allowed
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT dokument_id FROM ('
+                ' SELECT s.dokument_id, s.wektor FROM dokument_search s'
+                f' JOIN ({sql}) AS allowed ON allowed.doc_id = s.dokument_id'
+                " WHERE s.wektor @@ to_tsquery('simple', %s) ORDER BY s.dokument_id DESC LIMIT %s"
+                " ) AS candidates ORDER BY ts_rank_cd(wektor, to_tsquery('simple', %s)) DESC, dokument_id DESC LIMIT %s",
+                [*params, self._query(terms), candidates, self._query(terms), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM dokument_search')
+
+
+_BACKENDS = {backend.vendor: backend for backend in (SQLiteFTSBackend(), PostgresSearchBackend())}
+
+
+def get_search_backend():
+    """Backend for the default database, or ``None`` when it has no full-text index."""
+    return _BACKENDS.get(connection.vendor)
+
+
+# --- Public API ---
+
+def index_document(document):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.index(document.pk, document_fields(document))
+
+
+def index_documents(documents):
+    """index_document for many documents, loading their texts in one query (prefetch tags and metadata)."""
+    from .models import DocumentVersionText
+
+    backend = get_search_backend()
+    if backend is None:
+        return
+    texts = dict(DocumentVersionText.objects.filter(
+        wersja_id__in=[document.aktualna_wersja_id for document in documents if document.aktualna_wersja_id]
+    ).values_list('wersja_id', 'tekst'))
+    for document in documents:
+        backend.index(document.pk, document_fields(document, texts.get(document.aktualna_wersja_id, '')))
+
+
+def remove_document(document_id):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.remove([document_id])
+
+
+class SearchResults:
+    """
+    Ranked matches of a query, countable and sliceable so that they can be
+    handed to django.core.paginator.Paginator. Slices are Document instances
+    loaded from ``queryset`` in rank order.
+
+    Only the SEARCH_RANK_CANDIDATES most recent matches are scored, so a
+    broad query costs about as much as a narrow one and returns the best of
+    its newest matches. One query ranks them and keeps the SEARCH_RANK_WINDOW
+    best, which give both the count and every page; ``truncated`` tells
+    whether there were more matches than that.
+    """
+
+    def __init__(self, query, allowed, queryset=None):
+        self.query = query
+        self.terms = analyze(query)
+        self.allowed = allowed
+        self.queryset = queryset if queryset is not None else allowed
+        self.backend = get_search_backend()
+        self._ids = None
+        self._count = None
+
+    def _fallback(self):
+        condition = Q()
+        for token in tokenize(self.query):
+            condition &= Q(nazwa__icontains=token) | Q(opis__icontains=token)
+        return self.queryset.filter(condition, pk__in=self.allowed.values('pk')).order_by('nazwa', 'pk')
+
+    def _ranked_ids(self):
+        if self._ids is None:
+            allowed = allowed_sql(self.allowed) if self.terms else None
+            if allowed is None:
+                self._ids = []
+            else:
+                # One more than the window tells whether it was truncated
+                self._ids = self.backend.ranked_ids(self.terms, allowed, SEARCH_RANK_WINDOW + 1, SEARCH_RANK_CANDIDATES)
+        return self._ids
+
+    def _hits(self):
+        if self._count is None:
+            if self.backend is None:
+                self._count = self._fallback()[:SEARCH_RANK_WINDOW + 1].count() if self.terms else 0
+            else:
+                self._count = len(self._ranked_ids())
+        return self._count
+
+    def count(self):
+        return min(self._hits(), SEARCH_RANK_WINDOW)
+
+    def __len__(self):
+        return self.count()
+
+    @property
+    def truncated(self):
+        return self._hits() > SEARCH_RANK_WINDOW
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start = key.start or 0
+        stop = min(key.stop if key.stop is not None else SEARCH_RANK_WINDOW, SEARCH_RANK_WINDOW)
+        if not self.terms or stop <= start:
+            return []
+        if self.backend is None:
+            return list(self._fallback()[start:stop])
+        ids = self._ranked_ids()[start:stop]
+        documents = self.queryset.in_bulk(ids)
+        return [documents[pk] for pk in ids if pk in documents]
+
+
+def search_documents(query, allowed, queryset=None):
+    """
+    Rank documents matching ``query`` among ``allowed`` (a Document queryset
+    already restricted to what the user may see). ``queryset`` (default:
+    ``allowed``) loads the result rows by pk, e.g. with select_related
+    applied; it need not repeat the permission filter.
+    """
+    return SearchResults(query, allowed, queryset)
+
+
+def rebuild_index(batch_size=500, progress=None):
+    """Reindex every document. Returns the number of documents indexed."""
+    from .models import Document
+
+    backend = get_search_backend()
+    if backend is None:
+        return 0
+    backend.clear()
+    total = 0
+    documents = Document.objects.prefetch_related('tagi', 'metadane').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(documents.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        index_documents(batch)
+        total += len(batch)
+        last_pk = batch[-1].pk
+        if progress is not None:
+            progress(total)
+    return total
@@ -0,0 +1,135 @@
+"""
+Cached SystemSettings lookups.
+
+All rows are loaded at once into a process-local dict and kept for as long
+as the settings generation, a CacheGeneration row, does not change. The
+generation is bumped when a setting is saved or deleted (set_setting, the
+admin, any model save) once the transaction commits. Each process re-reads
+it at most once per SETTINGS_GENERATION_CHECK_INTERVAL seconds, so a change
+reaches every worker within that time, with or without a shared cache
+backend. The loaded dict is stored in Django's cache too, under the
+generation, so with a shared backend the other processes reload it without
+a query.
+
+Bulk ``update()``/``delete()`` on SystemSettings bypass the signals: call
+bump_settings_generation() after them.
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+SETTINGS_GENERATION_KEY = 'system_settings:generation'
+SETTINGS_VALUES_TIMEOUT = 60 * 60
+TRUE_VALUES = {'1', 'true', 'yes', 'on', 'tak'}
+FALSE_VALUES = {'0', 'false', 'no', 'off', 'nie', ''}
+
+# (generation, values, monotonic time the generation was read), replaced as
+# a whole so threads never see half of it
+_snapshot = (None, None, 0)
+# Changes not committed yet, per thread (each thread has its own connection)
+_local = threading.local()
+
+
+def get_settings_generation():
+    from .models import CacheGeneration
+    return CacheGeneration.current(SETTINGS_GENERATION_KEY)
+
+
+def bump_settings_generation():
+    """Invalidate the cached settings in every process."""
+    global _snapshot
+    from .models import CacheGeneration
+    CacheGeneration.bump(SETTINGS_GENERATION_KEY)
+    _snapshot = (None, None, 0)
+
+
+def invalidate_settings():
+    """Drop this process's copy now and everyone's once the current transaction commits."""
+    global _snapshot
+    _snapshot = (None, None, 0)
+
+    def bump():
+        pending.discard(bump)
+        bump_settings_generation()
+
+    pending = _pending_bumps()
+    pending.add(bump)
+    transaction.on_commit(bump)
+
+
+def _pending_bumps():
+    if not hasattr(_local, 'pending'):
+        _local.pending = set()
+    return _local.pending
+
+
+def _change_pending():
+    # A change made in this thread's open transaction: until it commits a
+    # reload may see uncommitted rows, so it is not kept (and not shared). A
+    # rollback discards the on_commit callback, and with it the change.
+    pending = _pending_bumps()
+    if pending:
+        pending.intersection_update(func for _, func, *_ in connection.run_on_commit)
+    return bool(pending)
+
+
+def _load():
+    from .models import SystemSettings
+    return dict(SystemSettings.objects.values_list('klucz', 'wartosc'))
+
+
+def all_settings():
+    """``{klucz: wartosc}`` of every system setting."""
+    global _snapshot
+    if _change_pending():
+        return _load()
+    cached_generation, values, checked = _snapshot
+    now = time.monotonic()
+    interval = getattr(settings, 'SETTINGS_GENERATION_CHECK_INTERVAL', 1)
+    if values is not None and now - checked < interval:
+        return values
+    generation = get_settings_generation()
+    if cached_generation != generation:
+        key = f'system_settings:values:{generation}'
+        values = cache.get(key)
+        if values is None:
+            values = _load()
+            cache.set(key, values, SETTINGS_VALUES_TIMEOUT)
+    _snapshot = (generation, values, now)
+    return values
+
+
+def get_setting(klucz, default=None):
+    return all_settings().get(klucz, default)
+
+
+def get_int(klucz, default=None):
+    value = get_setting(klucz)
+    try:
+        return int(value.strip())
+    except (AttributeError, ValueError):
+        return default
+
+
+def get_bool(klucz, default=False):
+    value = get_setting(klucz)
+    if value is None:
+        return default
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    return default
+
+
+def get_json(klucz, default=None):
+    value = get_setting(klucz)
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,243 @@
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save
+
+
+def _acl_target(instance):
+    from .acl import acl_for_model
+
+    model = instance.content_type.model_class()
+    if acl_for_model(model) is None:
+        return None
+    return model, int(instance.object_pk), instance.permission.codename
+
+
+def _sync_acl_on_grant(sender, instance, created, **kwargs):
+    """Mirror a guardian user object permission into DocumentACL/FolderACL."""
+    from .acl import grant_acl_bit
+
+    target = _acl_target(instance)
+    if target is not None:
+        grant_acl_bit(instance.user_id, *target)
+
+
+def _sync_acl_on_revoke(sender, instance, **kwargs):
+    from .acl import revoke_acl_bit
+
+    target = _acl_target(instance)
+    if target is not None:
+        revoke_acl_bit(instance.user_id, *target)
+
+
+def _reindex_document(sender, instance, **kwargs):
+    from .search import index_document
+    index_document(instance)
+
+
+def _remove_document_from_index(sender, instance, **kwargs):
+    from .search import remove_document
+    remove_document(instance.pk)
+
+
+def _reindex_related_document(sender, instance, **kwargs):
+    """Metadata and versions are indexed as part of their document."""
+    from .models import Document
+    from .search import index_document
+    try:
+        document = instance.dokument
+    except Document.DoesNotExist:
+        return  # Deleted together with its document
+    index_document(document)
+
+
+def _reindex_on_tag_change(sender, instance, action, reverse, pk_set, **kwargs):
+    from .models import Document
+    from .search import index_document
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_document(instance)
+    else:
+        # tag.documents.add(...): ``pk_set`` holds document ids (None on clear)
+        documents = Document.objects.filter(pk__in=pk_set) if pk_set else instance.documents.all()
+        for document in documents:
+            index_document(document)
+
+
+def _reindex_tagged_documents(sender, instance, created, **kwargs):
+    from .search import index_document
+    if not created:
+        for document in instance.documents.all():
+            index_document(document)
+
+
+def _extract_version_text(sender, instance, created, **kwargs):
+    from .extraction import schedule_extraction
+    if created and instance.plik:
+        schedule_extraction(instance)
+
+
+def _remember_blob(sender, instance, **kwargs):
+    """Note the stored file name, so a later save can tell whether ``plik`` changed."""
+    plik = instance.__dict__.get('plik')
+    instance._stored_plik = getattr(plik, 'name', plik) or ''
+
+
+def _move_blob_reference(sender, instance, created, update_fields=None, **kwargs):
+    from .storage import add_blob_reference, release_blob_reference
+    if update_fields is not None and 'plik' not in update_fields:
+        return
+    old = '' if created else instance._stored_plik
+    new = instance.plik.name or ''
+    if new != old:
+        add_blob_reference(new)
+        release_blob_reference(old)
+        instance._stored_plik = new
+
+
+def _release_blob_reference(sender, instance, **kwargs):
+    from .storage import release_blob_reference
+    release_blob_reference(instance.plik.name or '')
+
+
+def _render_version_previews(sender, instance, created, **kwargs):
+    from .previews import schedule_previews
+    if created and instance.plik:
+        schedule_previews(instance)
+
+
+def _compact_superseded_versions(sender, instance, created, **kwargs):
+    from .chunked import schedule_compaction
+    if created:
+        schedule_compaction(instance)
+
+
+def _connect_acl_signals():
+    from guardian.models import UserObjectPermission
+
+    post_save.connect(_sync_acl_on_grant, sender=UserObjectPermission, dispatch_uid='acl_sync_grant')
+    post_delete.connect(_sync_acl_on_revoke, sender=UserObjectPermission, dispatch_uid='acl_sync_revoke')
+
+
+def _connect_search_signals():
+    from .models import Document, DocumentMetadata, DocumentVersion, Tag
+
+    post_save.connect(_reindex_document, sender=Document, dispatch_uid='search_index_document')
+    post_delete.connect(_remove_document_from_index, sender=Document, dispatch_uid='search_remove_document')
+    for model in (DocumentMetadata, DocumentVersion):
+        post_save.connect(_reindex_related_document, sender=model, dispatch_uid=f'search_save_{model.__name__}')
+        post_delete.connect(_reindex_related_document, sender=model, dispatch_uid=f'search_delete_{model.__name__}')
+    m2m_changed.connect(_reindex_on_tag_change, sender=Document.tagi.through, dispatch_uid='search_document_tags')
+    post_save.connect(_reindex_tagged_documents, sender=Tag, dispatch_uid='search_tag_rename')
+    post_save.connect(_extract_version_text, sender=DocumentVersion, dispatch_uid='search_extract_version_text')
+
+
+def _connect_blob_signals():
+    from .models import Document, DocumentVersion
+
+    for model in (Document, DocumentVersion):
+        post_init.connect(_remember_blob, sender=model, dispatch_uid=f'blob_remember_{model.__name__}')
+        post_save.connect(_move_blob_reference, sender=model, dispatch_uid=f'blob_reference_{model.__name__}')
+        post_delete.connect(_release_blob_reference, sender=model, dispatch_uid=f'blob_release_{model.__name__}')
+
+
+def _connect_preview_signals():
+    from .models import DocumentVersion
+
+    post_save.connect(_render_version_previews, sender=DocumentVersion, dispatch_uid='preview_render_version')
+
+
+def _connect_version_storage_signals():
+    from .models import DocumentVersion
+
+    post_save.connect(_compact_superseded_versions, sender=DocumentVersion, dispatch_uid='chunked_compact_versions')
+
+
+# Saving one of these changes what a document counts as in the statistics
+STATS_DOCUMENT_FIELDS = {'folder', 'wlasciciel', 'rozmiar_pliku', 'usunieto'}
+
+
+def _remember_stats_state(sender, instance, **kwargs):
+    from .models import Document
+    from .stats import document_state, folder_state
+    instance._stats_state = document_state(instance) if sender is Document else folder_state(instance)
+
+
+def _load_stats_state(sender, instance, **kwargs):
+    """A partially loaded instance did not know its state: read it before the save changes it."""
+    from .models import Document
+    from .stats import document_state, folder_state
+    if instance._stats_state is not ... or instance.pk is None:
+        return
+    stored = sender.objects.filter(pk=instance.pk).first()
+    if stored is None:
+        instance._stats_state = None
+    else:
+        instance._stats_state = document_state(stored) if sender is Document else folder_state(stored)
+
+
+def _update_document_stats(sender, instance, created, update_fields=None, **kwargs):
+    from .stats import document_changed, document_state
+    if update_fields is not None and not STATS_DOCUMENT_FIELDS & set(update_fields):
+        return
+    new = document_state(instance)
+    document_changed(None if created else instance._stats_state, new)
+    instance._stats_state = new
+
+
+def _remove_document_stats(sender, instance, **kwargs):
+    from .stats import document_changed
+    if instance._stats_state is not ...:  # Unknown for a partially loaded instance: rebuild_stats repairs it
+        document_changed(instance._stats_state, None)
+
+
+def _touch_version_stats(sender, instance, **kwargs):
+    from .stats import document_touched
+    document_touched(instance.dokument_id)
+
+
+def _update_folder_stats(sender, instance, created, **kwargs):
+    from .stats import folder_changed, folder_state
+    folder_changed(instance, instance._stats_state, created=created)
+    instance._stats_state = folder_state(instance)
+
+
+def _remove_folder_stats(sender, instance, **kwargs):
+    from .stats import folder_deleted
+    if instance._stats_state is not ...:
+        folder_deleted(instance._stats_state)
+
+
+def _invalidate_system_settings(sender, **kwargs):
+    from .settings_cache import invalidate_settings
+    invalidate_settings()
+
+
+def _connect_stats_signals():
+    from .models import Document, DocumentVersion, Folder
+
+    for model in (Document, Folder):
+        post_init.connect(_remember_stats_state, sender=model, dispatch_uid=f'stats_remember_{model.__name__}')
+        pre_save.connect(_load_stats_state, sender=model, dispatch_uid=f'stats_load_{model.__name__}')
+    post_save.connect(_update_document_stats, sender=Document, dispatch_uid='stats_save_document')
+    # Before the delete: a cascade removes folders and documents in no set order,
+    # and a document's ancestors are needed to subtract its size from them.
+    pre_delete.connect(_remove_document_stats, sender=Document, dispatch_uid='stats_delete_document')
+    post_save.connect(_update_folder_stats, sender=Folder, dispatch_uid='stats_save_folder')
+    pre_delete.connect(_remove_folder_stats, sender=Folder, dispatch_uid='stats_delete_folder')
+    post_save.connect(_touch_version_stats, sender=DocumentVersion, dispatch_uid='stats_save_version')
+    post_delete.connect(_touch_version_stats, sender=DocumentVersion, dispatch_uid='stats_delete_version')
+
+
+def _connect_settings_signals():
+    from .models import SystemSettings
+
+    post_save.connect(_invalidate_system_settings, sender=SystemSettings, dispatch_uid='settings_cache_save')
+    post_delete.connect(_invalidate_system_settings, sender=SystemSettings, dispatch_uid='settings_cache_delete')
+
+
+_connect_acl_signals()
+_connect_search_signals()
+_connect_blob_signals()
+_connect_preview_signals()
+_connect_version_storage_signals()
+_connect_settings_signals()
+_connect_stats_signals()
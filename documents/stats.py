@@ -0,0 +1,242 @@
+"""
+Precomputed folder and user statistics.
+
+FolderStats holds, for every folder, its direct (not deleted) documents and
+subfolders, the total size of the documents in its whole subtree and when
+something in it last changed; UserStats the same totals for what a user
+owns. Signals (documents.signals) apply each save and delete as F()
+deltas, so concurrent changes add up instead of overwriting each other,
+and the folder listing and the dashboard read the counters instead of
+aggregating.
+
+Changes that bypass signals (bulk_create, queryset update()/delete(), raw
+SQL) leave the counters stale: ``manage.py rebuild_stats`` recomputes them.
+"""
+from collections import Counter, defaultdict
+
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+
+
+# --- Deltas ---
+
+def document_state(document):
+    """
+    ``(folder_id, owner_id, size)`` a document counts as, None when it does
+    not count (deleted). Read from the instance's loaded fields only;
+    ``...`` when one of them is deferred.
+    """
+    values = document.__dict__
+    if any(field not in values for field in ('folder_id', 'wlasciciel_id', 'rozmiar_pliku', 'usunieto')):
+        return ...
+    if values['usunieto']:
+        return None
+    return values['folder_id'], values['wlasciciel_id'], values['rozmiar_pliku'] or 0
+
+
+def folder_state(folder):
+    """``(parent_id, owner_id)`` of a folder from its loaded fields, ``...`` when deferred."""
+    values = folder.__dict__
+    if any(field not in values for field in ('rodzic_id', 'wlasciciel_id')):
+        return ...
+    return values['rodzic_id'], values['wlasciciel_id']
+
+
+def _path_ids(sciezka):
+    return [int(part) for part in sciezka.strip('/').split('/') if part]
+
+
+def _folder_paths(folder_ids):
+    """``{folder_id: [ids of the folder and its ancestors]}`` for the folders that still exist."""
+    from .models import Folder
+
+    folder_ids = {pk for pk in folder_ids if pk}
+    if not folder_ids:
+        return {}
+    return {pk: _path_ids(sciezka) or [pk] for pk, sciezka in Folder.objects.filter(pk__in=folder_ids).values_list('pk', 'sciezka')}
+
+
+def _apply(model, owner_model, deltas, now):
+    """
+    Add ``deltas`` (``{pk: Counter(field=delta)}``) to the stats rows of
+    ``model`` and mark them active at ``now``. Rows missing for an existing
+    folder or user are created from the deltas.
+    """
+    groups = defaultdict(list)
+    for pk, counter in deltas.items():
+        groups[frozenset((field, delta) for field, delta in counter.items() if delta)].append(pk)
+    for changes, pks in groups.items():
+        values = {field: F(field) + delta for field, delta in changes}
+        values['ostatnia_aktywnosc'] = now
+        if model.objects.filter(pk__in=pks).update(**values) == len(pks):
+            continue
+        missing = set(pks) - set(model.objects.filter(pk__in=pks).values_list('pk', flat=True))
+        alive = owner_model.objects.filter(pk__in=missing).values_list('pk', flat=True)
+        model.objects.bulk_create(
+            [model(pk=pk, ostatnia_aktywnosc=now, **{field: max(delta, 0) for field, delta in changes}) for pk in alive],
+            ignore_conflicts=True,
+        )
+
+
+def _apply_all(folder_deltas, user_deltas):
+    from django.contrib.auth.models import User
+    from .models import Folder, FolderStats, UserStats
+
+    now = timezone.now()
+    _apply(FolderStats, Folder, folder_deltas, now)
+    _apply(UserStats, User, user_deltas, now)
+
+
+def _document_deltas(states):
+    """``(folder_deltas, user_deltas)`` for ``(state, sign)`` pairs of document states."""
+    folder_deltas, user_deltas = defaultdict(Counter), defaultdict(Counter)
+    states = [(state, sign) for state, sign in states if state]
+    paths = _folder_paths(state[0] for state, _ in states)
+    for (folder_id, owner_id, size), sign in states:
+        if folder_id in paths:
+            folder_deltas[folder_id]['liczba_dokumentow'] += sign
+            for pk in paths[folder_id]:
+                folder_deltas[pk]['rozmiar_calkowity'] += sign * size
+        user_deltas[owner_id]['liczba_dokumentow'] += sign
+        user_deltas[owner_id]['rozmiar_calkowity'] += sign * size
+    return folder_deltas, user_deltas
+
+
+def document_changed(old, new):
+    """
+    Move a document's contribution from state ``old`` to ``new`` (see
+    document_state). Its folders and owner are marked active even when
+    nothing counted changed.
+    """
+    _apply_all(*_document_deltas([(old, -1), (new, 1)]))
+
+
+def documents_added(states):
+    """Count many new documents at once (their document_state), e.g. after bulk_create."""
+    _apply_all(*_document_deltas([(state, 1) for state in states]))
+
+
+def document_touched(document_id):
+    """Mark the folders and owner of a document active, e.g. after a new version."""
+    from .models import Document
+
+    row = Document.objects.filter(pk=document_id).values_list('folder_id', 'wlasciciel_id').first()
+    if row is None:
+        return  # Deleted together with its versions
+    folder_id, owner_id = row
+    folder_deltas = {pk: Counter() for pk in _folder_paths([folder_id]).get(folder_id, [])}
+    _apply_all(folder_deltas, {owner_id: Counter()})
+
+
+def folder_changed(folder, old, created=False):
+    """Apply a folder's creation, move or change of owner; ``old`` is its folder_state before."""
+    from .models import FolderStats
+
+    parent_id, owner_id = folder_state(folder)
+    folder_deltas, user_deltas = defaultdict(Counter), defaultdict(Counter)
+    if created:
+        folder_deltas[folder.pk] = Counter()
+        if parent_id:
+            folder_deltas[parent_id]['liczba_podfolderow'] += 1
+        user_deltas[owner_id]['liczba_folderow'] += 1
+        _apply_all(folder_deltas, user_deltas)
+        return
+
+    old_parent_id, old_owner_id = old
+    if old_parent_id != parent_id:
+        # The whole subtree's size moves from the old ancestors to the new ones
+        size = FolderStats.objects.filter(pk=folder.pk).values_list('rozmiar_calkowity', flat=True).first() or 0
+        paths = _folder_paths([old_parent_id, parent_id])
+        for pk in paths.get(old_parent_id, []):
+            folder_deltas[pk]['rozmiar_calkowity'] -= size
+        for pk in paths.get(parent_id, []):
+            folder_deltas[pk]['rozmiar_calkowity'] += size
+        if old_parent_id:
+            folder_deltas[old_parent_id]['liczba_podfolderow'] -= 1
+        if parent_id:
+            folder_deltas[parent_id]['liczba_podfolderow'] += 1
+    if old_owner_id != owner_id:
+        user_deltas[old_owner_id]['liczba_folderow'] -= 1
+        user_deltas[owner_id]['liczba_folderow'] += 1
+    if folder_deltas or user_deltas:
+        _apply_all(folder_deltas, user_deltas)
+
+
+def folder_deleted(state):
+    """Apply the deletion of a folder with folder_state ``state``; its documents are applied one by one."""
+    parent_id, owner_id = state
+    folder_deltas, user_deltas = defaultdict(Counter), defaultdict(Counter)
+    if parent_id:
+        folder_deltas[parent_id]['liczba_podfolderow'] -= 1
+    user_deltas[owner_id]['liczba_folderow'] -= 1
+    _apply_all(folder_deltas, user_deltas)
+
+
+# --- Reconciliation ---
+
+FOLDER_FIELDS = ('liczba_dokumentow', 'liczba_podfolderow', 'rozmiar_calkowity')
+USER_FIELDS = ('liczba_dokumentow', 'liczba_folderow', 'rozmiar_calkowity')
+
+
+def compute_stats():
+    """
+    Expected ``({folder_id: (documents, subfolders, size, last_change)},
+    {user_id: (documents, folders, size, last_change)})`` aggregated from
+    scratch.
+    """
+    from .models import Document, Folder
+
+    documents = Document.objects.filter(usunieto=False).order_by()
+    paths = {pk: _path_ids(sciezka) or [pk] for pk, sciezka in Folder.objects.values_list('pk', 'sciezka')}
+    folders = {pk: [0, 0, 0, None] for pk in paths}
+    for parent_id, count in Folder.objects.filter(rodzic__isnull=False).order_by().values_list('rodzic').annotate(Count('pk')):
+        folders[parent_id][1] = count
+    rows = documents.filter(folder__isnull=False).values_list('folder').annotate(Count('pk'), Sum('rozmiar_pliku'), Max('ostatnia_modyfikacja'))
+    for folder_id, count, size, changed in rows:
+        folders[folder_id][0] = count
+        for pk in paths[folder_id]:
+            totals = folders[pk]
+            totals[2] += size or 0
+            totals[3] = max(totals[3], changed) if totals[3] else changed
+
+    users = defaultdict(lambda: [0, 0, 0, None])  # Only users owning something: no row reads as zeros
+    for owner_id, count, size, changed in documents.values_list('wlasciciel').annotate(Count('pk'), Sum('rozmiar_pliku'), Max('ostatnia_modyfikacja')):
+        users[owner_id][0], users[owner_id][2], users[owner_id][3] = count, size or 0, changed
+    for owner_id, count in Folder.objects.order_by().values_list('wlasciciel').annotate(Count('pk')):
+        users[owner_id][1] = count
+    return ({pk: tuple(values) for pk, values in folders.items()},
+            {pk: tuple(values) for pk, values in users.items()})
+
+
+def _reconcile(model, expected, fields, dry_run):
+    """Bring the rows of ``model`` to ``expected``; returns (missing, wrong) row counts."""
+    rows = model.objects.in_bulk()
+    missing = [pk for pk in expected if pk not in rows]
+    wrong = []
+    for pk, row in rows.items():
+        values = expected.get(pk, (0, 0, 0, None))
+        if tuple(getattr(row, field) for field in fields) == values[:3]:
+            continue
+        for field, value in zip(fields, values):
+            setattr(row, field, value)
+        if values[3] and (row.ostatnia_aktywnosc is None or row.ostatnia_aktywnosc < values[3]):
+            row.ostatnia_aktywnosc = values[3]
+        wrong.append(row)
+    if not dry_run:
+        model.objects.bulk_create(
+            [model(pk=pk, ostatnia_aktywnosc=expected[pk][3], **dict(zip(fields, expected[pk]))) for pk in missing],
+            batch_size=500,
+        )
+        model.objects.bulk_update(wrong, [*fields, 'ostatnia_aktywnosc'], batch_size=500)
+    return len(missing), len(wrong)
+
+
+def rebuild_stats(dry_run=False):
+    """Recompute every FolderStats and UserStats row; returns ``{table: (missing, wrong)}``."""
+    from .models import FolderStats, UserStats
+
+    folders, users = compute_stats()
+    return {
+        FolderStats._meta.db_table: _reconcile(FolderStats, folders, FOLDER_FIELDS, dry_run),
+        UserStats._meta.db_table: _reconcile(UserStats, users, USER_FIELDS, dry_run),
+    }
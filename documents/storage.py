@@ -0,0 +1,343 @@
+"""
+Content-addressed storage for document files.
+
+Document.plik and DocumentVersion.plik are stored under
+``blobs/<aa>/<bb>/<sha256><ext>``: the name is derived from the content, so
+re-uploading identical bytes (an unchanged version, the same attachment in
+several folders) writes nothing and every row shares one file. The
+extension is kept in the name because downloads, previews and text
+extraction go by it. Uploads fingerprinted by the handlers in
+documents.uploads are not read again: known content is skipped and a spooled
+temporary file is moved into place.
+
+Each stored file has a Blob row whose ``liczba_odwolan`` counts the Document
+and DocumentVersion rows pointing at it; the receivers in documents.signals
+keep it current. A blob is never deleted when its count drops to zero, only
+by ``manage.py gc_blobs`` once it has stayed unreferenced for
+BLOB_GC_GRACE_HOURS, after re-checking that no row uses it. Storing content
+that is already there restarts the grace period of its blob (touch_blob)
+before the file is looked at, so an upload that reuses a file is safe until
+its row is saved.
+
+``manage.py dedupe_media`` moves files stored under the old per-upload paths
+into the store.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+BLOB_PREFIX = 'blobs/'
+_EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,10}$')
+
+
+def blob_name(digest, original_name=''):
+    """Storage name of the blob with SHA-256 ``digest``, keeping the extension of ``original_name``."""
+    extension = os.path.splitext(original_name)[1].lower()
+    if not _EXTENSION_RE.match(extension):
+        extension = ''
+    return f'{BLOB_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX)
+
+
+def blob_digest(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names files by the SHA-256 of their content."""
+
+    def get_available_name(self, name, max_length=None):
+        return name  # _save derives the final name from the content
+
+    def _save(self, name, content):
+        digest = getattr(content, 'digest', None)  # Attached by documents.uploads
+        if digest is None:
+            return self._save_hashing(name, content)
+
+        name = blob_name(digest.sha256, name)
+        full_path = self.path(name)
+        touch_blob(name)  # Before looking at the file: see touch_blob
+        if os.path.exists(full_path):
+            return name  # Same content is already stored: nothing to read or write
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if hasattr(content, 'temporary_file_path'):
+            file_move_safe(content.temporary_file_path(), full_path)
+        else:
+            fd, tmp_path = self._temp_file()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.replace(tmp_path, full_path)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    def _temp_file(self):
+        tmp_dir = self.path(BLOB_PREFIX + 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return tempfile.mkstemp(dir=tmp_dir)
+
+    def _save_hashing(self, name, content):
+        digest = hashlib.sha256()
+        fd, tmp_path = self._temp_file()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            name = blob_name(digest.hexdigest(), name)
+            full_path = self.path(name)
+            touch_blob(name)
+            if os.path.exists(full_path):
+                os.remove(tmp_path)  # Same content is already stored
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.replace(tmp_path, full_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def get_blob_storage():
+    return blob_storage
+
+
+# --- Reference counting ---
+
+def add_blob_reference(name, count=1):
+    from .models import Blob
+
+    if not is_blob(name):
+        return
+    with transaction.atomic():
+        blob, created = Blob.objects.get_or_create(
+            sciezka=name,
+            defaults={
+                'hash_pliku': blob_digest(name),
+                'rozmiar': blob_storage.size(name) if blob_storage.exists(name) else 0,
+                'liczba_odwolan': count,
+            },
+        )
+        if not created:
+            Blob.objects.filter(pk=blob.pk).update(
+                liczba_odwolan=F('liczba_odwolan') + count, ostatnia_zmiana=timezone.now()
+            )
+
+
+def add_blob_references(counts):
+    """add_blob_reference for many blobs at once: ``counts`` is ``{name: count}``."""
+    from collections import defaultdict
+    from .models import Blob
+
+    counts = {name: count for name, count in counts.items() if is_blob(name) and count}
+    if not counts:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        Blob.objects.bulk_create([
+            Blob(sciezka=name, hash_pliku=blob_digest(name),
+                 rozmiar=blob_storage.size(name) if blob_storage.exists(name) else 0)
+            for name in counts
+        ], ignore_conflicts=True)
+        by_count = defaultdict(list)
+        for name, count in counts.items():
+            by_count[count].append(name)
+        for count, names in by_count.items():
+            Blob.objects.filter(sciezka__in=names).update(liczba_odwolan=F('liczba_odwolan') + count, ostatnia_zmiana=now)
+
+
+def touch_blob(name):
+    """
+    Restart the GC grace period of blob ``name``, which an upload is about to
+    reference again. The update waits for a collect_garbage transaction
+    deleting the blob, which removes the file before it commits: a file still
+    there afterwards is safe to reuse.
+    """
+    from .models import Blob
+
+    Blob.objects.filter(sciezka=name).update(ostatnia_zmiana=timezone.now())
+
+
+def release_blob_reference(name, count=1):
+    from django.db.models.functions import Greatest
+    from .models import Blob
+
+    if is_blob(name):
+        Blob.objects.filter(sciezka=name, liczba_odwolan__gt=0).update(
+            liczba_odwolan=Greatest(F('liczba_odwolan') - count, 0), ostatnia_zmiana=timezone.now()
+        )
+
+
+def blob_references():
+    """``{name: count}`` of blob references actually held by Document and DocumentVersion rows."""
+    from django.db.models import Count
+    from .models import Document, DocumentVersion
+
+    counts = {}
+    for model in (Document, DocumentVersion):
+        rows = (model.objects.filter(plik__startswith=BLOB_PREFIX)
+                .order_by().values_list('plik').annotate(n=Count('pk')))
+        for name, n in rows:
+            counts[name] = counts.get(name, 0) + n
+    return counts
+
+
+def recount_blob_references():
+    """Reset every Blob count from the real references. Returns the number of corrected rows."""
+    from .models import Blob
+
+    actual = blob_references()
+    fixed = 0
+    with transaction.atomic():
+        for blob in Blob.objects.select_for_update().iterator(chunk_size=2000):
+            count = actual.pop(blob.sciezka, 0)
+            if count != blob.liczba_odwolan:
+                Blob.objects.filter(pk=blob.pk).update(liczba_odwolan=count, ostatnia_zmiana=timezone.now())
+                fixed += 1
+        for name, count in actual.items():
+            add_blob_reference(name, count)
+            fixed += 1
+    return fixed
+
+
+def collect_garbage(grace=None, dry_run=False):
+    """
+    Delete blobs that have been unreferenced for longer than ``grace``
+    (default BLOB_GC_GRACE_HOURS). Returns ``(blobs, bytes)`` removed.
+    """
+    from .models import Blob, Document, DocumentVersion
+
+    if grace is None:
+        grace = timedelta(hours=getattr(settings, 'BLOB_GC_GRACE_HOURS', 24))
+    cutoff = timezone.now() - grace
+    candidates = Blob.objects.filter(liczba_odwolan=0, ostatnia_zmiana__lt=cutoff)
+    removed = freed = 0
+    for blob in candidates.iterator(chunk_size=1000):
+        with transaction.atomic():
+            # The count is only a hint: re-check the tables before deleting.
+            if (Document.objects.filter(plik=blob.sciezka).exists()
+                    or DocumentVersion.objects.filter(plik=blob.sciezka).exists()):
+                continue
+            if dry_run:
+                removed += 1
+                freed += blob.rozmiar
+                continue
+            # Referenced or reused (touch_blob) since the candidates were listed
+            if not Blob.objects.filter(pk=blob.pk, liczba_odwolan=0, ostatnia_zmiana__lt=cutoff).delete()[0]:
+                continue
+            # Removed while the deletion holds the row, not after the commit:
+            # an upload touching the blob meanwhile waits and then finds no
+            # file, so it writes the content again.
+            blob_storage.delete(blob.sciezka)
+        removed += 1
+        freed += blob.rozmiar
+    return removed, freed
+
+
+# --- Old versions stored in another form (documents.chunked, documents.tiering) ---
+
+def superseded_versions():
+    """
+    Versions stored whole that have a newer version and whose blob no
+    document and no latest version uses.
+    """
+    from django.db.models import Exists, OuterRef
+    from .models import Document, DocumentVersion
+
+    newer = DocumentVersion.objects.filter(dokument=OuterRef('dokument'), numer_wersji__gt=OuterRef('numer_wersji'))
+    latest = DocumentVersion.objects.filter(~Exists(newer), plik__startswith=BLOB_PREFIX)
+    return (DocumentVersion.objects
+            .filter(Exists(newer), sposob_przechowywania=DocumentVersion.STORAGE_WHOLE, plik__startswith=BLOB_PREFIX)
+            .exclude(plik__in=Document.objects.filter(plik__startswith=BLOB_PREFIX).values('plik'))
+            .exclude(plik__in=latest.values('plik')))
+
+
+def repoint_versions(name, target, sposob_przechowywania):
+    """
+    Point the versions stored as the whole blob ``name`` at the blob
+    ``target`` holding the same content in another form. Returns the number
+    of versions changed: 0 when ``name`` is no longer only used by
+    superseded_versions. Goes around save() and its signals: the content
+    and the search index do not change.
+    """
+    from .models import DocumentVersion
+
+    with transaction.atomic():
+        if not superseded_versions().filter(plik=name).exists():
+            return 0
+        count = DocumentVersion.objects.filter(plik=name).update(plik=target, sposob_przechowywania=sposob_przechowywania)
+        add_blob_reference(target, count)
+        release_blob_reference(name, count)
+    return count
+
+
+# --- Migrating files stored before the blob store ---
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def move_into_store(name, dry_run=False):
+    """
+    Point every Document/DocumentVersion using the legacy file ``name`` at its
+    blob, linking the file into the store unless identical content is already
+    there. The legacy file is removed after commit.
+
+    Returns ``(blob_name, size, stored)`` where ``stored`` tells whether the
+    content was new to the store, or ``None`` if the file is missing.
+    """
+    from .models import Document, DocumentVersion
+
+    source = blob_storage.path(name)
+    if not os.path.isfile(source):
+        return None
+    digest = file_digest(source)
+    target_name = blob_name(digest, name)
+    target = blob_storage.path(target_name)
+    stored = not os.path.exists(target)
+    size = os.path.getsize(source)
+    if dry_run:
+        return target_name, size, stored
+
+    if stored:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)  # No copy on the same filesystem
+        except OSError:
+            with open(source, 'rb') as f:
+                blob_storage.save(target_name, f)
+    with transaction.atomic():
+        references = 0
+        for model in (Document, DocumentVersion):
+            rows = model.objects.filter(plik=name)
+            rows.filter(hash_pliku='').update(hash_pliku=digest)
+            references += rows.update(plik=target_name)
+        add_blob_reference(target_name, references)
+        transaction.on_commit(lambda: blob_storage.delete(name))
+    return target_name, size, stored
@@ -7,4 +7,16 @@ register = template.Library()
 @register.simple_tag
 def get_setting(key, default=None):
     """Template tag do pobierania ustawień systemowych"""
-    return SystemSettings.get_setting(key, default)
\ No newline at end of file
+    return SystemSettings.get_setting(key, default)
+
+
+@register.simple_tag
+def get_setting_bool(key, default=False):
+    """Ustawienie jako wartość logiczna (1/true/tak/on)"""
+    return SystemSettings.get_bool(key, default)
+
+
+@register.simple_tag
+def get_setting_int(key, default=None):
+    """Ustawienie jako liczba całkowita"""
+    return SystemSettings.get_int(key, default)
@@ -1,3 +1,1641 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Sum
+from django.template import Context, Template
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from guardian.shortcuts import assign_perm, remove_perm
+
+from users.models import Role
+
+from . import activity
+from .activity import ActivityLogWriter, export_activity_logs, log_activity
+from .chunked import CHUNK_MAX_SIZE, CHUNK_MIN_SIZE, chunk_boundaries, chunk_name, open_chunked
+from .comments import load_comment_thread
+from .extraction import (STATUS_LIMIT, STATUS_OK, extract_docx, extract_file,
+                         extract_pdf, extract_xlsx)
+from .models import (ActivityDailyRollup, ActivityLog, Blob, CacheGeneration, Comment, Document, DocumentACL,
+                     DocumentMetadata, DocumentVersion, DocumentVersionText, Folder, FolderStats, SystemSettings, Tag,
+                     UploadSession, UserStats)
+from .search import analyze, search_documents
+from .settings_cache import SETTINGS_GENERATION_KEY, bump_settings_generation
+from .storage import blob_storage
+from .previews import THUMBNAIL_SIZES, enforce_quota, preview_name, read_text_page
+from .uploads import _Fingerprint, sniff_mime
+from .tree import get_folder_ancestors, load_folder_tree
+from .versions import inconsistent_documents, latest_version_id
+from .zip_stream import stream_zip
+
+
+class MediaRootMixin:
+    """Run the test case against a throwaway MEDIA_ROOT."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._media_root = tempfile.mkdtemp()
+        cls._media_override = override_settings(MEDIA_ROOT=cls._media_root)
+        cls._media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_override.disable()
+        shutil.rmtree(cls._media_root, ignore_errors=True)
+
+
+def create_document(owner, nazwa, content=b'tresc', folder=None):
+    """Create a document with its first version, like DocumentUploadView."""
+    document = Document.objects.create(
+        nazwa=nazwa,
+        wlasciciel=owner,
+        folder=folder,
+        plik=SimpleUploadedFile(nazwa, content),
+        rozmiar_pliku=len(content),
+    )
+    document.add_first_version(owner, oryginalna_nazwa_pliku=nazwa)
+    return document
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class FolderZipDownloadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'haslo12345')
+        self.client.force_login(self.user)
+        self.root = Folder.objects.create(nazwa='Projekt', wlasciciel=self.user)
+        self.child = Folder.objects.create(nazwa='Umowy', rodzic=self.root, wlasciciel=self.user)
+        create_document(self.user, 'notatka.txt', b'pierwszy plik', folder=self.root)
+        create_document(self.user, 'umowa.txt', b'drugi plik', folder=self.child)
+
+    def test_zip_is_streamed_with_folder_tree(self):
+        response = self.client.get(reverse('documents:folder_download_zip', args=[self.root.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('Projekt/notatka.txt'), b'pierwszy plik')
+        self.assertEqual(archive.read('Projekt/Umowy/umowa.txt'), b'drugi plik')
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class FileDeliveryTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        cache.clear()  # No delivery log throttled by an earlier test
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'haslo12345')
+        self.client.force_login(self.user)
+        self.document = create_document(self.user, 'Umowa źródłowa.pdf', b'%PDF-1.4 umowa')
+        self.url = reverse('documents:document_download', args=[self.document.pk])
+
+    def test_file_response_streams_from_worker(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 umowa')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'],
+                         "attachment; filename=\"Umowa rdowa_v1.pdf\"; filename*=UTF-8''Umowa%20%C5%BAr%C3%B3d%C5%82owa_v1.pdf")
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+
+    @override_settings(PROTECTED_FILE_DELIVERY='documents.delivery.XAccelRedirectBackend')
+    def test_x_accel_redirect_hands_transfer_to_proxy(self):
+        version = self.document.wersje.get()
+        response = self.client.get(reverse('documents:document_version_download', args=[self.document.pk, version.pk]))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/' + version.plik.name)
+        self.assertEqual(response.content, b'')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment;'))
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+
+    @override_settings(PROTECTED_FILE_DELIVERY='documents.delivery.XSendfileBackend')
+    def test_x_sendfile_and_inline_preview(self):
+        response = self.client.get(reverse('documents:document_preview', args=[self.document.pk]))
+        self.assertEqual(response['X-Sendfile'], self.document.plik.path)
+        self.assertEqual((response['Content-Type'], response['X-Content-Type-Options']), ('application/pdf', 'nosniff'))
+        self.assertTrue(response['Content-Disposition'].startswith('inline;'))
+
+    def test_conditional_get_answers_304_without_the_file(self):
+        version = self.document.wersje.get()
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(etag, f'"{version.hash_pliku}"')
+        os.remove(version.plik.path)  # A 304 must not need the file at all
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+        last_modified = response['Last-Modified']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"inny"').status_code, 404)
+        # 304s deliver nothing and are not logged
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+
+    def test_byte_ranges(self):
+        content = b'%PDF-1.4 umowa'
+        response = self.client.get(self.url, HTTP_RANGE='bytes=9-')
+        self.assertEqual((response.status_code, response['Content-Range'], response['Content-Length']),
+                         (206, 'bytes 9-13/14', '5'))
+        self.assertEqual(b''.join(response.streaming_content), b'umowa')
+        self.assertEqual(b''.join(self.client.get(self.url, HTTP_RANGE='bytes=-5').streaming_content), b'umowa')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-3, 2-4, 9-10')
+        body = b''.join(response.streaming_content)
+        boundary = response['Content-Type'].split('boundary=')[1]
+        self.assertEqual((response.status_code, int(response['Content-Length'])), (206, len(body)))
+        parts = body.split(f'--{boundary}'.encode())[1:-1]
+        self.assertEqual([part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts], [content[0:5], content[9:11]])
+        self.assertIn(b'Content-Range: bytes 0-4/14', parts[0])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */14'))
+        # A stale If-Range gets the whole, current file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=9-', HTTP_IF_RANGE='"stary"')
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, content))
+        # Logged once, for the first fetch, although it did not start at byte 0
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+
+    def test_every_ranged_fetch_is_audited_once_per_window(self):
+        self.client.get(self.url, HTTP_RANGE='bytes=1-')
+        self.client.get(self.url, HTTP_RANGE='bytes=1-')
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+        with override_settings(DELIVERY_LOG_THROTTLE_SECONDS=0):
+            self.client.get(self.url, HTTP_RANGE='bytes=1-')
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 2)
+
+    def test_permission_is_checked_before_delivery(self):
+        reader = User.objects.create_user('reader', 'reader@example.com', 'haslo12345')
+        self.client.force_login(reader)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_loadtest_command(self):
+        out = io.StringIO()
+        call_command('loadtest_downloads', '--clients', '4', '--size-mb', '1', '--workers', '2',
+                     '--client-mb-per-s', '100', stdout=out)
+        self.assertIn('x-accel: worker busy', out.getvalue())
+
+
+class StreamZipBenchmark(TestCase):
+    """Compare the streaming writer with the previous BytesIO approach.
+
+    Peak memory is measured with tracemalloc (Python allocations, which is
+    what the old code held twice) rather than process RSS, which is too noisy
+    inside a shared test runner.
+    """
+    FILE_COUNT = 500
+    FILE_SIZE = 32 * 1024
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tree = tempfile.mkdtemp()
+        cls.entries = []
+        for i in range(cls.FILE_COUNT):
+            subdir = os.path.join(cls.tree, f'folder_{i % 10}')
+            os.makedirs(subdir, exist_ok=True)
+            path = os.path.join(subdir, f'plik_{i}.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(cls.FILE_SIZE))
+            cls.entries.append((path, os.path.relpath(path, cls.tree)))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tree, ignore_errors=True)
+        super().tearDownClass()
+
+    def _buffered(self):
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for path, arcname in self.entries:
+                zipf.write(path, arcname)
+        yield zip_buffer.getvalue()
+
+    def _measure(self, generator_factory):
+        tracemalloc.start()
+        started = time.perf_counter()
+        chunks = generator_factory()
+        first = next(chunks)
+        ttfb = time.perf_counter() - started
+        total = len(first)
+        for chunk in chunks:
+            total += len(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return ttfb, peak, total
+
+    def test_streaming_uses_less_memory_and_starts_sooner(self):
+        buffered_ttfb, buffered_peak, buffered_size = self._measure(self._buffered)
+        streamed_ttfb, streamed_peak, streamed_size = self._measure(lambda: stream_zip(self.entries))
+
+        self.assertGreater(streamed_size, self.FILE_COUNT * self.FILE_SIZE)
+        self.assertLess(streamed_peak, buffered_peak / 10)
+        self.assertLess(streamed_ttfb, buffered_ttfb)
+
+
+class FolderTreeLoaderTests(TestCase):
+    DEPTH = 5
+    DOCUMENTS = 1000
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+
+    def _build_tree(self, depth, documents_total):
+        root = Folder.objects.create(nazwa='root', wlasciciel=self.user)
+        level = [root]
+        folders = [root]
+        for depth_index in range(1, depth):
+            next_level = []
+            for parent in level:
+                for i in range(2):
+                    next_level.append(Folder.objects.create(
+                        nazwa=f'f{depth_index}_{i}', rodzic=parent, wlasciciel=self.user
+                    ))
+            folders.extend(next_level)
+            level = next_level
+
+        documents = Document.objects.bulk_create([
+            Document(nazwa=f'doc_{i}.txt', wlasciciel=self.user, folder=folders[i % len(folders)])
+            for i in range(documents_total)
+        ])
+        DocumentVersion.objects.bulk_create([
+            DocumentVersion(dokument=doc, numer_wersji=number, utworzony_przez=self.user,
+                            plik=f'document_versions/{doc.pk}_{number}.txt')
+            for doc in documents for number in (1, 2)
+        ])
+        Document.objects.update(aktualna_wersja=latest_version_id())
+        return root, folders
+
+    def test_query_count_does_not_depend_on_tree_size(self):
+        small_root, _ = self._build_tree(depth=2, documents_total=3)
+        with self.assertNumQueries(2):
+            small_tree = load_folder_tree(small_root)
+        self.assertEqual(len(list(small_tree.all_documents())), 3)
+
+        root, folders = self._build_tree(depth=self.DEPTH, documents_total=self.DOCUMENTS)
+        with self.assertNumQueries(2):
+            tree = load_folder_tree(root)
+            walked = list(tree.walk())
+            documents = list(tree.all_documents())
+            latest = {doc.latest_version.numer_wersji for doc in documents}
+
+        self.assertEqual(len(walked), len(folders))
+        self.assertEqual(max(path.count(os.sep) for _, path in walked), self.DEPTH - 1)
+        self.assertEqual(len(documents), self.DOCUMENTS)
+        self.assertEqual(latest, {2})
+
+    def test_ancestors_are_loaded_in_one_query(self):
+        _, folders = self._build_tree(depth=self.DEPTH, documents_total=0)
+        leaf = Folder.objects.get(pk=folders[-1].pk)
+
+        with self.assertNumQueries(1):
+            chain = get_folder_ancestors(leaf)
+            full_path = leaf.get_full_path()
+
+        self.assertEqual(len(chain), self.DEPTH)
+        self.assertIsNone(chain[0].rodzic_id)
+        self.assertEqual(full_path, ' / '.join(f.nazwa for f in chain))
+
+
+class FolderMaterializedPathTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.a = Folder.objects.create(nazwa='A', wlasciciel=self.user)
+        self.b = Folder.objects.create(nazwa='B', rodzic=self.a, wlasciciel=self.user)
+        self.c = Folder.objects.create(nazwa='C', rodzic=self.b, wlasciciel=self.user)
+        self.other = Folder.objects.create(nazwa='Inny', wlasciciel=self.user)
+
+    def test_path_is_set_on_create(self):
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.sciezka, f'/{self.a.pk}/{self.b.pk}/{self.c.pk}/')
+        self.assertEqual(self.c.get_full_path(), 'A / B / C')
+        self.assertEqual(self.c.poziom, 2)
+        self.assertEqual(self.c.get_ancestor_ids(), [self.a.pk, self.b.pk])
+
+    def test_move_and_rename_update_subtree(self):
+        self.b.rodzic = self.other
+        self.b.nazwa = 'B2'
+        self.b.save()
+
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.sciezka, f'/{self.other.pk}/{self.b.pk}/{self.c.pk}/')
+        self.assertEqual(self.c.get_full_path(), 'Inny / B2 / C')
+        self.assertEqual(list(self.other.get_descendants()), [self.b, self.c])
+        self.assertEqual(list(self.a.get_descendants()), [])
+
+    def test_moving_into_own_subtree_is_rejected(self):
+        self.a.rodzic = self.c
+        with self.assertRaises(ValidationError):
+            self.a.full_clean()
+        with self.assertRaises(IntegrityError):
+            self.a.save()
+
+    def test_save_ignores_stale_in_memory_paths(self):
+        stale_b = Folder.objects.get(pk=self.b.pk)
+        moved_a = Folder.objects.get(pk=self.a.pk)
+        moved_a.rodzic = self.other
+        moved_a.save()
+
+        stale_b.nazwa = 'B2'
+        stale_b.save()
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.sciezka, f'/{self.other.pk}/{self.a.pk}/{self.b.pk}/{self.c.pk}/')
+        self.assertEqual(self.c.get_full_path(), 'Inny / A / B2 / C')
+
+    def test_single_query_lookups(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.c.get_ancestors()), [self.a, self.b])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.a.get_descendants().count(), 2)
+
+    def test_rebuild_command_repairs_index(self):
+        Folder.objects.filter(pk=self.c.pk).update(sciezka='', sciezka_nazw='', poziom=0)
+
+        out = io.StringIO()
+        call_command('rebuild_folder_paths', '--check', stdout=out)
+        self.assertIn('1 inconsistent', out.getvalue())
+        self.assertEqual(Folder.objects.get(pk=self.c.pk).sciezka, '')
+
+        call_command('rebuild_folder_paths', stdout=io.StringIO())
+        self.assertEqual(Folder.objects.get(pk=self.c.pk).get_full_path(), 'A / B / C')
+
+
+class ActivityLogWriterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.document = Document.objects.create(nazwa='dok.txt', wlasciciel=self.user)
+        self.spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        self.writer = ActivityLogWriter(capacity=3, batch_size=2, spill_dir=self.spill_dir, autostart=False)
+
+    def _event(self, document=None):
+        return {
+            'uzytkownik_id': self.user.pk,
+            'typ_aktywnosci': 'pobieranie',
+            'dokument_id': document.pk if document else None,
+            'folder_id': None,
+            'szczegoly': 'test',
+            'adres_ip': '127.0.0.1',
+            'znacznik_czasu': timezone.now() - timedelta(minutes=5),
+        }
+
+    def test_flush_bulk_inserts_with_queue_time(self):
+        events = [self._event(self.document) for _ in range(3)]
+        for event in events:
+            self.writer.enqueue(event)
+        self.assertEqual(ActivityLog.objects.count(), 0)
+
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(
+            sorted(ActivityLog.objects.values_list('znacznik_czasu', flat=True)),
+            sorted(e['znacznik_czasu'] for e in events),
+        )
+        self.assertEqual(self.writer.stats()['queue_depth'], 0)
+
+    def test_failed_flush_spills_and_replays(self):
+        self.writer.enqueue(self._event(self.document))
+        with mock.patch.object(ActivityLogWriter, '_write', side_effect=RuntimeError('database locked')), \
+                self.assertLogs('documents.activity', 'ERROR'):
+            self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(self.writer.stats()['spilled'], 1)
+        self.assertTrue(self.writer.stats()['spill_pending'])
+
+        self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(ActivityLog.objects.get().dokument, self.document)
+        self.assertFalse(self.writer.stats()['spill_pending'])
+
+    def test_truncated_spill_line_is_moved_aside(self):
+        self.writer._spill([self._event(self.document), self._event()])
+        with open(self.writer.spill_path, 'a', encoding='utf-8') as f:
+            f.write('{"uzytkownik_id": 1, "typ_akt')  # Crash in the middle of a write
+
+        with self.assertLogs('documents.activity', 'ERROR'):
+            self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(ActivityLog.objects.count(), 2)
+        self.assertFalse(self.writer.stats()['spill_pending'])
+        with open(self.writer.spill_path + '.bad', encoding='utf-8') as f:
+            self.assertEqual(f.read(), '{"uzytkownik_id": 1, "typ_akt\n')
+
+    @skipUnless(activity.fcntl, 'needs fcntl')
+    def test_replay_is_skipped_while_another_process_replays(self):
+        self.writer._spill([self._event()])
+        with open(self.writer.spill_path + '.replay.lock', 'a') as f:
+            activity.fcntl.flock(f, activity.fcntl.LOCK_EX)
+            other = ActivityLogWriter(batch_size=2, spill_dir=self.spill_dir, autostart=False)
+            self.assertEqual(other.flush(), 0)
+        self.assertTrue(self.writer.stats()['spill_pending'])
+        self.assertEqual(self.writer.flush(), 1)
+
+    def test_spill_without_fcntl(self):
+        with mock.patch('documents.activity.fcntl', None):
+            self.writer._spill([self._event(self.document)])
+            self.assertEqual(self.writer.flush(), 1)
+        self.assertFalse(self.writer.stats()['spill_pending'])
+
+    def test_full_buffer_spills_instead_of_blocking(self):
+        for _ in range(5):
+            self.writer.enqueue(self._event())
+        stats = self.writer.stats()
+        self.assertEqual((stats['queue_depth'], stats['spilled'], stats['dropped']), (3, 2, 0))
+        self.assertEqual(self.writer.flush(), 5)
+
+    def test_deleted_document_is_nulled(self):
+        self.writer.enqueue(self._event(self.document))
+        self.document.delete()
+        self.writer.flush()
+        self.assertIsNone(ActivityLog.objects.get().dokument_id)
+
+    @override_settings(ACTIVITY_LOG_SYNC=True)
+    def test_sync_setting_writes_in_request(self):
+        log_activity(self.user, 'pobieranie', document=self.document, ip_address='127.0.0.1')
+        self.assertEqual(ActivityLog.objects.filter(dokument=self.document).count(), 1)
+
+
+class ActivityLogRetentionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.document = Document.objects.create(nazwa='dok.txt', wlasciciel=self.user)
+        self.now = timezone.now()
+        self.old = self.now - timedelta(days=800)
+        ActivityLog.objects.bulk_create(
+            [ActivityLog(uzytkownik=self.user, typ_aktywnosci='pobieranie', dokument=self.document,
+                         znacznik_czasu=self.old) for _ in range(3)]
+            + [ActivityLog(uzytkownik=self.user, typ_aktywnosci='edycja', znacznik_czasu=self.old)]
+            + [ActivityLog(uzytkownik=self.user, typ_aktywnosci='pobieranie', znacznik_czasu=self.now)]
+        )
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir, ignore_errors=True)
+
+    def test_rollup_counts_by_user_action_and_document(self):
+        call_command('rollup_activity_logs', '--since', timezone.localdate(self.old).isoformat(), stdout=io.StringIO())
+        rollups = ActivityDailyRollup.objects.filter(data=timezone.localdate(self.old))
+        self.assertEqual(
+            sorted(rollups.values_list('typ_aktywnosci', 'dokument_id', 'liczba')),
+            [('edycja', None, 1), ('pobieranie', self.document.pk, 3)],
+        )
+
+        # Re-running is idempotent
+        call_command('rollup_activity_logs', '--since', timezone.localdate(self.old).isoformat(), stdout=io.StringIO())
+        self.assertEqual(ActivityDailyRollup.objects.filter(data=timezone.localdate(self.old)).count(), 2)
+
+    def test_archive_exports_and_deletes_old_months(self):
+        call_command('archive_activity_logs', '--dry-run', '--output-dir', self.archive_dir, stdout=io.StringIO())
+        self.assertEqual(ActivityLog.objects.count(), 5)
+
+        call_command('archive_activity_logs', '--output-dir', self.archive_dir, stdout=io.StringIO())
+        self.assertEqual(list(ActivityLog.objects.values_list('znacznik_czasu', flat=True)), [self.now])
+
+        month = timezone.localtime(self.old).strftime('%Y-%m')
+        with gzip.open(os.path.join(self.archive_dir, f'activity_log_{month}.jsonl.gz'), 'rt') as f:
+            exported = [json.loads(line) for line in f]
+        self.assertEqual(len(exported), 4)
+        self.assertEqual(
+            ActivityDailyRollup.objects.filter(data=timezone.localdate(self.old)).aggregate(total=Sum('liczba'))['total'],
+            4,
+        )
+
+    def test_archiving_again_adds_to_the_rollups(self):
+        day = timezone.localdate(self.old)
+        call_command('rollup_activity_logs', '--since', day.isoformat(), stdout=io.StringIO())
+        call_command('archive_activity_logs', '--output-dir', self.archive_dir, stdout=io.StringIO())
+        # A row replayed into the archived month after the first run
+        ActivityLog.objects.create(uzytkownik=self.user, typ_aktywnosci='pobieranie', dokument=self.document,
+                                   znacznik_czasu=self.old)
+        call_command('archive_activity_logs', '--output-dir', self.archive_dir, stdout=io.StringIO())
+        # Recomputing an archived day keeps what was archived
+        call_command('rollup_activity_logs', '--since', day.isoformat(), stdout=io.StringIO())
+
+        self.assertEqual(
+            sorted(ActivityDailyRollup.objects.filter(data=day).values_list('typ_aktywnosci', 'dokument_id', 'liczba')),
+            [('edycja', None, 1), ('pobieranie', self.document.pk, 4)],
+        )
+        month = timezone.localtime(self.old).strftime('%Y-%m')
+        self.assertTrue(os.path.exists(os.path.join(self.archive_dir, f'activity_log_{month}.2.jsonl.gz')))
+
+    def test_rows_added_during_export_are_kept(self):
+        def add_row(queryset, path, chunk_size=5000, on_row=None):
+            count = export_activity_logs(queryset, path, chunk_size, on_row)
+            if count:
+                ActivityLog.objects.create(uzytkownik=self.user, typ_aktywnosci='edycja', znacznik_czasu=self.old)
+            return count
+
+        with mock.patch('documents.management.commands.archive_activity_logs.export_activity_logs', add_row):
+            call_command('archive_activity_logs', '--output-dir', self.archive_dir, stdout=io.StringIO())
+        self.assertEqual(ActivityLog.objects.filter(znacznik_czasu=self.old).count(), 1)
+        self.assertEqual(
+            ActivityDailyRollup.objects.filter(data=timezone.localdate(self.old)).aggregate(total=Sum('liczba'))['total'],
+            5,
+        )
+
+    def test_admin_month_filter(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'haslo12345')
+        self.client.force_login(admin_user)
+        month = timezone.localtime(self.now).strftime('%Y-%m')
+        response = self.client.get(reverse('admin:documents_activitylog_changelist'), {'miesiac': month})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True, TEXT_EXTRACTION_EAGER=True)
+class DocumentSearchTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.reader = User.objects.create_user('reader', 'reader@example.com', 'haslo12345')
+
+    def _search(self, query):
+        return [d.nazwa for d in search_documents(query, Document.objects.all())[:25]]
+
+    def test_analyze_stems_and_folds_diacritics(self):
+        self.assertEqual(analyze('Umowy najmu'), analyze('umowa NAJMU'))
+        self.assertEqual(analyze('Źródła'), ['zrodl'])
+        self.assertEqual(analyze('raport i faktura'), analyze('raport faktura'))
+
+    def test_index_follows_document_tags_metadata_and_delete(self):
+        document = Document.objects.create(nazwa='zestawienie.pdf', wlasciciel=self.owner, opis='Umowy najmu biura')
+        self.assertEqual(self._search('umowa'), ['zestawienie.pdf'])
+
+        tag = Tag.objects.create(nazwa='kadry')
+        document.tagi.add(tag)
+        self.assertEqual(self._search('kadry'), ['zestawienie.pdf'])
+        tag.nazwa = 'ksiegowosc'
+        tag.save()
+        self.assertEqual(self._search('kadry'), [])
+        self.assertEqual(self._search('ksiegowosc'), ['zestawienie.pdf'])
+
+        DocumentMetadata.objects.create(dokument=document, klucz='kontrahent', wartosc='Nowak')
+        self.assertEqual(self._search('nowak'), ['zestawienie.pdf'])
+
+        document.delete()
+        self.assertEqual(self._search('umowa'), [])
+
+    def test_ranks_name_matches_first_and_indexes_text_files(self):
+        create_document(self.owner, 'notatki.txt', content='Budżet na przyszły rok'.encode())
+        Document.objects.create(nazwa='budzet_2025.xlsx', wlasciciel=self.owner)
+        self.assertEqual(self._search('budżet'), ['budzet_2025.xlsx', 'notatki.txt'])
+        self.assertEqual(self._search('budż'), ['budzet_2025.xlsx', 'notatki.txt'])
+
+    def test_view_filters_by_permission_and_paginates(self):
+        for i in range(30):
+            document = Document.objects.create(nazwa=f'raport_{i:02d}.pdf', wlasciciel=self.owner)
+            if i % 2 == 0:
+                assign_perm('browse_document', self.reader, document)
+
+        self.client.force_login(self.reader)
+        response = self.client.get(reverse('documents:search_results'), {'query': 'raport'})
+        self.assertEqual(response.context['document_count'], 15)
+        self.assertTrue(all(int(d.nazwa[7:9]) % 2 == 0 for d in response.context['documents']))
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'haslo12345'))
+        response = self.client.get(reverse('documents:search_results'), {'query': 'raport', 'page': 2})
+        self.assertEqual(response.context['document_count'], 30)
+        self.assertEqual(len(response.context['documents']), 5)
+        self.assertFalse(response.context['documents_truncated'])
+        self.assertContains(response, '?query=raport&page=1')
+
+    def test_count_is_capped_at_rank_window(self):
+        for i in range(4):
+            Document.objects.create(nazwa=f'faktura_{i}.pdf', wlasciciel=self.owner)
+        with mock.patch('documents.search.SEARCH_RANK_WINDOW', 3):
+            results = search_documents('faktura', Document.objects.all())
+            self.assertEqual(results.count(), 3)
+            self.assertTrue(results.truncated)
+            self.assertEqual(len(results[:25]), 3)
+
+    def test_best_match_outside_the_newest_is_ranked_first(self):
+        best = Document.objects.create(nazwa='faktura.pdf', wlasciciel=self.owner)
+        for i in range(4):
+            Document.objects.create(nazwa=f'skan_{i}.pdf', opis='Załączona faktura', wlasciciel=self.owner)
+        with mock.patch('documents.search.SEARCH_RANK_WINDOW', 3):
+            results = search_documents('faktura', Document.objects.all())
+            self.assertEqual(results[0], best)
+            self.assertEqual(len(results[:25]), 3)
+
+
+    def test_broad_queries_rank_only_the_newest_candidates(self):
+        Document.objects.create(nazwa='faktura.pdf', wlasciciel=self.owner)
+        newest = [Document.objects.create(nazwa=f'skan_{i}.pdf', opis='Załączona faktura', wlasciciel=self.owner) for i in range(3)]
+        with mock.patch('documents.search.SEARCH_RANK_CANDIDATES', 3), CaptureQueriesContext(connection) as queries:
+            results = search_documents('faktura', Document.objects.all())
+            self.assertEqual(results.count(), 3)
+            self.assertEqual(sorted(d.pk for d in results[:25]), sorted(d.pk for d in newest))
+        # The count and the page come from one ranking query
+        self.assertEqual(sum('bm25' in query['sql'] for query in queries), 1)
+
+    def test_last_word_is_a_prefix_unless_common_by_itself(self):
+        for i in range(3):
+            Document.objects.create(nazwa=f'bank_{i}.pdf', wlasciciel=self.owner)
+        Document.objects.create(nazwa='bankomat.pdf', wlasciciel=self.owner)
+        self.assertEqual(len(self._search('bank')), 4)
+        with mock.patch('documents.search.SEARCH_RANK_WINDOW', 2):
+            self.assertEqual(sorted(self._search('bank')), ['bank_1.pdf', 'bank_2.pdf'])
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+
+
+def write_pdf(path, content):
+    stream = zlib.compress(content)
+    with open(path, 'wb') as f:
+        f.write(b'%%PDF-1.4\n1 0 obj\n<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream))
+        f.write(stream + b'\nendstream\nendobj\n%%EOF\n')
+
+
+class TextExtractionTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def test_docx_xlsx_and_pdf_extractors(self):
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        write_zip(os.path.join(self.tmp, 'a.docx'), {'word/document.xml': (
+            f'<w:document {w}><w:body><w:p><w:r><w:t>Umowa</w:t></w:r><w:r><w:t xml:space="preserve"> najmu</w:t></w:r></w:p>'
+            '<w:p><w:r><w:t>Lokal 5</w:t></w:r></w:p></w:body></w:document>'
+        )})
+        self.assertEqual(extract_docx(os.path.join(self.tmp, 'a.docx'), 1000).split(), ['Umowa', 'najmu', 'Lokal', '5'])
+
+        ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+        write_zip(os.path.join(self.tmp, 'b.xlsx'), {
+            'xl/sharedStrings.xml': f'<sst {ns}><si><t>Kwota</t></si><si><t>Czynsz</t></si></sst>',
+            'xl/worksheets/sheet1.xml': (
+                f'<worksheet {ns}><sheetData><row r="1"><c r="A1" t="s"><v>1</v></c><c r="B1"><v>1200</v></c></row>'
+                '<row r="2"><c r="A2" t="inlineStr"><is><t>Razem</t></is></c><c r="B2" t="s"><v>0</v></c></row></sheetData></worksheet>'
+            ),
+        })
+        self.assertEqual(extract_xlsx(os.path.join(self.tmp, 'b.xlsx'), 1000), 'Czynsz\t1200\nRazem\tKwota')
+
+        write_pdf(os.path.join(self.tmp, 'c.pdf'), b'BT /F1 12 Tf (Faktura \\(VAT\\)) Tj T* [(nr) -250 ( 7)] TJ ET')
+        self.assertEqual(extract_pdf(os.path.join(self.tmp, 'c.pdf'), 1000).split(), ['Faktura', '(VAT)', 'nr', '7'])
+
+    def test_timeout_is_reported_as_limit(self):
+        path = os.path.join(self.tmp, 'wolny.txt')
+        with open(path, 'w') as f:
+            f.write('tekst')
+        with mock.patch.dict('documents.extraction.EXTRACTORS', {'.txt': lambda p, n: time.sleep(5)}):
+            status, text, message, _ = extract_file(path, timeout=0.2)
+        self.assertEqual((status, text, message), (STATUS_LIMIT, '', 'timed out'))
+
+    @override_settings(TEXT_EXTRACTION_EAGER=True)
+    def test_new_version_is_extracted_and_searchable(self):
+        document = create_document(self.owner, 'notatka.txt', content='Spotkanie   zarządu\r\n\r\n\r\nw piątek'.encode())
+        text = DocumentVersionText.objects.get(wersja__dokument=document)
+        self.assertEqual((text.status, text.tekst), (STATUS_OK, 'Spotkanie zarządu\n\nw piątek'))
+        results = search_documents('zarząd', Document.objects.all())
+        self.assertEqual(list(results[:10]), [document])
+
+    def test_extract_text_command_runs_pool_and_resumes(self):
+        documents = [create_document(self.owner, f'plik_{i}.txt', content=f'raport kwartalny {i}'.encode()) for i in range(3)]
+        # Left over from an interrupted run
+        DocumentVersionText.objects.create(wersja=documents[0].wersje.get(), tekst='raport', status=STATUS_OK)
+
+        out = io.StringIO()
+        call_command('extract_text', '--workers', '2', stdout=out)
+        self.assertIn('Processed 2 versions, 2 with text', out.getvalue())
+        self.assertEqual(DocumentVersionText.objects.filter(status=STATUS_OK).count(), 3)
+        self.assertEqual(len(search_documents('kwartalny', Document.objects.all())[:10]), 2)
+
+        out = io.StringIO()
+        call_command('extract_text', stdout=out)
+        self.assertIn('Nothing to extract', out.getvalue())
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class BlobStorageTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+
+    def _files(self):
+        found = []
+        for directory, _, files in os.walk(self._media_root):
+            found += [os.path.join(directory, f) for f in files]
+        return found
+
+    def test_identical_content_is_stored_once(self):
+        first = create_document(self.owner, 'a.txt', content=b'ta sama tresc')
+        second = create_document(self.owner, 'b.txt', content=b'ta sama tresc')
+        self.assertEqual(first.plik.name, second.plik.name)
+        self.assertTrue(first.plik.name.startswith('blobs/') and first.plik.name.endswith('.txt'))
+        self.assertEqual(len([f for f in self._files() if Path(f).read_bytes() == b'ta sama tresc']), 1)
+        # Two documents and their two versions
+        self.assertEqual(Blob.objects.get(sciezka=first.plik.name).liczba_odwolan, 4)
+
+    def test_unchanged_version_upload_reuses_blob(self):
+        document = create_document(self.owner, 'umowa.txt', content=b'v1')
+        url = reverse('documents:document_version_upload', args=[document.pk])
+        self.client.post(url, {'plik': SimpleUploadedFile('umowa.txt', b'v1')})
+        document.refresh_from_db()
+        self.assertEqual(set(document.wersje.values_list('plik', flat=True)), {document.plik.name})
+        self.assertEqual(Blob.objects.get().liczba_odwolan, 3)
+
+    def test_gc_deletes_only_unreferenced_blobs_after_grace(self):
+        kept = create_document(self.owner, 'a.txt', content=b'wspolne')
+        create_document(self.owner, 'b.txt', content=b'wspolne').delete()
+        gone = create_document(self.owner, 'c.txt', content=b'jedyne')
+        gone_path = gone.plik.path
+        gone.delete()
+
+        self.assertEqual(Blob.objects.get(sciezka=kept.plik.name).liczba_odwolan, 2)
+        call_command('gc_blobs', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(gone_path))  # Still within the grace period
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_blobs', '--grace-hours', '0', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(gone_path))
+        self.assertTrue(os.path.exists(kept.plik.path))
+        self.assertEqual(list(Blob.objects.values_list('sciezka', flat=True)), [kept.plik.name])
+
+    def test_reusing_blob_past_grace_restarts_it(self):
+        document = create_document(self.owner, 'a.txt', content=b'porzucone')
+        name, path = document.plik.name, document.plik.path
+        document.delete()
+        Blob.objects.filter(sciezka=name).update(ostatnia_zmiana=timezone.now() - timedelta(days=30))
+
+        # An upload stores the same content; its row is not saved yet
+        self.assertEqual(blob_storage.save('b.txt', ContentFile(b'porzucone')), name)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_blobs', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(Blob.objects.filter(sciezka=name).exists())
+
+    def test_upload_racing_gc_keeps_its_file(self):
+        document = create_document(self.owner, 'a.txt', content=b'porzucone')
+        name, path = document.plik.name, document.plik.path
+        document.delete()
+        Blob.objects.filter(sciezka=name).update(ostatnia_zmiana=timezone.now() - timedelta(days=30))
+
+        from . import storage
+        touch = storage.touch_blob
+
+        def gc_first(blob_name):
+            # gc_blobs commits just before the upload touches the blob
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('gc_blobs', stdout=io.StringIO())
+            touch(blob_name)
+
+        with mock.patch('documents.storage.touch_blob', side_effect=gc_first):
+            self.assertEqual(blob_storage.save('b.txt', ContentFile(b'porzucone')), name)
+        self.assertFalse(Blob.objects.filter(sciezka=name).exists())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'porzucone')
+
+    def test_dedupe_media_moves_legacy_files(self):
+        legacy = []
+        for i in range(2):
+            name = f'documents/{self.owner.pk}/2024/01/stary_{i}.pdf'
+            os.makedirs(os.path.dirname(os.path.join(self._media_root, name)), exist_ok=True)
+            with open(os.path.join(self._media_root, name), 'wb') as f:
+                f.write(b'%PDF-1.4 duplikat')
+            legacy.append(name)
+            document = Document.objects.create(nazwa=f'stary_{i}.pdf', wlasciciel=self.owner)
+            Document.objects.filter(pk=document.pk).update(plik=name)
+
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_media', stdout=out)
+        self.assertIn('Moved 2 files (34 bytes) into 1 blobs; 17 bytes of duplicates freed', out.getvalue())
+        names = set(Document.objects.values_list('plik', flat=True))
+        self.assertEqual(len(names), 1)
+        blob = Blob.objects.get()
+        self.assertEqual((blob.sciezka, blob.liczba_odwolan), (names.pop(), 2))
+        self.assertFalse(any(os.path.exists(os.path.join(self._media_root, name)) for name in legacy))
+        self.assertEqual(Document.objects.filter(hash_pliku=blob.hash_pliku).count(), 2)
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True, FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+class UploadFingerprintTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+
+    def test_sniff_mime_from_first_bytes(self):
+        docx = io.BytesIO()
+        write_zip(docx, {'[Content_Types].xml': '<Types/>', 'word/document.xml': '<w/>'})
+        self.assertEqual(sniff_mime(docx.getvalue()[:2048], 'a.docx'),
+                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+        self.assertEqual(sniff_mime(b'%PDF-1.7\n', 'a.txt'), 'application/pdf')
+        self.assertEqual(sniff_mime('zażółć'.encode()[:-1], 'a.txt'), 'text/plain')
+        self.assertEqual(sniff_mime(b'\x00\x01\x02', 'a.txt'), 'application/octet-stream')
+
+    def test_upload_persists_fingerprint_without_rereading(self):
+        content = b'%PDF-1.4\n' + os.urandom(4096)  # Above FILE_UPLOAD_MAX_MEMORY_SIZE: spooled to disk
+        # Every byte goes through the fingerprint exactly once
+        with mock.patch.object(_Fingerprint, 'update', autospec=True, side_effect=_Fingerprint.update) as update:
+            response = self.client.post(reverse('documents:document_upload'), {
+                'plik': SimpleUploadedFile('faktura.pdf', content), 'nazwa': 'Faktura', 'status': 'draft',
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sum(len(call.args[1]) for call in update.call_args_list), len(content))
+
+        document = Document.objects.get(nazwa='Faktura')
+        version = document.wersje.get()
+        expected = (hashlib.sha256(content).hexdigest(), len(content), 'application/pdf')
+        self.assertEqual((document.hash_pliku, document.rozmiar_pliku, document.typ_mime), expected)
+        self.assertEqual((version.hash_pliku, version.rozmiar_pliku, version.typ_mime), expected)
+
+        self.client.post(reverse('documents:document_version_upload', args=[document.pk]),
+                         {'plik': SimpleUploadedFile('faktura.txt', b'poprawka')})
+        document.refresh_from_db()
+        self.assertEqual((document.typ_mime, document.typ_pliku, document.rozmiar_pliku), ('text/plain', 'txt', 8))
+        self.assertEqual(document.hash_pliku, hashlib.sha256(b'poprawka').hexdigest())
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class ResumableUploadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.staging_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.staging_dir, ignore_errors=True)
+        staging = override_settings(UPLOAD_STAGING_DIR=self.staging_dir)
+        staging.enable()
+        self.addCleanup(staging.disable)
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.content = b'%PDF-1.4\n' + os.urandom(10000)
+
+    def _create(self, **data):
+        data.setdefault('nazwa_pliku', 'raport.pdf')
+        data.setdefault('rozmiar', len(self.content))
+        return self.client.post(reverse('documents:upload_session_create'), data)
+
+    def _patch(self, url, offset, chunk):
+        return self.client.generic('PATCH', url, chunk, content_type='application/offset+octet-stream',
+                                   HTTP_UPLOAD_OFFSET=str(offset), HTTP_TUS_RESUMABLE='1.0.0')
+
+    def _upload(self, url, chunk_size=4096):
+        for offset in range(0, len(self.content), chunk_size):
+            response = self._patch(url, offset, self.content[offset:offset + chunk_size])
+            self.assertEqual(response.status_code, 204)
+
+    def test_chunked_upload_creates_document_with_first_version(self):
+        response = self._create(nazwa='Raport roczny', komentarz='pierwsza wersja')
+        self.assertEqual(response.status_code, 201)
+        url = response['Location']
+        self._upload(url)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], str(len(self.content)))
+
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, 201)
+        document = Document.objects.get(pk=response.json()['dokument'])
+        version = document.wersje.get()
+        expected = (hashlib.sha256(self.content).hexdigest(), len(self.content), 'application/pdf')
+        self.assertEqual((document.nazwa, document.typ_pliku), ('Raport roczny', 'pdf'))
+        self.assertEqual((document.hash_pliku, document.rozmiar_pliku, document.typ_mime), expected)
+        self.assertEqual((version.plik.name, version.komentarz), (document.plik.name, 'pierwsza wersja'))
+        self.assertEqual(Path(document.plik.path).read_bytes(), self.content)
+        self.assertEqual(os.listdir(self.staging_dir), [])  # Moved into the store
+        self.assertTrue(ActivityLog.objects.filter(dokument=document, typ_aktywnosci='tworzenie').exists())
+
+    def test_resume_after_interrupted_chunk(self):
+        url = self._create()['Location']
+        self._patch(url, 0, self.content[:3000])
+        # The client lost track of what arrived: a stale offset is refused with the real one
+        response = self._patch(url, 0, self.content[:3000])
+        self.assertEqual((response.status_code, response['Upload-Offset']), (409, '3000'))
+        self.assertEqual(self.client.post(url + 'finalize/').status_code, 409)
+
+        offset = int(self.client.head(url)['Upload-Offset'])
+        self.assertEqual(self._patch(url, offset, self.content[offset:]).status_code, 204)
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, 201)
+        document = Document.objects.get(pk=response.json()['dokument'])
+        self.assertEqual(document.hash_pliku, hashlib.sha256(self.content).hexdigest())
+
+    def test_chunk_past_declared_size_is_rejected(self):
+        url = self._create(rozmiar=100)['Location']
+        self.assertEqual(self._patch(url, 0, b'x' * 101).status_code, 413)
+        with override_settings(UPLOAD_MAX_SIZE=50):
+            self.assertEqual(self._create(rozmiar=100).status_code, 400)
+        self.assertEqual(self._create(nazwa_pliku='skrypt.exe').status_code, 400)
+
+    def test_upload_as_new_version(self):
+        document = create_document(self.owner, 'raport.txt', content=b'v1')
+        url = self._create(dokument=document.pk, komentarz='poprawki')['Location']
+        self._upload(url, chunk_size=len(self.content))
+        self.assertEqual(self.client.post(url + 'finalize/').status_code, 201)
+
+        document.refresh_from_db()
+        latest = document.wersje.first()
+        self.assertEqual((latest.numer_wersji, latest.komentarz, latest.oryginalna_nazwa_pliku),
+                         (2, 'poprawki', 'raport.pdf'))
+        self.assertEqual((document.plik.name, document.typ_pliku), (latest.plik.name, 'pdf'))
+        # A finished session takes no more data
+        self.assertEqual(self._patch(url, len(self.content), b'x').status_code, 410)
+
+    def test_sessions_are_private_and_checked_against_permissions(self):
+        document = create_document(self.owner, 'raport.txt')
+        url = self._create()['Location']
+        reader = User.objects.create_user('reader', 'reader@example.com', 'haslo12345')
+        self.client.force_login(reader)
+        self.assertEqual(self.client.head(url).status_code, 404)
+        self.assertEqual(self._create(dokument=document.pk).status_code, 403)
+
+    def test_new_documents_only_go_to_browseable_folders(self):
+        editor = User.objects.create_user('edytor', 'edytor@example.com', 'haslo12345')
+        editor.profile.rola = Role.objects.get(nazwa=Role.EDITOR)
+        editor.profile.save()
+        hidden = Folder.objects.create(nazwa='Zarząd', wlasciciel=self.owner)
+        shared = Folder.objects.create(nazwa='Wspólny', wlasciciel=self.owner)
+        assign_perm('browse_folder', editor, shared)
+        self.client.force_login(editor)
+
+        self.assertEqual(self._create(folder=hidden.pk).status_code, 400)
+        url = self._create(folder=shared.pk)['Location']
+        self._upload(url)
+        remove_perm('browse_folder', editor, shared)
+        self.assertEqual(self.client.post(url + 'finalize/').status_code, 403)
+        self.assertFalse(Document.objects.filter(folder=shared).exists())
+
+    def test_cancel_and_cleanup(self):
+        cancelled = self._create()['Location']
+        self._patch(cancelled, 0, self.content[:100])
+        self.assertEqual(self.client.delete(cancelled).status_code, 204)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+        self._create()
+        UploadSession.objects.update(ostatnia_aktywnosc=timezone.now() - timedelta(days=2))
+        out = io.StringIO()
+        call_command('cleanup_uploads', stdout=out)
+        self.assertIn('discarded 1 abandoned uploads', out.getvalue())
+        self.assertIn('Deleted 1 finished upload sessions', out.getvalue())
+        self.assertEqual(os.listdir(self.staging_dir), [])
+        self.assertEqual(UploadSession.objects.get().status, UploadSession.STATUS_CANCELLED)
+
+
+def png_bytes(width, height, color='red'):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGBA', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True, TEXT_EXTRACTION_EAGER=True)
+class PreviewTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+
+    def test_thumbnail_rendered_once_and_keyed_by_content(self):
+        document = create_document(self.owner, 'zdjecie.png', png_bytes(2000, 1000))
+        url = reverse('documents:document_thumbnail', args=[document.pk, 480])
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/jpeg'))
+        from PIL import Image
+        self.assertEqual(Image.open(io.BytesIO(b''.join(response.streaming_content))).size, (480, 240))
+        # All sizes came from the one render
+        for size in THUMBNAIL_SIZES:
+            self.assertTrue(os.path.exists(os.path.join(self._media_root, preview_name(document.hash_pliku, size))))
+
+        with mock.patch('documents.previews.render_thumbnails') as render:
+            self.assertEqual(self.client.get(url).status_code, 200)
+            copy = create_document(self.owner, 'kopia.png', png_bytes(2000, 1000))
+            self.client.get(reverse('documents:document_thumbnail', args=[copy.pk, 160]))
+        render.assert_not_called()
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(reverse('documents:document_thumbnail', args=[document.pk, 333])).status_code, 404)
+
+    @mock.patch('documents.previews.MAX_IMAGE_PIXELS', 100 * 100)
+    def test_oversized_images_are_not_decoded(self):
+        large = create_document(self.owner, 'plakat.png', png_bytes(200, 100))
+        response = self.client.get(reverse('documents:document_thumbnail', args=[large.pk, 160]))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(os.path.exists(os.path.join(self._media_root, preview_name(large.hash_pliku, 160))))
+        small = create_document(self.owner, 'ikona.png', png_bytes(100, 100))
+        self.assertEqual(self.client.get(reverse('documents:document_thumbnail', args=[small.pk, 160])).status_code, 200)
+
+    def test_preview_page_shows_thumbnail_and_original(self):
+        document = create_document(self.owner, 'zdjecie.png', png_bytes(50, 50))
+        response = self.client.get(reverse('documents:document_preview', args=[document.pk]))
+        self.assertContains(response, reverse('documents:document_thumbnail', args=[document.pk, THUMBNAIL_SIZES[-1]]))
+        response = self.client.get(reverse('documents:document_preview', args=[document.pk]) + '?oryginal=1')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['Content-Disposition'].startswith('inline;'))
+
+    def test_text_preview_is_paged_by_byte_offset(self):
+        line = 'zażółć gęślą jaźń\n'
+        document = create_document(self.owner, 'duzy.txt', (line * 10000).encode())
+        url = reverse('documents:document_preview', args=[document.pk])
+        response = self.client.get(url)
+        content = response.context['content']
+        self.assertTrue(content.endswith('\n') and 0 < len(content.encode()) <= 64 * 1024)
+        next_offset = response.context['next_offset']
+        self.assertContains(response, f'?offset={next_offset}')
+
+        pages, offset = [], 0
+        while offset is not None:
+            text, offset = read_text_page(document.plik.path, offset)
+            pages.append(text)
+        self.assertEqual(''.join(pages), line * 10000)
+        # An offset inside a character skips to the next one instead of failing
+        self.assertFalse(read_text_page(document.plik.path, 2)[0].startswith('\ufffd'))
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='podglad').count(), 1)
+
+    def test_other_text_files_get_a_text_preview(self):
+        document = create_document(self.owner, 'dane.csv', 'miasto;liczba\nŁódź;3\n'.encode())
+        response = self.client.get(reverse('documents:document_preview', args=[document.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['is_text'])
+        self.assertNotIn('is_extracted', response.context)
+        self.assertContains(response, 'Łódź;3')
+
+    def test_docx_preview_uses_extracted_text(self):
+        path = os.path.join(self._media_root, 'umowa.docx')
+        write_zip(path, {'word/document.xml': '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                                              '<w:body><w:p><w:r><w:t>Treść umowy najmu</w:t></w:r></w:p></w:body></w:document>'})
+        with open(path, 'rb') as f:
+            document = create_document(self.owner, 'umowa.docx', f.read())
+        response = self.client.get(reverse('documents:document_preview', args=[document.pk]))
+        self.assertContains(response, 'Treść umowy najmu')
+        self.assertTrue(response.context['is_extracted'])
+
+    def test_lru_eviction_and_warm_command(self):
+        documents = [create_document(self.owner, f'obraz_{i}.png', png_bytes(400 + i, 300)) for i in range(3)]
+        out = io.StringIO()
+        call_command('warm_previews', '--workers', '1', stdout=out)
+        self.assertIn('Rendered previews of 3 files, 0 failed', out.getvalue())
+        call_command('warm_previews', stdout=out)
+        self.assertIn('All previews are cached', out.getvalue())
+
+        paths = {d.pk: os.path.join(self._media_root, preview_name(d.hash_pliku, THUMBNAIL_SIZES[0])) for d in documents}
+        for i, document in enumerate(documents):
+            for size in THUMBNAIL_SIZES:
+                path = os.path.join(self._media_root, preview_name(document.hash_pliku, size))
+                os.utime(path, (1000 + i, 1000 + i))
+        # Using the oldest one makes it the most recent
+        self.client.get(reverse('documents:document_thumbnail', args=[documents[0].pk, THUMBNAIL_SIZES[0]]))
+
+        removed, freed = enforce_quota(max_bytes=os.path.getsize(paths[documents[0].pk]) * 2)
+        self.assertEqual(removed, 3 * len(THUMBNAIL_SIZES) - 1)
+        self.assertEqual(enforce_quota(max_bytes=os.path.getsize(paths[documents[0].pk]) * 2), (0, 0))
+        self.assertTrue(os.path.exists(paths[documents[0].pk]))
+        self.assertFalse(os.path.exists(paths[documents[1].pk]))
+
+
+class SystemSettingsCacheTests(TestCase):
+    def setUp(self):
+        bump_settings_generation()  # Nothing cached by an earlier test
+        with self.captureOnCommitCallbacks(execute=True):
+            SystemSettings.set_setting('nazwa_systemu', 'Archiwum')
+            SystemSettings.set_setting('max_plikow', ' 25 ')
+            SystemSettings.set_setting('rejestracja', 'Tak')
+            SystemSettings.set_setting('rozszerzenia', '["pdf", "docx"]')
+
+    def test_lookups_hit_the_database_once(self):
+        template = Template(
+            '{% load custom_settings %}{% get_setting "nazwa_systemu" %} {% get_setting "brak" "x" %} '
+            '{% get_setting_int "max_plikow" %} {% get_setting_bool "rejestracja" as r %}{{ r }}'
+        )
+        with self.assertNumQueries(2):  # The generation and the values
+            self.assertEqual(template.render(Context()), 'Archiwum x 25 True')
+        with self.assertNumQueries(0):
+            template.render(Context())
+            self.assertEqual(SystemSettings.get_json('rozszerzenia'), ['pdf', 'docx'])
+            self.assertEqual(SystemSettings.get_int('nazwa_systemu', 7), 7)
+            self.assertIs(SystemSettings.get_bool('brak', True), True)
+
+    def test_changes_invalidate_after_commit(self):
+        self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Archiwum')
+        with self.captureOnCommitCallbacks(execute=True):
+            SystemSettings.set_setting('nazwa_systemu', 'Repozytorium')
+            # Before the commit the change is visible to its own transaction but not cached
+            self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Repozytorium')
+        self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Repozytorium')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            SystemSettings.objects.get(klucz='rejestracja').delete()
+        self.assertIs(SystemSettings.get_bool('rejestracja'), False)
+        with self.assertNumQueries(0):
+            SystemSettings.get_setting('nazwa_systemu')
+
+    def test_rollback_does_not_leave_the_change_pending(self):
+        SystemSettings.get_setting('nazwa_systemu')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            SystemSettings.set_setting('nazwa_systemu', 'Repozytorium')
+            raise RuntimeError
+        self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Archiwum')
+        with self.assertNumQueries(0):
+            SystemSettings.get_setting('nazwa_systemu')
+
+    def test_other_processes_see_changes(self):
+        self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Archiwum')
+        # Saved by another process: the generation changes, this process's copy is not dropped
+        SystemSettings.objects.filter(klucz='nazwa_systemu').update(wartosc='Repozytorium')
+        CacheGeneration.bump(SETTINGS_GENERATION_KEY)
+        with override_settings(SETTINGS_GENERATION_CHECK_INTERVAL=0):
+            self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Repozytorium')
+
+    def test_other_processes_reload_from_the_shared_cache(self):
+        from . import settings_cache
+        SystemSettings.get_setting('nazwa_systemu')
+        settings_cache._snapshot = (None, None, 0)  # A fresh process
+        with self.assertNumQueries(1):  # The generation
+            self.assertEqual(SystemSettings.get_setting('nazwa_systemu'), 'Archiwum')
+
+
+class HomeListingPaginationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.folder = Folder.objects.create(nazwa='Archiwum', wlasciciel=self.owner)
+        Folder.objects.bulk_create([Folder(nazwa=f'podfolder_{i:02}', rodzic=self.folder, wlasciciel=self.owner) for i in range(3)])
+        # Duplicate names: the id breaks the tie
+        Document.objects.bulk_create([Document(nazwa=f'dok_{i // 2:03}.txt', folder=self.folder, wlasciciel=self.owner) for i in range(10)])
+        self.url = reverse('documents:folder_view', args=[self.folder.pk])
+
+    def _pages(self, **headers):
+        pages, url = [], self.url
+        while url:
+            response = self.client.get(url, **headers)
+            pages.append(response)
+            cursor = response.context['next_cursor']
+            url = f'{self.url}?po={cursor}' if cursor else None
+        return pages
+
+    @mock.patch('documents.views.HOME_PAGE_SIZE', 4)
+    def test_pages_cover_the_folder_once_in_order(self):
+        pages = self._pages()
+        self.assertEqual([(len(p.context['folders']), len(p.context['documents'])) for p in pages], [(3, 1), (0, 4), (0, 4), (0, 1)])
+        listed = [item.pk for p in pages for item in p.context['folders'] + p.context['documents']]
+        expected = (list(Folder.objects.filter(rodzic=self.folder).order_by('nazwa', 'id').values_list('pk', flat=True))
+                    + list(Document.objects.filter(folder=self.folder).order_by('nazwa', 'id').values_list('pk', flat=True)))
+        self.assertEqual(listed, expected)
+        self.assertEqual(pages[0].context['folders'][0].doc_count, 0)
+        self.assertContains(pages[0], 'Załaduj więcej')
+        self.assertNotContains(pages[-1], 'Załaduj więcej')
+
+    @mock.patch('documents.views.HOME_PAGE_SIZE', 3)
+    def test_load_more_returns_only_the_items(self):
+        pages = self._pages(HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTemplateUsed(pages[1], 'documents/partials/home_page.html')
+        self.assertNotContains(pages[1], 'breadcrumb')
+        # The first page is exactly the folders: documents follow on the next one
+        self.assertEqual([len(p.context['items']) for p in pages], [3, 3, 3, 3, 1])
+        self.assertEqual(len(pages[1].context['documents']), 3)
+
+    def test_bad_cursor_starts_over(self):
+        response = self.client.get(self.url + '?po=nie-kursor')
+        self.assertEqual(len(response.context['folders']), 3)
+
+
+class StatsTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.other = User.objects.create_user('inny', 'inny@example.com', 'haslo12345')
+        self.root = Folder.objects.create(nazwa='Archiwum', wlasciciel=self.owner)
+        self.child = Folder.objects.create(nazwa='2024', rodzic=self.root, wlasciciel=self.owner)
+
+    def _folder(self, folder):
+        stats = FolderStats.objects.get(pk=folder.pk)
+        return stats.liczba_dokumentow, stats.liczba_podfolderow, stats.rozmiar_calkowity
+
+    def _user(self, user):
+        stats = UserStats.objects.get(pk=user.pk)
+        return stats.liczba_dokumentow, stats.liczba_folderow, stats.rozmiar_calkowity
+
+    def _assert_in_sync(self):
+        out = io.StringIO()
+        call_command('rebuild_stats', '--check', stdout=out)
+        self.assertIn('Statistics are up to date', out.getvalue())
+
+    def test_documents_update_counters_of_folders_and_owner(self):
+        a = Document.objects.create(nazwa='a.txt', wlasciciel=self.owner, folder=self.child, rozmiar_pliku=100)
+        Document.objects.create(nazwa='b.txt', wlasciciel=self.other, folder=self.root, rozmiar_pliku=10)
+        self.assertEqual(self._folder(self.child), (1, 0, 100))
+        self.assertEqual(self._folder(self.root), (1, 1, 110))
+        self.assertEqual(self._user(self.owner), (1, 2, 100))
+
+        a.rozmiar_pliku = 300
+        a.folder = self.root
+        a.save()
+        self.assertEqual((self._folder(self.child), self._folder(self.root)), ((0, 0, 0), (2, 1, 310)))
+        a.usunieto = True
+        a.save()
+        self.assertEqual((self._folder(self.root), self._user(self.owner)), ((1, 1, 10), (0, 2, 0)))
+        a.usunieto = False
+        a.save()
+        Document.objects.get(pk=a.pk).delete()
+        self.assertEqual(self._folder(self.root), (1, 1, 10))
+        self._assert_in_sync()
+
+    def test_version_marks_activity(self):
+        document = create_document(self.owner, 'umowa.txt', b'v1', folder=self.child)
+        FolderStats.objects.update(ostatnia_aktywnosc=None)
+        document.add_version(SimpleUploadedFile('umowa.txt', b'wersja 2'), self.owner)
+        self.assertIsNotNone(FolderStats.objects.get(pk=self.root.pk).ostatnia_aktywnosc)
+        self.assertEqual(self._folder(self.root), (0, 1, len(b'wersja 2')))
+        self._assert_in_sync()
+
+    def test_folder_moves_and_deletes(self):
+        Document.objects.create(nazwa='a.txt', wlasciciel=self.owner, folder=self.child, rozmiar_pliku=100)
+        other_root = Folder.objects.create(nazwa='Inne', wlasciciel=self.other)
+        self.child.rodzic = other_root
+        self.child.save()
+        self.assertEqual((self._folder(self.root), self._folder(other_root)), ((0, 0, 0), (0, 1, 100)))
+        self.child.wlasciciel = self.other
+        self.child.save()
+        self.assertEqual((self._user(self.owner)[1], self._user(self.other)[1]), (1, 2))
+
+        Folder.objects.get(pk=self.child.pk).delete()  # With its document
+        self.assertEqual(self._folder(other_root), (0, 0, 0))
+        self.assertEqual(self._user(self.owner), (0, 1, 0))
+        self._assert_in_sync()
+
+    def test_rebuild_repairs_bypassed_changes(self):
+        Document.objects.bulk_create([Document(nazwa=f'{i}.txt', wlasciciel=self.owner, folder=self.child, rozmiar_pliku=5) for i in range(3)])
+        FolderStats.objects.filter(pk=self.root.pk).delete()
+        out = io.StringIO()
+        call_command('rebuild_stats', stdout=out)
+        self.assertIn('statystyki_folderu: 1 missing, 1 wrong', out.getvalue())
+        self.assertEqual((self._folder(self.child), self._folder(self.root)), ((3, 0, 15), (0, 1, 15)))
+        self._assert_in_sync()
+
+    def test_home_reads_counters(self):
+        self.client.force_login(self.owner)
+        Document.objects.create(nazwa='a.txt', wlasciciel=self.owner, folder=self.child, rozmiar_pliku=2048)
+        response = self.client.get(reverse('documents:home'))
+        self.assertEqual((response.context['total_documents'], response.context['total_folders']), (1, 2))
+        self.assertEqual(response.context['total_size'], '2.0 KB')
+        self.assertContains(response, 'Moje dokumenty')
+        self.assertEqual((response.context['folders'][0].doc_count, response.context['folders'][0].subfolder_count), (0, 1))
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class CommentThreadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.document = create_document(self.owner, 'umowa.txt', b'v1')
+        self.url = reverse('documents:document_detail', args=[self.document.pk])
+
+    def _comment(self, tresc, rodzic=None, wersja=None, aktywny=True):
+        return Comment.objects.create(dokument=self.document, uzytkownik=self.owner, tresc=tresc,
+                                      rodzic=rodzic, wersja_dokumentu=wersja, aktywny=aktywny)
+
+    def test_tree_and_version_grouping(self):
+        version = self.document.wersje.get()
+        first = self._comment('pierwszy')
+        reply = self._comment('odpowiedz', rodzic=first, wersja=version)
+        self._comment('odpowiedz na odpowiedz', rodzic=reply)
+        hidden = self._comment('ukryty', aktywny=False)
+        self._comment('sierota', rodzic=hidden)
+        self._comment('drugi', wersja=version)
+
+        with self.assertNumQueries(1):
+            thread = load_comment_thread(self.document)
+        self.assertEqual([(c.tresc, c.depth) for c in thread], [
+            ('pierwszy', 0), ('odpowiedz', 1), ('odpowiedz na odpowiedz', 2), ('sierota', 0), ('drugi', 0),
+        ])
+        self.assertEqual([c.tresc for c in thread.roots[0].replies], ['odpowiedz'])
+        self.assertEqual([c.tresc for c in thread.for_version(version)], ['odpowiedz', 'drugi'])
+        self.assertEqual(len(thread.document_comments), 3)
+
+    def _count_queries(self):
+        self.client.get(self.url)  # Warm up caches
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_detail_query_count_is_constant(self):
+        self._comment('pierwszy')
+        small = self._count_queries()
+        parent = None
+        for i in range(5):
+            version = self.document.add_version(SimpleUploadedFile('umowa.txt', f'v{i + 2}'.encode()), self.owner)
+            parent = self._comment(f'komentarz {i}', rodzic=parent, wersja=version)
+        with self.assertNumQueries(small):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['all_comments']), 6)
+        self.assertEqual([len(v.comments) for v in response.context['versions']], [1, 1, 1, 1, 1, 0])
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class VersionChunkingTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        cache.clear()  # No delivery log throttled by an earlier test
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.contents = [os.urandom(300 * 1024)]
+        for _ in range(2):
+            previous = self.contents[-1]
+            self.contents.append(previous[:1000] + b'wstawione bajty' + previous[1000:250000] + os.urandom(64) + previous[250064:])
+        self.document = create_document(self.owner, 'arkusz.bin', content=self.contents[0])
+        for content in self.contents[1:]:
+            self.document.add_version(SimpleUploadedFile('arkusz.bin', content), self.owner)
+
+    def _compact(self):
+        out = io.StringIO()
+        call_command('compact_versions', '--min-kb', '1', stdout=out)
+        return out.getvalue()
+
+    def _download(self, version, **headers):
+        url = reverse('documents:document_version_download', args=[self.document.pk, version.pk])
+        return self.client.get(url, headers=headers)
+
+    def test_boundaries_follow_content_after_insertion(self):
+        data = self.contents[0]
+        before = {data[start:end] for start, end in zip([0, *chunk_boundaries(data)], chunk_boundaries(data))}
+        shifted = b'x' * 100 + data
+        after = [shifted[start:end] for start, end in zip([0, *chunk_boundaries(shifted)], chunk_boundaries(shifted))]
+        self.assertEqual(sum(map(len, after)), len(shifted))
+        self.assertTrue(all(CHUNK_MIN_SIZE <= len(chunk) <= CHUNK_MAX_SIZE for chunk in after[:-1]))
+        self.assertLessEqual(sum(len(chunk) for chunk in after if chunk not in before), 2 * CHUNK_MAX_SIZE)
+
+    def test_old_versions_are_chunked_and_the_latest_stays_whole(self):
+        old_names = list(self.document.wersje.order_by('numer_wersji').values_list('plik', flat=True))[:2]
+        self.assertIn('Converted 2 versions', self._compact())
+
+        v1, v2, v3 = self.document.wersje.order_by('numer_wersji')
+        self.assertEqual([v.sposob_przechowywania for v in (v1, v2, v3)],
+                         [DocumentVersion.STORAGE_CHUNKED, DocumentVersion.STORAGE_CHUNKED, DocumentVersion.STORAGE_WHOLE])
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.plik.name, v3.plik.name)
+        self.assertTrue(v1.plik.name.startswith('blobs/manifests/') and v1.plik.name.endswith('.bin'))
+        self.assertEqual([Blob.objects.get(sciezka=name).liczba_odwolan for name in old_names], [0, 0])
+        self.assertEqual(Blob.objects.get(sciezka=v1.plik.name).liczba_odwolan, 1)
+        # The second version only added the chunks around its edits
+        digests = {digest for v in (v1, v2) for digest, _ in open_chunked(v.plik.name).chunks}
+        stored = sum(os.path.getsize(os.path.join(self._media_root, chunk_name(digest))) for digest in digests)
+        self.assertLess(stored, len(self.contents[0]) * 1.2)
+        self.assertIn('Converted 0 versions', self._compact())
+
+    def test_chunked_version_downloads_the_original_bytes(self):
+        self._compact()
+        version = self.document.wersje.get(numer_wersji=2)
+        response = self._download(version)
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body, self.contents[1])
+        self.assertEqual(hashlib.sha256(body).hexdigest(), version.hash_pliku)
+        self.assertEqual(response['Content-Length'], str(len(self.contents[1])))
+        self.assertIn('arkusz_v2.bin', response['Content-Disposition'])
+        self.assertEqual(self._download(version, **{'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='pobieranie').count(), 1)
+
+    def test_file_shared_with_a_current_document_stays_whole(self):
+        other = create_document(self.owner, 'kopia.bin', content=self.contents[0])
+        self._compact()
+        self.assertEqual(self.document.wersje.get(numer_wersji=1).sposob_przechowywania, DocumentVersion.STORAGE_WHOLE)
+        self.assertTrue(os.path.exists(other.plik.path))
+
+    def test_gc_removes_replaced_files_then_unlisted_chunks(self):
+        whole_path = self.document.wersje.get(numer_wersji=1).plik.path
+        self._compact()
+        chunk_paths = [os.path.join(self._media_root, chunk_name(digest)) for version in self.document.wersje.all()[1:]
+                       for digest, _ in open_chunked(version.plik.name).chunks]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_blobs', '--grace-hours', '0', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(whole_path))
+        self.assertEqual(b''.join(open_chunked(self.document.wersje.get(numer_wersji=1).plik.name)), self.contents[0])
+
+        self.document.delete()
+        with self.captureOnCommitCallbacks(execute=True):  # The manifests, then the chunks they listed
+            call_command('gc_blobs', '--grace-hours', '0', stdout=io.StringIO())
+        self.assertFalse(any(os.path.exists(path) for path in chunk_paths))
+
+
+@override_settings(ACTIVITY_LOG_SYNC=True)
+class ColdStorageTierTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        cache.clear()  # No delivery log throttled by an earlier test
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.contents = [''.join(f'{i};wersja {n};{i * n}\n' for i in range(3000)).encode() for n in range(1, 4)]
+        self.document = create_document(self.owner, 'raport.csv', content=self.contents[0])
+        for content in self.contents[1:]:
+            self.document.add_version(SimpleUploadedFile('raport.csv', content), self.owner)
+        self.document.wersje.update(data_utworzenia=timezone.now() - timedelta(days=400))
+
+    def _tier(self, *args):
+        out = io.StringIO()
+        call_command('tier_cold_versions', '--min-kb', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def _version(self, numer):
+        return self.document.wersje.get(numer_wersji=numer)
+
+    def test_old_unread_versions_are_compressed_and_download_intact(self):
+        self.assertIn('Compressed 2 versions', self._tier())
+        self.assertEqual([self._version(n).sposob_przechowywania for n in (1, 2, 3)],
+                         [DocumentVersion.STORAGE_COLD, DocumentVersion.STORAGE_COLD, DocumentVersion.STORAGE_WHOLE])
+        version = self._version(1)
+        self.assertTrue(version.plik.name.startswith('blobs/cold/') and version.plik.name.endswith('.csv'))
+        self.assertLess(os.path.getsize(version.plik.path), len(self.contents[0]) / 2)
+
+        url = reverse('documents:document_version_download', args=[self.document.pk, version.pk])
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.contents[0])
+        self.assertEqual(response['Content-Length'], str(len(self.contents[0])))
+        self.assertIsNotNone(self._version(1).ostatni_dostep)
+
+        detail = self.client.get(reverse('documents:document_detail', args=[self.document.pk]))
+        self.assertEqual(detail.context['storage_state'], 'zimny')
+        self.assertContains(detail, 'Archiwum (zstd)')
+
+    def test_recently_downloaded_versions_stay_hot(self):
+        version = self._version(1)
+        self.client.get(reverse('documents:document_version_download', args=[self.document.pk, version.pk]))
+        self._tier()
+        self.assertEqual(self._version(1).sposob_przechowywania, DocumentVersion.STORAGE_WHOLE)
+        self.assertEqual(self._version(2).sposob_przechowywania, DocumentVersion.STORAGE_COLD)
+
+    def test_incompressible_files_stay_whole(self):
+        document = create_document(self.owner, 'zdjecie.jpg', content=os.urandom(20000))
+        document.add_version(SimpleUploadedFile('zdjecie.jpg', os.urandom(20000)), self.owner)
+        document.wersje.update(data_utworzenia=timezone.now() - timedelta(days=400))
+        self.assertIn('1 files left as they are', self._tier())
+        self.assertEqual(document.wersje.get(numer_wersji=1).sposob_przechowywania, DocumentVersion.STORAGE_WHOLE)
+
+    def test_dry_run_estimates_without_changing_anything(self):
+        output = self._tier('--dry-run')
+        self.assertIn('- csv: 2 files', output)
+        self.assertIn('Would compress 2 files', output)
+        self.assertFalse(self.document.wersje.exclude(sposob_przechowywania=DocumentVersion.STORAGE_WHOLE).exists())
+        self.assertIn('Compressed 0 versions', self._tier('--days', '1000'))
+
+
+# Extracted and not previewed in the request: background work would outlive the test database
+@override_settings(ACTIVITY_LOG_SYNC=True, TEXT_EXTRACTION_EAGER=True, PREVIEW_ON_UPLOAD=False)
+class ConcurrentVersionUploadTests(MediaRootMixin, TransactionTestCase):
+    UPLOADS = 50
+
+    def test_parallel_uploads_get_consecutive_numbers(self):
+        owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        document = create_document(owner, 'umowa.txt', content=b'v1')
+        url = reverse('documents:document_version_upload', args=[document.pk])
+        clients = [Client() for _ in range(self.UPLOADS)]
+        for client in clients:
+            client.force_login(owner)
+        barrier = threading.Barrier(self.UPLOADS, timeout=30)
+
+        def upload(i):
+            client = clients[i]
+            barrier.wait()
+            try:
+                return client.post(url, {'plik': SimpleUploadedFile('umowa.txt', f'wersja {i}'.encode())}).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.UPLOADS) as pool:
+            statuses = list(pool.map(upload, range(self.UPLOADS)))
+
+        self.assertEqual(statuses, [302] * self.UPLOADS)
+        numbers = sorted(document.wersje.values_list('numer_wersji', flat=True))
+        self.assertEqual(numbers, list(range(1, self.UPLOADS + 2)))
+        document.refresh_from_db()
+        latest = document.wersje.get(numer_wersji=self.UPLOADS + 1)
+        self.assertEqual((document.licznik_wersji, document.plik.name), (self.UPLOADS + 1, latest.plik.name))
+        self.assertEqual(Blob.objects.get(sciezka=latest.plik.name).liczba_odwolan, 2)
+
+    def test_locked_database_is_retried(self):
+        owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        document = create_document(owner, 'umowa.txt', content=b'v1')
+        first_blob = document.plik.name
+        number_and_save = Document._number_and_save_version
+        calls = []
+
+        def locked_once(self, version):
+            calls.append(version.numer_wersji)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return number_and_save(self, version)
+
+        with mock.patch.object(Document, '_number_and_save_version', locked_once):
+            version = document.add_version(SimpleUploadedFile('umowa.txt', b'v2'), owner)
+        self.assertEqual((len(calls), version.numer_wersji, document.licznik_wersji), (2, 2, 2))
+        self.assertEqual(document.plik.name, version.plik.name)
+
+        # The instance remembers its new file: saving it again moves no references
+        document.save()
+        self.assertEqual(Blob.objects.get(sciezka=version.plik.name).liczba_odwolan, 2)
+        self.assertEqual(Blob.objects.get(sciezka=first_blob).liczba_odwolan, 1)
+
+    def test_busy_database_rerenders_form(self):
+        owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        document = create_document(owner, 'umowa.txt', content=b'v1')
+        self.client.force_login(owner)
+        with mock.patch.object(Document, 'add_version', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('documents.views', 'WARNING'):
+            response = self.client.post(reverse('documents:document_version_upload', args=[document.pk]),
+                                        {'plik': SimpleUploadedFile('umowa.txt', b'v2')})
+        self.assertEqual(response.status_code, 503)
+        self.assertContains(response, 'spróbuj przesłać wersję ponownie', status_code=503)
+        self.assertEqual(document.wersje.count(), 1)
+
+
+class CurrentVersionTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_superuser('owner', 'owner@example.com', 'haslo12345')
+        self.client.force_login(self.owner)
+        self.document = create_document(self.owner, 'umowa.txt', content=b'v1')
+
+    def test_new_version_becomes_current(self):
+        first = self.document.aktualna_wersja
+        self.assertEqual(first.numer_wersji, 1)
+        second = self.document.add_version(SimpleUploadedFile('umowa.txt', b'wersja 2'), self.owner)
+
+        document = Document.objects.select_related('aktualna_wersja').get(pk=self.document.pk)
+        self.assertEqual(document.aktualna_wersja, second)
+        self.assertEqual((document.plik.name, document.rozmiar_pliku, document.hash_pliku),
+                         (second.plik.name, second.rozmiar_pliku, second.hash_pliku))
+        self.assertFalse(inconsistent_documents().exists())
+
+        response = self.client.get(reverse('documents:document_download', args=[document.pk]))
+        self.assertEqual(b''.join(response.streaming_content), b'wersja 2')
+        self.assertIn('umowa_v2.txt', response['Content-Disposition'])
+
+    def test_rebuild_repairs_stale_pointer_and_fields(self):
+        second = self.document.add_version(SimpleUploadedFile('umowa.txt', b'wersja 2'), self.owner)
+        first = self.document.wersje.get(numer_wersji=1)
+        Document.objects.filter(pk=self.document.pk).update(aktualna_wersja=first, hash_pliku='')
+
+        out = io.StringIO()
+        call_command('rebuild_current_versions', '--check', stdout=out)
+        self.assertIn('1 inconsistent', out.getvalue())
+        self.assertEqual(Document.objects.get(pk=self.document.pk).aktualna_wersja_id, first.pk)
+
+        call_command('rebuild_current_versions', stdout=io.StringIO())
+        document = Document.objects.get(pk=self.document.pk)
+        self.assertEqual((document.aktualna_wersja_id, document.hash_pliku), (second.pk, second.hash_pliku))
+        self.assertFalse(inconsistent_documents().exists())
+        self.assertEqual(Blob.objects.get(sciezka=second.plik.name).liczba_odwolan, 2)
+
+
+class ImportDocumentsTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'haslo12345')
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        self.directory = os.path.join(self.source, 'archiwum')
+        self.manifest = os.path.join(self.source, 'manifest.jsonl')
+        self._write('raport.txt', b'raport roczny')
+        self._write('umowy/najem.txt', b'umowa najmu')
+        self._write('umowy/2024/kopia.txt', b'raport roczny')
+        self._write('umowy/program.exe', b'MZ')
+
+    def _write(self, relative_path, content):
+        path = os.path.join(self.directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def _import(self):
+        out = io.StringIO()
+        call_command('import_documents', self.directory, '--owner', 'owner', '--manifest', self.manifest,
+                     '--workers', '1', '--batch-size', '2', stdout=out)
+        return out.getvalue()
+
+    def test_imports_tree_like_uploads(self):
+        output = self._import()
+        self.assertIn('Imported 3 files', output)
+        self.assertIn('unsupported file: umowy/program.exe', output)
+
+        root = Folder.objects.get(nazwa='archiwum', rodzic=None)
+        self.assertEqual(Folder.objects.get(nazwa='2024').get_full_path(), 'archiwum / umowy / 2024')
+        document = Document.objects.select_related('aktualna_wersja').get(nazwa='kopia.txt')
+        self.assertEqual(document.aktualna_wersja.numer_wersji, 1)
+        self.assertEqual(document.licznik_wersji, 1)
+        with open(document.plik.path, 'rb') as f:
+            self.assertEqual(f.read(), b'raport roczny')
+
+        # What the signals maintain for single uploads
+        self.assertEqual(Blob.objects.get(sciezka=document.plik.name).liczba_odwolan, 4)
+        self.assertTrue(self.owner.has_perm('documents.download_document', document))
+        self.assertEqual(DocumentACL.objects.get(dokument=document).uprawnienia, DocumentACL.BROWSE | DocumentACL.DOWNLOAD)
+        self.assertEqual(ActivityLog.objects.filter(typ_aktywnosci='tworzenie', dokument__isnull=False).count(), 3)
+        self.assertEqual(root.statystyki.rozmiar_calkowity, 13 + 11 + 13)
+        self.assertEqual(list(search_documents('najem', Document.objects.all())[:10]),
+                         [Document.objects.get(nazwa='najem.txt')])
+        out = io.StringIO()
+        call_command('rebuild_stats', '--check', stdout=out)
+        self.assertIn('up to date', out.getvalue())
+        self.assertFalse(inconsistent_documents().exists())
+
+    def test_rerun_skips_imported_files(self):
+        self._import()
+        self._write('umowy/aneks.txt', b'aneks')
+        self.assertIn('Imported 1 files', self._import())
+        self.assertEqual(Document.objects.count(), 4)
+        self.assertEqual(Folder.objects.count(), 3)
+        with open(self.manifest, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 4)
@@ -0,0 +1,192 @@
+"""
+Cold storage tier for old document versions.
+
+Text, docx/xlsx and uncompressed PDFs are stored as uploaded, and old
+versions are rarely downloaded again. ``manage.py tier_cold_versions``
+compresses with zstd the superseded versions (see
+storage.superseded_versions: never a latest version or a document's current
+file) that nobody has downloaded for COLD_STORAGE_AFTER_DAYS. The compressed
+file is a blob under ``blobs/cold/`` with the digest and extension of the
+original; the version's ``plik`` points at it, its ``sposob_przechowywania``
+becomes STORAGE_COLD and gc_blobs deletes the original once no row uses it.
+Files zstd does not shrink to COLD_STORAGE_MIN_SAVING of their size (JPEG,
+ZIP-based formats, anything compressed already) stay whole.
+
+Downloads decompress on the fly (documents.delivery.serve_stream) in
+COLD_STREAM_CHUNK_SIZE pieces. ``DocumentVersion.ostatni_dostep`` records
+the last download, at most once per ACCESS_RESOLUTION; versions never
+downloaded count from their creation. zstandard is optional: without it
+nothing is tiered, and cold versions cannot be downloaded.
+"""
+import hashlib
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .storage import BLOB_PREFIX, blob_digest, blob_storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COLD_PREFIX = BLOB_PREFIX + 'cold/'
+COLD_STREAM_CHUNK_SIZE = 64 * 1024
+# Compressed files must be at most this fraction of the original to be kept
+COLD_STORAGE_MIN_SAVING = 0.9
+ACCESS_RESOLUTION = timedelta(hours=1)
+FRAME_HEADER_MAX_SIZE = 18
+ESTIMATE_SAMPLE_SIZE = 1024 * 1024
+
+
+def cold_name(name):
+    """Name of the compressed copy of the whole blob ``name`` (same digest and extension)."""
+    return COLD_PREFIX + name[len(BLOB_PREFIX):]
+
+
+def _level():
+    return getattr(settings, 'COLD_STORAGE_LEVEL', 10)
+
+
+def _cutoff(days=None):
+    if days is None:
+        days = getattr(settings, 'COLD_STORAGE_AFTER_DAYS', 180)
+    return timezone.now() - timedelta(days=days)
+
+
+# --- Access ---
+
+def record_access(versions):
+    """Mark the versions of the ``versions`` queryset as downloaded now (one UPDATE, throttled)."""
+    now = timezone.now()
+    versions.filter(Q(ostatni_dostep__isnull=True) | Q(ostatni_dostep__lt=now - ACCESS_RESOLUTION)).update(
+        ostatni_dostep=now
+    )
+
+
+def cold_candidates(days=None, min_size=0):
+    """
+    Names of the superseded blobs of at least ``min_size`` bytes that no
+    version using them has been downloaded in ``days`` days (default
+    COLD_STORAGE_AFTER_DAYS).
+    """
+    from .storage import superseded_versions
+
+    last_access = Coalesce('ostatni_dostep', 'data_utworzenia')
+    versions = superseded_versions().annotate(dostep=last_access)
+    recent = versions.filter(dostep__gte=_cutoff(days)).values('plik')
+    return (versions.filter(rozmiar_pliku__gte=min_size).exclude(plik__in=recent)
+            .order_by('plik').values_list('plik', flat=True).distinct())
+
+
+# --- Compression ---
+
+def compress_blob(name):
+    """
+    Write the zstd-compressed copy of the blob ``name``. Returns ``(size,
+    compressed)``, or None when the file is missing, does not match its
+    digest or would not shrink enough (then nothing is kept).
+    """
+    source = blob_storage.path(name)
+    target = blob_storage.path(cold_name(name))
+    if not os.path.isfile(source):
+        return None
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    digest = hashlib.sha256()
+    try:
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            compressor = zstandard.ZstdCompressor(level=_level(), write_checksum=True)
+            with compressor.stream_writer(dst, size=size, closefd=False) as writer:
+                for chunk in iter(lambda: src.read(COLD_STREAM_CHUNK_SIZE * 16), b''):
+                    digest.update(chunk)
+                    writer.write(chunk)
+        compressed = os.path.getsize(tmp_path)
+        if digest.hexdigest() != blob_digest(name):
+            logger.error('Blob %s does not match its digest, left whole', name)
+            return None
+        if compressed > size * COLD_STORAGE_MIN_SAVING:
+            return None
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size, compressed
+
+
+def tier_blob(name):
+    """
+    Compress the blob ``name`` and point the versions using it at the
+    compressed copy. Returns ``(versions, size, compressed)``, None when it
+    stays whole.
+    """
+    from .models import DocumentVersion
+    from .storage import repoint_versions
+
+    result = compress_blob(name)
+    if result is None:
+        return None
+    return (repoint_versions(name, cold_name(name), DocumentVersion.STORAGE_COLD), *result)
+
+
+def estimate_saving(name):
+    """Expected ``(size, compressed)`` of the blob ``name`` from its first ESTIMATE_SAMPLE_SIZE bytes."""
+    path = blob_storage.path(name)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        sample = f.read(ESTIMATE_SAMPLE_SIZE)
+    if not sample:
+        return size, size
+    ratio = len(zstandard.ZstdCompressor(level=_level()).compress(sample)) / len(sample)
+    return size, min(size, int(size * ratio))
+
+
+# --- Reading ---
+
+class ColdContent:
+    """The original bytes of a compressed blob, decompressed as they are iterated; ``size`` is their length."""
+
+    def __init__(self, path):
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed: cold versions cannot be read')
+        with open(path, 'rb') as f:
+            self.size = zstandard.get_frame_parameters(f.read(FRAME_HEADER_MAX_SIZE)).content_size
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            yield from zstandard.ZstdDecompressor().read_to_iter(
+                f, read_size=COLD_STREAM_CHUNK_SIZE, write_size=COLD_STREAM_CHUNK_SIZE
+            )
+
+
+def open_cold(name):
+    """ColdContent of the stored blob ``name``; FileNotFoundError when it is missing."""
+    return ColdContent(blob_storage.path(name))
+
+
+def open_stored_version(version):
+    """The content of a version not stored whole (chunked or cold), iterable with its ``size``."""
+    from .chunked import open_chunked
+
+    if version.sposob_przechowywania == version.STORAGE_CHUNKED:
+        return open_chunked(version.plik.name)
+    return open_cold(version.plik.name)
+
+
+def storage_state(versions):
+    """
+    ``'goracy'`` when every version of a document is stored whole, else
+    ``'zimny'`` (its old versions are chunked or compressed).
+    """
+    if all(version.sposob_przechowywania == version.STORAGE_WHOLE for version in versions):
+        return 'goracy'
+    return 'zimny'
@@ -0,0 +1,120 @@
+"""
+Folder tree loading helpers.
+
+Walking ``Folder.rodzic`` / ``Folder.podkatalogi`` one lazy relation at a time
+costs a query per folder and per document. The helpers below use the
+materialized path on ``Folder`` to fetch a whole subtree (or the ancestor
+chain of a folder) in a constant number of queries and assemble the structure
+in memory.
+"""
+import os
+
+from .models import Document, Folder
+
+
+def compute_folder_paths(folders):
+    """Compute ``{pk: (sciezka, sciezka_nazw, poziom)}`` from ``rodzic`` links alone.
+
+    Used to verify or rebuild the materialized path columns; folders whose
+    parent chain is broken or cyclic are treated as roots.
+    """
+    rows = {f.pk: f for f in folders}
+    paths = {}
+    for folder in rows.values():
+        chain = []
+        seen = set()
+        current = folder
+        while current is not None and current.pk not in paths and current.pk not in seen:
+            seen.add(current.pk)
+            chain.append(current)
+            current = rows.get(current.rodzic_id)
+        for item in reversed(chain):
+            parent = paths.get(item.rodzic_id)
+            if parent:
+                sciezka = f"{parent[0]}{item.pk}/"
+                sciezka_nazw = f"{parent[1]}{Folder.PATH_SEPARATOR}{item.nazwa}"
+            else:
+                sciezka, sciezka_nazw = f"/{item.pk}/", item.nazwa
+            paths[item.pk] = (sciezka, sciezka_nazw, sciezka.count('/') - 2)
+    return paths
+
+
+def get_folder_ancestors(folder):
+    """Return the path from the root folder down to ``folder`` (inclusive).
+
+    Uses a single indexed lookup on the materialized path. Each returned folder
+    has its ``rodzic`` relation cached, so walking it afterwards is free.
+    """
+    if folder is None:
+        return []
+    by_id = {f.pk: f for f in Folder.objects.filter(pk__in=folder.get_ancestor_ids())}
+    by_id[folder.pk] = folder
+
+    chain = []
+    current = folder
+    while current is not None:
+        chain.insert(0, current)
+        current = by_id.get(current.rodzic_id)
+    for parent, child in zip(chain, chain[1:]):
+        child.rodzic = parent
+    if chain[0].rodzic_id is None:
+        chain[0].rodzic = None
+    return chain
+
+
+class FolderTree:
+    """In-memory view of a folder subtree with its documents.
+
+    Every document carries a ``latest_version`` attribute (``None`` when it has
+    no versions), so callers never have to touch ``doc.wersje``.
+    """
+
+    def __init__(self, root, folders, documents):
+        self.root = root
+        self._children = {}
+        self._documents = {}
+        for folder in folders:
+            if folder.pk != root.pk:
+                self._children.setdefault(folder.rodzic_id, []).append(folder)
+        for document in documents:
+            self._documents.setdefault(document.folder_id, []).append(document)
+        for siblings in self._children.values():
+            siblings.sort(key=lambda f: f.nazwa)
+        for docs in self._documents.values():
+            docs.sort(key=lambda d: d.nazwa)
+
+    def children(self, folder):
+        return self._children.get(folder.pk, [])
+
+    def documents(self, folder):
+        return self._documents.get(folder.pk, [])
+
+    def walk(self, base_path=None):
+        """Yield ``(folder, path)`` pairs depth-first, starting with the root."""
+        stack = [(self.root, base_path if base_path is not None else self.root.nazwa)]
+        while stack:
+            folder, path = stack.pop()
+            yield folder, path
+            for child in reversed(self.children(folder)):
+                stack.append((child, os.path.join(path, child.nazwa)))
+
+    def all_documents(self):
+        for docs in self._documents.values():
+            yield from docs
+
+
+def load_folder_tree(root):
+    """Load ``root`` with all its descendants, live documents and their latest versions.
+
+    Runs two queries regardless of the depth or width of the tree.
+    """
+    subtree_ids = root.get_descendants(include_self=True).values('pk')
+    folders = list(Folder.objects.filter(pk__in=subtree_ids))
+
+    documents = list(Document.objects.filter(
+        folder__in=subtree_ids, usunieto=False
+    ).select_related('aktualna_wersja'))
+    for document in documents:
+        document.latest_version = document.aktualna_wersja
+
+    return FolderTree(root, folders, documents)
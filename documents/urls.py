@@ -17,7 +17,13 @@ urlpatterns = [
     path('documents/<int:pk>/delete/', views.DocumentDeleteView.as_view(), name='document_delete'),
     path('documents/<int:pk>/download/', views.document_download, name='document_download'),
     path('documents/<int:pk>/preview/', views.document_preview, name='document_preview'),
+    path('documents/<int:pk>/thumbnail/<int:size>/', views.document_thumbnail, name='document_thumbnail'),
     path('documents/<int:pk>/version/upload/', views.document_version_upload, name='document_version_upload'),
+
+    # Resumable uploads
+    path('uploads/', views.upload_session_create, name='upload_session_create'),
+    path('uploads/<uuid:pk>/', views.upload_session_detail, name='upload_session_detail'),
+    path('uploads/<uuid:pk>/finalize/', views.upload_session_finalize, name='upload_session_finalize'),
     
     # Folders (admin only)
     
@@ -32,4 +38,5 @@ urlpatterns = [
     
     # Search and API
     path('search/', views.search_results, name='search_results'),
+    path('activity-log/stats/', views.activity_log_stats, name='activity_log_stats'),
 ]
\ No newline at end of file
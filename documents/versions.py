@@ -0,0 +1,64 @@
+"""
+The current version of a document.
+
+``Document.aktualna_wersja`` points at the highest numbered version and the
+document's file fields (plik, rozmiar_pliku, hash_pliku, typ_mime) are copies
+of that version's, so downloads, ZIPs and folder listings get the current
+version with ``select_related`` instead of one lookup per document.
+Document.add_first_version and Document.add_version keep them up to date.
+
+Changes that bypass those methods (versions created or deleted directly,
+queryset update(), raw SQL) leave them stale: ``manage.py
+rebuild_current_versions`` finds and repairs such documents.
+"""
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+CACHED_FIELDS = ['plik', 'rozmiar_pliku', 'hash_pliku', 'typ_mime']
+
+
+def latest_version_id():
+    """Subquery: pk of the highest numbered version of the outer document."""
+    from .models import DocumentVersion
+
+    return Subquery(DocumentVersion.objects.filter(dokument=OuterRef('pk'))
+                    .order_by('-numer_wersji').values('pk')[:1])
+
+
+def inconsistent_documents():
+    """Documents whose aktualna_wersja is not the latest version, or whose file fields differ from it."""
+    from .models import Document
+
+    wrong_pointer = (Q(aktualna_wersja__isnull=True, najnowsza__isnull=False)
+                     | Q(aktualna_wersja__isnull=False, najnowsza__isnull=True)
+                     | ~Q(aktualna_wersja=F('najnowsza')))
+    stale_fields = Q(aktualna_wersja__isnull=False) & (
+        ~Q(plik=F('aktualna_wersja__plik'))
+        | ~Q(hash_pliku=F('aktualna_wersja__hash_pliku'))
+        | ~Q(typ_mime=F('aktualna_wersja__typ_mime'))
+        | ~Q(rozmiar=Coalesce('aktualna_wersja__rozmiar_pliku', Value(0)))
+    )
+    return (Document.objects.annotate(najnowsza=latest_version_id(), rozmiar=Coalesce('rozmiar_pliku', Value(0)))
+            .filter(wrong_pointer | stale_fields).order_by('pk'))
+
+
+def repair_current_version(document_id):
+    """
+    Point the document at its latest version and copy that version's file
+    fields, saving through the model so blob references and statistics
+    follow. Returns the version, None when the document has none.
+    """
+    from .models import Document
+
+    with transaction.atomic():
+        document = Document.objects.select_for_update().get(pk=document_id)
+        version = document.wersje.order_by('-numer_wersji').first()
+        document.aktualna_wersja = version
+        if version is None:
+            document.save(update_fields=['aktualna_wersja'])
+            return None
+        for field in CACHED_FIELDS:
+            setattr(document, field, getattr(version, field))
+        document.save(update_fields=['aktualna_wersja', *CACHED_FIELDS])
+    return version
@@ -2,45 +2,50 @@
 
 import os
 import mimetypes
-from datetime import datetime
 import logging
-from itertools import chain
-from urllib.parse import quote
-import io
-import zipfile
 
-from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator
-from django.db import transaction
-from django.db.models import Prefetch, Q, Count, Sum
-from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.db import OperationalError
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.http import (Http404, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect, render
-from django.urls import reverse, reverse_lazy
+from django.urls import reverse
 from django.views.generic import (CreateView, FormView,
                                   ListView, UpdateView, DetailView)
-from django.views.generic.detail import SingleObjectMixin
 from django import forms
 
-from guardian.shortcuts import assign_perm, get_objects_for_user
+from guardian.shortcuts import assign_perm
 
-from users.permissions import (user_can_comment_on_document,
+from users.permissions import (get_permission_index, get_permission_resolver,
                                user_can_create_document,
                                user_can_create_folder,
                                user_can_delete_document,
                                user_can_delete_folder, user_can_edit_document,
                                user_can_edit_folder,
-                               user_can_share_document,
                                user_can_view_document, user_can_view_folder)
 
+from .activity import get_activity_writer, log_activity
+from .comments import load_comment_thread
+from .delivery import audits_delivery, serve_file, serve_stream
 from .forms import (CommentForm, DocumentUpdateForm, DocumentUploadForm,
                     DocumentVersionUploadForm, FolderCreateForm,
-                    FolderDeleteForm, FolderUpdateForm)
-from .models import (ActivityLog, Comment, Document, DocumentVersion, Folder,
-                     Tag)
+                    FolderUpdateForm, UploadSessionForm)
+from .listing import decode_cursor, listing_page
+from .models import Document, DocumentVersion, Folder, UploadSession, UserStats
+from .previews import (THUMBNAIL_SIZES, can_render, extracted_text_page, file_extension,
+                       get_thumbnail, read_text_page)
+from . import resumable
+from .search import search_documents
+from .tiering import open_stored_version, record_access, storage_state
+from .tree import get_folder_ancestors, load_folder_tree
+from .zip_stream import stream_zip
 
 # --- Logger ---
 logger = logging.getLogger(__name__)
@@ -58,21 +63,23 @@ def get_client_ip(request):
     return ip
 
 def _log_activity(user, action_type, document=None, folder=None, details="", ip_address=""):
-    """Helper to create an ActivityLog entry."""
-    ActivityLog.objects.create(
-        uzytkownik=user,
-        typ_aktywnosci=action_type,
-        dokument=document,
-        folder=folder,
-        szczegoly=details,
-        adres_ip=ip_address
-    )
+    """Helper to record an ActivityLog entry (queued for the background writer, see documents.activity)."""
+    log_activity(user, action_type, document=document, folder=folder, details=details, ip_address=ip_address)
 # --- Main Views (Class-Based) ---
 
+# Items per page of a folder listing (folders first, then documents)
+HOME_PAGE_SIZE = 100
+
+
 class HomeView(LoginRequiredMixin, ListView):
     template_name = 'documents/home.html'
     context_object_name = 'items'
 
+    def get_template_names(self):
+        if self.request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return ['documents/partials/home_page.html']  # "Load more": just the next items
+        return [self.template_name]
+
     def get_queryset(self):
         folder_id = self.kwargs.get('folder_id')
         self.current_folder = None
@@ -80,64 +87,60 @@ class HomeView(LoginRequiredMixin, ListView):
 
         if folder_id:
             self.current_folder = get_object_or_404(Folder, pk=folder_id)
-            if not user_can_view_folder(user, self.current_folder):
+            if not get_permission_resolver(self.request).can_view_folder(self.current_folder):
                 raise PermissionDenied("You do not have permission to view this folder.")
 
-        browseable_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
-        browseable_documents = get_objects_for_user(user, 'documents.browse_document', klass=Document)
+        index = get_permission_index(self.request)
+        folder_qs = index.filter_folders(Folder.objects.filter(rodzic=self.current_folder))
+        document_qs = index.filter_documents(Document.objects.filter(folder=self.current_folder, usunieto=False))
 
-        folder_qs = browseable_folders.filter(rodzic=self.current_folder)
-        document_qs = browseable_documents.filter(folder=self.current_folder, usunieto=False)
-        
+        # Precomputed counters (documents.stats): a join, not an aggregate per folder
         folder_qs = folder_qs.annotate(
-            doc_count=Count('documents', filter=Q(documents__usunieto=False)),
-            subfolder_count=Count('podkatalogi')
+            doc_count=Coalesce(F('statystyki__liczba_dokumentow'), 0),
+            subfolder_count=Coalesce(F('statystyki__liczba_podfolderow'), 0),
         ).select_related('wlasciciel__profile').prefetch_related('tagi')
 
         document_qs = document_qs.select_related('wlasciciel__profile', 'folder').prefetch_related('tagi')
-        
-        return list(folder_qs) + list(document_qs)
+
+        page, self.next_cursor = listing_page(
+            [('f', folder_qs), ('d', document_qs)], decode_cursor(self.request.GET.get('po')), HOME_PAGE_SIZE
+        )
+        self.page_folders, self.page_documents = page['f'], page['d']
+        return self.page_folders + self.page_documents
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
 
-        all_items = context['items']
-        folders = [item for item in all_items if isinstance(item, Folder)]
-        documents = [item for item in all_items if isinstance(item, Document)]
-        
+        folders, documents = self.page_folders, self.page_documents
+        resolver = get_permission_resolver(self.request)
+        resolver.prefetch(context['items'])
         for item in folders:
-            item.current_user_can_edit = user_can_edit_folder(user, item)
-            item.current_user_can_delete = user_can_delete_folder(user, item)
+            item.current_user_can_edit = resolver.can_edit_folder(item)
+            item.current_user_can_delete = resolver.can_delete_folder(item)
         for item in documents:
-            item.current_user_can_edit = user_can_edit_document(user, item)
-            item.current_user_can_delete = user_can_delete_document(user, item)
-            
-        context['folders'] = sorted(folders, key=lambda f: f.nazwa)
-        context['documents'] = sorted(documents, key=lambda d: d.nazwa)
+            item.current_user_can_edit = resolver.can_edit_document(item)
+            item.current_user_can_delete = resolver.can_delete_document(item)
+
+        context['folders'] = folders
+        context['documents'] = documents
+        context['next_cursor'] = self.next_cursor
+        context['is_continuation'] = bool(self.request.GET.get('po'))
 
         context['current_folder'] = self.current_folder
         context['is_root'] = self.current_folder is None
-        context['user_can_create_documents'] = user_can_create_document(user, self.current_folder)
-        context['user_can_create_folders'] = user_can_create_folder(user, self.current_folder)
-
-        breadcrumbs = []
-        if self.current_folder:
-            temp_folder = self.current_folder
-            while temp_folder:
-                breadcrumbs.insert(0, temp_folder)
-                temp_folder = temp_folder.rodzic
-        context['breadcrumbs'] = breadcrumbs
-
-        if context['is_root']:
-            user_docs = get_objects_for_user(user, 'documents.browse_document', klass=Document).filter(usunieto=False)
-            user_folders = get_objects_for_user(user, 'documents.browse_folder', klass=Folder)
-            stats = user_docs.aggregate(total_size=Sum('rozmiar_pliku'))
-            
-            context['total_documents'] = user_docs.count()
-            context['total_folders'] = user_folders.count()
-            context['total_size'] = self._human_readable_size(stats['total_size'] or 0)
-            
+        context['user_can_create_documents'] = resolver.can_create_document(self.current_folder)
+        context['user_can_create_folders'] = resolver.can_create_folder(self.current_folder)
+
+        context['breadcrumbs'] = get_folder_ancestors(self.current_folder)
+
+        if context['is_root'] and not context['is_continuation']:
+            # What the user owns (the cards say so), not everything they may browse
+            stats = UserStats.objects.filter(pk=user.pk).first() or UserStats()
+            context['total_documents'] = stats.liczba_dokumentow
+            context['total_folders'] = stats.liczba_folderow
+            context['total_size'] = self._human_readable_size(stats.rozmiar_calkowity)
+
         return context
 
     def _human_readable_size(self, size_bytes):
@@ -155,25 +158,20 @@ def document_detail(request, pk):
         'tagi',
         'wersje__utworzony_przez__profile',
         'metadane',
-        Prefetch('komentarze', queryset=Comment.objects.filter(aktywny=True, wersja_dokumentu__isnull=True).select_related('uzytkownik__profile').order_by('data_utworzenia'))
     ).select_related('wlasciciel__profile', 'folder'), pk=pk, usunieto=False)
 
-    if not user_can_view_document(request.user, document):
+    resolver = get_permission_resolver(request)
+    resolver.prefetch([document])
+    if not resolver.can_view_document(document):
         raise PermissionDenied("You do not have permission to view this document.")
 
-    # Handle comment submission
-    # Fetch all comments related to this document, including those linked to versions
-    all_comments = Comment.objects.filter(
-        Q(dokument=document) | Q(wersja_dokumentu__dokument=document),
-        aktywny=True
-    ).select_related('uzytkownik__profile', 'wersja_dokumentu').order_by('data_utworzenia')
+    versions = sorted(document.wersje.all(), key=lambda version: version.numer_wersji, reverse=True)
 
     # Initialize the main comment form
     # Default to commenting on the document itself, or the latest version if available
-    latest_version = document.wersje.order_by('-numer_wersji').first()
     initial_comment_data = {'dokument': document.pk}
-    if latest_version:
-        initial_comment_data['wersja_dokumentu'] = latest_version.pk
+    if document.aktualna_wersja_id:
+        initial_comment_data['wersja_dokumentu'] = document.aktualna_wersja_id
     
     comment_form = CommentForm(initial=initial_comment_data)
 
@@ -204,87 +202,125 @@ def document_detail(request, pk):
             messages.success(request, 'Komentarz dodany pomyślnie.')
             return redirect('documents:document_detail', pk=document.pk)
 
+    # Every comment of the document and its versions, as a reply tree (one query)
+    comment_thread = load_comment_thread(document)
     context = {
         'document': document,
-        'all_comments': all_comments, # New context variable
+        'all_comments': comment_thread,
         'comment_form': comment_form,
-        'can_edit_this_document': user_can_edit_document(request.user, document),
-        'can_delete_this_document': user_can_delete_document(request.user, document),
-        'can_comment_on_this_document': user_can_comment_on_document(request.user, document),
-        'can_download_this_document': request.user.has_perm('documents.download_document', document),
+        'can_edit_this_document': resolver.can_edit_document(document),
+        'can_delete_this_document': resolver.can_delete_document(document),
+        'can_comment_on_this_document': resolver.can_comment_on_document(document),
+        'can_download_this_document': resolver.can_download_document(document),
         'can_preview_this_document': document.can_preview(),
-        'versions': document.wersje.all().order_by('-numer_wersji'), # Still need versions for history display
+        'thumbnail_url': (reverse('documents:document_thumbnail', args=[document.pk, THUMBNAIL_SIZES[1]])
+                          if document.plik and document.hash_pliku and can_render(file_extension(document.plik.name)) else None),
+        'versions': versions,
+        'storage_state': storage_state(versions),
     }
 
-    # Add version-specific comments to each version object for template display
-    for version in context['versions']:
-        version.comments = version.komentarze.filter(aktywny=True).select_related('uzytkownik__profile').order_by('data_utworzenia')
+    for version in versions:
+        version.comments = comment_thread.for_version(version)
     return render(request, 'documents/document_detail.html', context)
 
 @login_required
 def document_download(request, pk):
-    document = get_object_or_404(Document, pk=pk)
+    document = get_object_or_404(Document.objects.select_related('aktualna_wersja'), pk=pk)
     if not user_can_view_document(request.user, document):
         raise PermissionDenied("You do not have permission to download this document.")
     
-    # Pobierz najnowszą wersję dokumentu
-    latest_version = document.wersje.order_by('-numer_wersji').first()
+    # Najnowsza wersja dokumentu (wczytana razem z dokumentem)
+    latest_version = document.aktualna_wersja
 
     if not latest_version or not latest_version.plik:
         raise Http404("Brak dostępnej wersji pliku do pobrania.")
 
-    file_path = latest_version.plik.path
-    if not os.path.exists(file_path):
-        raise Http404("Plik najnowszej wersji nie został znaleziony na serwerze.")
-
-    _log_activity(request.user, 'pobieranie', document=document, details=f"Pobrał najnowszą wersję ({latest_version.numer_wersji}) dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
-    
-    content_type, encoding = mimetypes.guess_type(file_path)
-    if content_type is None:
-        content_type = 'application/octet-stream'
-    
     # Generowanie nazwy pliku dla głównego dokumentu (najnowsza wersja)
     ext = os.path.splitext(latest_version.plik.name)[1]
     base_document_name = os.path.splitext(document.nazwa)[0]
-    full_filename = f"{base_document_name}_v{latest_version.numer_wersji}{ext}"
-    
-    # Kodowanie nazwy pliku dla nagłówka Content-Disposition
-    try:
-        # ASCII fallback for older browsers
-        ascii_filename = full_filename.encode('ascii', 'ignore').decode('ascii')
-    except UnicodeEncodeError:
-        ascii_filename = 'download' + os.path.splitext(full_filename)[1] # Fallback if it can't be ASCII-encoded
+    response = serve_file(request, latest_version.plik, f"{base_document_name}_v{latest_version.numer_wersji}{ext}",
+                          etag=latest_version.hash_pliku, last_modified=latest_version.data_utworzenia)
+    if audits_delivery(request, response, 'pobieranie', latest_version):
+        record_access(DocumentVersion.objects.filter(pk=latest_version.pk))
+        _log_activity(request.user, 'pobieranie', document=document, details=f"Pobrał najnowszą wersję ({latest_version.numer_wersji}) dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
+    return response
 
-    # UTF-8 encoded filename for modern browsers (RFC 6266)
-    utf8_filename = quote(full_filename)
+INLINE_PREVIEW_TYPES = {'application/pdf', 'image/png', 'image/jpeg'}
 
-    response = FileResponse(open(file_path, 'rb'), content_type=content_type)
-    response['Content-Disposition'] = f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{utf8_filename}"
-    return response
 
 @login_required
 def document_preview(request, pk):
     document = get_object_or_404(Document, pk=pk)
     if not user_can_view_document(request.user, document):
         raise PermissionDenied("You do not have permission to preview this document.")
-
-    file_path = document.plik.path
-    if not os.path.exists(file_path):
+    if not document.plik:
         raise Http404("Document file not found.")
 
-    content_type, encoding = mimetypes.guess_type(file_path)
-    
-    # For simplicity, let's assume we can preview text files directly
-    # For other types, we might just show a message or link to download
+    extension = file_extension(document.plik.name)
+    content_type, encoding = mimetypes.guess_type(document.plik.name)
+
+    def open_original():
+        # Browsers display these themselves: deliver the file inline like a download
+        filename = os.path.splitext(document.nazwa)[0] + os.path.splitext(document.plik.name)[1]
+        response = serve_file(request, document.plik, filename, content_type, as_attachment=False, etag=document.hash_pliku)
+        if audits_delivery(request, response, 'podglad', document):
+            _log_activity(request.user, 'podglad', document=document, details=f"Otworzył oryginał dokumentu '{document.nazwa}' w przeglądarce", ip_address=get_client_ip(request))
+        return response
+
+    if 'oryginal' in request.GET and content_type in INLINE_PREVIEW_TYPES:
+        return open_original()
+
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        offset = 0
+    context = {
+        'document': document,
+        'offset': offset,
+        'can_open_original': content_type in INLINE_PREVIEW_TYPES,
+    }
     if content_type and content_type.startswith('text/'):
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        _log_activity(request.user, 'podglad', document=document, details=f"Wyświetlił podgląd dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
-        return render(request, 'documents/document_preview.html', {'document': document, 'content': content, 'is_text': True})
+        # One page from the byte offset, however large the file is
+        try:
+            context['content'], context['next_offset'] = read_text_page(document.plik.path, offset)
+        except FileNotFoundError:
+            raise Http404("Document file not found.")
+        context['is_text'] = True
+    elif can_render(extension) and document.hash_pliku:
+        context['is_image'] = True
+        context['thumbnail_url'] = reverse('documents:document_thumbnail', args=[document.pk, THUMBNAIL_SIZES[-1]])
     else:
-        _log_activity(request.user, 'podglad', document=document, details=f"Próbował wyświetlić podgląd dokumentu '{document.nazwa}' (nieobsługiwany typ)", ip_address=get_client_ip(request))
-        messages.info(request, "Podgląd dla tego typu pliku nie jest obsługiwany. Możesz pobrać plik.")
-        return redirect('documents:document_detail', pk=document.pk)
+        page = extracted_text_page(document, offset)
+        if page is None and content_type in INLINE_PREVIEW_TYPES:
+            return open_original()  # E.g. a scanned PDF without pypdfium2
+        if page is None:
+            _log_activity(request.user, 'podglad', document=document, details=f"Próbował wyświetlić podgląd dokumentu '{document.nazwa}' (nieobsługiwany typ)", ip_address=get_client_ip(request))
+            messages.info(request, "Podgląd dla tego typu pliku nie jest obsługiwany. Możesz pobrać plik.")
+            return redirect('documents:document_detail', pk=document.pk)
+        context['content'], context['next_offset'] = page
+        context['is_text'] = True
+        context['is_extracted'] = True
+
+    if not offset:
+        _log_activity(request.user, 'podglad', document=document, details=f"Wyświetlił podgląd dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
+    return render(request, 'documents/document_preview.html', context)
+
+
+@login_required
+def document_thumbnail(request, pk, size):
+    """JPEG thumbnail of the document's current file, rendered on first use (see documents.previews)."""
+    document = get_object_or_404(Document, pk=pk)
+    if not user_can_view_document(request.user, document):
+        raise PermissionDenied("You do not have permission to preview this document.")
+    if size not in THUMBNAIL_SIZES or not document.hash_pliku:
+        raise Http404("Brak miniatury.")
+
+    extension = file_extension(document.plik.name)
+    preview = get_thumbnail(document.plik, document.hash_pliku, extension, size)
+    if preview is None:
+        raise Http404("Brak miniatury.")
+    filename = f"{os.path.splitext(document.nazwa)[0]}-{size}.jpg"
+    return serve_file(request, preview, filename, 'image/jpeg', as_attachment=False, etag=f"{document.hash_pliku}-{size}")
 
 @login_required
 def document_version_upload(request, pk):
@@ -295,36 +331,14 @@ def document_version_upload(request, pk):
     if request.method == 'POST':
         form = DocumentVersionUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            new_version_file = form.cleaned_data['plik']
-            # Determine the next version number
-            last_version = document.wersje.order_by('-numer_wersji').first()
-            if last_version:
-                next_version_number = last_version.numer_wersji + 1
-            else:
-                next_version_number = 1
-
-            # Determine the next version number
-            last_version = document.wersje.order_by('-numer_wersji').first()
-            if last_version:
-                next_version_number = last_version.numer_wersji + 1
-            else:
-                next_version_number = 1
-
-            DocumentVersion.objects.create(
-                dokument=document,
-                numer_wersji=next_version_number,
-                plik=new_version_file,
-                oryginalna_nazwa_pliku=new_version_file.name,
-                rozmiar_pliku=new_version_file.size,
-                utworzony_przez=request.user
-            )
-            # Update main document's file to the latest version
-            document.plik = new_version_file
-            document.nazwa_pliku = new_version_file.name
-            document.rozmiar_pliku = new_version_file.size
-            document.typ_pliku = mimetypes.guess_type(new_version_file.name)[0] or 'application/octet-stream'
-            document.ostatnia_modyfikacja = datetime.now()
-            document.save()
+            try:
+                document.add_version(form.cleaned_data['plik'], request.user, komentarz=form.cleaned_data['komentarz'])
+            except OperationalError:
+                # Baza zajęta przez inne zapisy dłużej niż limit oczekiwania
+                logger.warning('Version upload for document %s timed out waiting for the database', document.pk)
+                form.add_error(None, 'Serwer jest chwilowo zajęty, spróbuj przesłać wersję ponownie.')
+                return render(request, 'documents/document_version_upload.html',
+                              {'document': document, 'form': form}, status=503)
 
             _log_activity(request.user, 'nowa_wersja', document=document, details=f"Przesłał nową wersję dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
             messages.success(request, 'Nowa wersja dokumentu została pomyślnie przesłana.')
@@ -346,37 +360,20 @@ def document_version_download(request, document_pk, version_pk):
     if not version.plik:
         raise Http404("Plik tej wersji nie istnieje.")
 
-    file_path = version.plik.path
-    if not os.path.exists(file_path):
-        raise Http404("Plik wersji dokumentu nie został znaleziony na serwerze.")
-
-    _log_activity(request.user, 'pobieranie', document=document, details=f"Pobrał wersję {version.numer_wersji} dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
-
-    content_type, encoding = mimetypes.guess_type(file_path)
-    if content_type is None:
-        content_type = 'application/octet-stream'
-
-    # Generowanie nazwy pliku z numerem wersji
-    # Używamy nazwy dokumentu i numeru wersji
-    # Pobierz rozszerzenie z pliku wersji
+    # Nazwa pliku: nazwa dokumentu (bez rozszerzenia), numer wersji i rozszerzenie pliku wersji
     ext = os.path.splitext(version.plik.name)[1]
-    # Użyj nazwy dokumentu (bez rozszerzenia) jako podstawy
     base_document_name = os.path.splitext(document.nazwa)[0]
-    version_filename = f"{base_document_name}_v{version.numer_wersji}{ext}"
-
-    # Kodowanie nazwy pliku dla nagłówka Content-Disposition
-    try:
-        # ASCII fallback for older browsers
-        ascii_filename = version_filename.encode('ascii', 'ignore').decode('ascii')
-    except UnicodeEncodeError:
-        ascii_filename = 'version_download' + os.path.splitext(version_filename)[1] # Fallback if it can't be ASCII-encoded
-
-    # UTF-8 encoded filename for modern browsers (RFC 6266)
-    utf8_filename = quote(version_filename)
-
-    response = FileResponse(open(file_path, 'rb'), content_type=content_type)
-    response['Content-Disposition'] = f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{utf8_filename}"
-    return response
+    filename = f"{base_document_name}_v{version.numer_wersji}{ext}"
+    if version.sposob_przechowywania != DocumentVersion.STORAGE_WHOLE:
+        # Starsza wersja we fragmentach lub w archiwum: odtwarzana w locie
+        response = serve_stream(request, lambda: open_stored_version(version), filename,
+                                etag=version.hash_pliku, last_modified=version.data_utworzenia)
+    else:
+        response = serve_file(request, version.plik, filename,
+                              etag=version.hash_pliku, last_modified=version.data_utworzenia)
+    if audits_delivery(request, response, 'pobieranie', version):
+        record_access(DocumentVersion.objects.filter(pk=version.pk))
+        _log_activity(request.user, 'pobieranie', document=document, details=f"Pobrał wersję {version.numer_wersji} dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
     return response
 
 class DocumentUploadView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
@@ -401,14 +398,7 @@ class DocumentUploadView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
         assign_perm('documents.download_document', self.request.user, self.object) # Dodano uprawnienie do pobierania dla właściciela
 
         # Utwórz pierwszą wersję dokumentu
-        DocumentVersion.objects.create(
-            dokument=self.object,
-            numer_wersji=1,
-            plik=self.object.plik, # Użyj pliku z głównego dokumentu
-            oryginalna_nazwa_pliku=self.object.plik.name,
-            rozmiar_pliku=self.object.rozmiar_pliku,
-            utworzony_przez=self.request.user
-        )
+        self.object.add_first_version(self.request.user)
 
         _log_activity(self.request.user, 'tworzenie', document=self.object, details=f"Utworzył dokument '{self.object.nazwa}'", ip_address=get_client_ip(self.request))
         messages.success(self.request, f'Dokument "{self.object.nazwa}" został przesłany pomyślnie.')
@@ -478,22 +468,17 @@ class FolderDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
     context_object_name = 'folder'
 
     def test_func(self):
-        return user_can_view_folder(self.request.user, self.get_object())
+        return get_permission_resolver(self.request).can_view_folder(self.get_object())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
-        folder = self.get_object()
-        context['can_edit_this_folder'] = user_can_edit_folder(user, folder)
-        context['can_delete_this_folder'] = user_can_delete_folder(user, folder)
-        context['can_download_this_folder'] = user_can_view_folder(user, folder) # Assuming view permission is enough for download
-
-        breadcrumbs = []
-        temp_folder = folder
-        while temp_folder:
-            breadcrumbs.insert(0, temp_folder)
-            temp_folder = temp_folder.rodzic
-        context['breadcrumbs'] = breadcrumbs
+        resolver = get_permission_resolver(self.request)
+        folder = self.object
+        context['can_edit_this_folder'] = resolver.can_edit_folder(folder)
+        context['can_delete_this_folder'] = resolver.can_delete_folder(folder)
+        context['can_download_this_folder'] = resolver.can_view_folder(folder) # Assuming view permission is enough for download
+
+        context['breadcrumbs'] = get_folder_ancestors(folder)
 
         return context
 
@@ -532,28 +517,39 @@ class FolderDeleteView(LoginRequiredMixin, UserPassesTestMixin, FormView):
         messages.success(self.request, 'Folder został pomyślnie usunięty.')
         return redirect(reverse('documents:home'))
 
+SEARCH_RESULTS_PER_PAGE = 25
+
+
 @login_required
 def search_results(request):
     query = request.GET.get('query', '')
     documents = Document.objects.none()
     folders = Folder.objects.none()
+    page_obj = None
+    documents_truncated = False
 
     if query:
-        # Search in documents
-        documents = get_objects_for_user(request.user, 'documents.browse_document', klass=Document).filter(
-            Q(nazwa__icontains=query) | Q(opis__icontains=query)
-        ).filter(usunieto=False).select_related('wlasciciel__profile', 'folder').prefetch_related('tagi')
+        # Search in documents: ranked full-text match within what the user may browse
+        index = get_permission_index(request)
+        visible = index.filter_documents(Document.objects.filter(usunieto=False))
+        ranked = search_documents(query, visible, Document.objects.select_related('wlasciciel__profile', 'folder').prefetch_related('tagi'))
+        page_obj = Paginator(ranked, SEARCH_RESULTS_PER_PAGE).get_page(request.GET.get('page'))
+        documents = page_obj.object_list
+        documents_truncated = ranked.truncated
 
         # Search in folders
-        folders = get_objects_for_user(request.user, 'documents.browse_folder', klass=Folder).filter(
+        folders = index.filter_folders(Folder.objects.filter(
             Q(nazwa__icontains=query) | Q(opis__icontains=query)
-        ).select_related('wlasciciel__profile').prefetch_related('tagi')
+        )).select_related('wlasciciel__profile').prefetch_related('tagi')
 
         _log_activity(request.user, 'wyszukiwanie', details=f"Wyszukał '{query}'", ip_address=get_client_ip(request))
 
     context = {
         'query': query,
         'documents': documents,
+        'page_obj': page_obj,
+        'document_count': page_obj.paginator.count if page_obj else 0,
+        'documents_truncated': documents_truncated,
         'folders': folders,
     }
     return render(request, 'documents/search_results.html', context)
@@ -565,15 +561,11 @@ def folder_download_zip(request, pk):
     if not user_can_view_folder(request.user, folder):
         raise PermissionDenied("You do not have permission to download this folder.")
 
-    # Create a in-memory zip file
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        # Function to recursively add folder contents
-        def add_folder_to_zip(current_folder, base_path=""):
-            # Add documents in the current folder
-            documents = Document.objects.filter(folder=current_folder, usunieto=False)
-            for doc in documents:
-                latest_version = doc.wersje.order_by('-numer_wersji').first()
+    def iter_folder_entries(tree):
+        """Yield (file_path, arcname) pairs for the folder tree."""
+        for current_folder, base_path in tree.walk():
+            for doc in tree.documents(current_folder):
+                latest_version = doc.latest_version
                 if latest_version and latest_version.plik:
                     file_path = latest_version.plik.path
                     if os.path.exists(file_path):
@@ -583,20 +575,131 @@ def folder_download_zip(request, pk):
                         base_name = os.path.splitext(doc.nazwa)[0]
                         # Create the final filename
                         final_filename = f"{base_name}{file_extension}"
-                        arcname = os.path.join(base_path, final_filename)
-                        zipf.write(file_path, arcname)
+                        yield file_path, os.path.join(base_path, final_filename)
 
-            # Add subfolders recursively
-            subfolders = Folder.objects.filter(rodzic=current_folder)
-            for subfolder in subfolders:
-                new_base_path = os.path.join(base_path, subfolder.nazwa)
-                add_folder_to_zip(subfolder, new_base_path)
+    # Collect only the file list up front so database access happens inside
+    # the view; the archive itself is compressed while it is being sent.
+    entries = list(iter_folder_entries(load_folder_tree(folder)))
 
-        add_folder_to_zip(folder, folder.nazwa)
-
-    zip_buffer.seek(0)
     _log_activity(request.user, 'pobieranie', folder=folder, details=f"Pobrał folder '{folder.nazwa}' jako ZIP", ip_address=get_client_ip(request))
 
-    response = HttpResponse(zip_buffer.getvalue(), content_type='application/zip')
+    response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
     response['Content-Disposition'] = f'attachment; filename="{folder.nazwa}.zip"'
-    return response
\ No newline at end of file
+    return response
+
+
+# --- Resumable uploads (tus-like, see documents.resumable) ---
+
+TUS_VERSION = '1.0.0'
+
+
+def _can_upload(user, document, folder):
+    if document is not None:
+        return user_can_edit_document(user, document)
+    if folder is not None and not user_can_view_folder(user, folder):
+        return False
+    return user_can_create_document(user, folder)
+
+
+def _upload_response(session, status=200, **data):
+    response = JsonResponse({
+        'id': str(session.pk),
+        'nazwa_pliku': session.nazwa_pliku,
+        'rozmiar': session.rozmiar,
+        'przeslano': session.przeslano,
+        'status': session.status,
+        'dokument': session.dokument_id,
+        **data,
+    }, status=status)
+    response['Tus-Resumable'] = TUS_VERSION
+    response['Upload-Offset'] = str(session.przeslano)
+    response['Upload-Length'] = str(session.rozmiar)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def _upload_error(exc):
+    response = JsonResponse({'error': str(exc)}, status=exc.status)
+    response['Tus-Resumable'] = TUS_VERSION
+    if isinstance(exc, resumable.UploadOffsetMismatch):
+        response['Upload-Offset'] = str(exc.offset)
+    return response
+
+
+@login_required
+def upload_session_create(request):
+    """Start a resumable upload of a new document or, with ``dokument``, a new version of one."""
+    if request.method != 'POST':
+        return HttpResponse(status=405, headers={'Allow': 'POST'})
+    data = request.POST.copy()
+    if 'rozmiar' not in data and 'HTTP_UPLOAD_LENGTH' in request.META:
+        data['rozmiar'] = request.META['HTTP_UPLOAD_LENGTH']
+    form = UploadSessionForm(data, user=request.user)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    if not _can_upload(request.user, form.cleaned_data['dokument'], form.cleaned_data['folder']):
+        raise PermissionDenied("You do not have permission to upload this file.")
+
+    session = resumable.create_session(request.user, **form.cleaned_data)
+    response = _upload_response(session, status=201)
+    response['Location'] = reverse('documents:upload_session_detail', kwargs={'pk': session.pk})
+    return response
+
+
+@login_required
+def upload_session_detail(request, pk):
+    """HEAD/GET: acknowledged offset; PATCH: append a chunk at Upload-Offset; DELETE: cancel."""
+    session = get_object_or_404(UploadSession.objects.select_related('dokument', 'folder'), pk=pk, uzytkownik=request.user)
+
+    if request.method in ('GET', 'HEAD'):
+        return _upload_response(session)
+    if request.method == 'DELETE':
+        resumable.discard(session)
+        return HttpResponse(status=204, headers={'Tus-Resumable': TUS_VERSION})
+    if request.method != 'PATCH':
+        return HttpResponse(status=405, headers={'Allow': 'GET, HEAD, PATCH, DELETE'})
+
+    if request.content_type != 'application/offset+octet-stream':
+        return JsonResponse({'error': 'Oczekiwano Content-Type: application/offset+octet-stream.'}, status=415)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Brak poprawnego nagłówka Upload-Offset.'}, status=400)
+    try:
+        # Read the body from the request stream: it never lands in request.body.
+        resumable.append_chunk(session, request, offset, length)
+    except resumable.UploadError as exc:
+        return _upload_error(exc)
+    return HttpResponse(status=204, headers={
+        'Tus-Resumable': TUS_VERSION,
+        'Upload-Offset': str(session.przeslano),
+    })
+
+
+@login_required
+def upload_session_finalize(request, pk):
+    """Assemble a completely uploaded file into its document or document version."""
+    if request.method != 'POST':
+        return HttpResponse(status=405, headers={'Allow': 'POST'})
+    session = get_object_or_404(UploadSession.objects.select_related('dokument', 'folder'), pk=pk, uzytkownik=request.user)
+    if not _can_upload(request.user, session.dokument, session.folder):
+        raise PermissionDenied("You do not have permission to upload this file.")
+
+    new_version = session.dokument is not None
+    try:
+        document = resumable.finalize(session, request.user)
+    except resumable.UploadError as exc:
+        return _upload_error(exc)
+
+    if new_version:
+        _log_activity(request.user, 'nowa_wersja', document=document, details=f"Przesłał nową wersję dokumentu '{document.nazwa}'", ip_address=get_client_ip(request))
+    else:
+        _log_activity(request.user, 'tworzenie', document=document, details=f"Utworzył dokument '{document.nazwa}'", ip_address=get_client_ip(request))
+    return _upload_response(session, status=201, url=reverse('documents:document_detail', kwargs={'pk': document.pk}))
+
+
+@staff_member_required
+def activity_log_stats(request):
+    """Queue depth and counters of this process's background activity log writer."""
+    return JsonResponse(get_activity_writer().stats())
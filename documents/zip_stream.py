@@ -0,0 +1,62 @@
+"""
+Streaming ZIP archive generator used by folder downloads.
+
+The archive is written into a small in-memory buffer which is drained after
+every chunk, so memory use per request stays constant and the first bytes
+reach the client before the whole folder has been compressed.
+"""
+import zipfile
+
+
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class _ZipStreamBuffer:
+    """Write-only, unseekable sink for ZipFile.
+
+    ZipFile detects the missing ``seek``/``tell`` and switches to data
+    descriptors, emitting local headers, file data and the central directory
+    strictly in order.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Return everything written since the previous drain."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, chunk_size=ZIP_CHUNK_SIZE):
+    """Yield a ZIP archive built from ``(file_path, arcname)`` pairs.
+
+    ``entries`` may be any iterable, including a lazy generator, so the
+    caller decides how much of the file list is held in memory.
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for file_path, arcname in entries:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with open(file_path, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    # Central directory is written when the ZipFile is closed.
+    data = buffer.drain()
+    if data:
+        yield data
@@ -1,8 +1,10 @@
 """
 Guardian permissions helpers for Document Manager
 """
-from guardian.shortcuts import assign_perm, remove_perm, get_perms
-# from guardian.core import ObjectPermissionChecker # Not directly used in these functions
+from guardian.shortcuts import assign_perm, remove_perm, get_perms, get_objects_for_user
+from guardian.core import ObjectPermissionChecker
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
 from django.contrib.auth.models import User # Not directly needed if using request.user
 # from .models import UserProfile, Role # UserProfile is accessed via user.profile
 
@@ -11,102 +13,348 @@ from django.contrib.auth.models import User # Not directly needed if using reque
 # from documents.models import Document, Folder # Import these where needed or pass objects
 
 
-# --- Document Permissions ---
+# --- Per-request resolver ---
 
-def user_can_view_document(user, document):
-    """Check if user can view specific document."""
-    if not user.is_authenticated:
-        return False
+class PermissionResolver:
+    """
+    Answers every user_can_* question for one user from memory.
 
-    # Administratorzy i Edytorzy widzą wszystko
-    if user.is_superuser or (hasattr(user, 'profile') and (user.profile.is_admin or user.profile.is_editor)):
-        return True
+    The role flags are read once, and object permissions come from a single
+    guardian ObjectPermissionChecker, so after prefetch() a listing page costs
+    the same number of queries whatever the number of items. The module-level
+    user_can_* helpers below are thin wrappers around a throwaway resolver.
+    """
 
-    # Właściciel zawsze może przeglądać swoje dokumenty
-    if document.wlasciciel == user:
-        return True
+    def __init__(self, user):
+        self.user = user
+        self.is_authenticated = user.is_authenticated
+        self.is_superuser = self.is_authenticated and user.is_superuser
+        profile = getattr(user, 'profile', None) if self.is_authenticated else None
+        self.has_profile = profile is not None
+        self.is_admin = bool(profile and profile.is_admin)
+        self.is_editor = bool(profile and profile.is_editor)
+        self.profile_active = profile.aktywny if profile else True
+        self._checker = ObjectPermissionChecker(user) if self.is_authenticated else None
+        self._acl_masks = {}
+        self._has_groups = None
+
+    def _uses_group_permissions(self):
+        # Group object permissions are not mirrored into the ACL tables, so
+        # group members still go through guardian.
+        if self._has_groups is None:
+            self._has_groups = self.user.groups.exists()
+        return self._has_groups
+
+    def prefetch(self, objects):
+        """Bulk-load object permissions for ``objects``.
+
+        Objects of different models may be mixed; each Document/Folder model
+        costs one ACL query (plus guardian's two for group members).
+        """
+        if self._checker is None or self.is_superuser:
+            return
+        by_model = {}
+        for obj in objects:
+            by_model.setdefault(type(obj), []).append(obj)
+        for model, model_objects in by_model.items():
+            acl = _acl_for_model(model)
+            if acl is None or self._uses_group_permissions():
+                self._checker.prefetch_perms(model_objects)
+            if acl is not None:
+                self._load_acl_masks(model, [obj.pk for obj in model_objects])
+
+    def _load_acl_masks(self, model, pks):
+        acl_model, field = _acl_for_model(model)
+        masks = self._acl_masks.setdefault(model, {})
+        missing = [pk for pk in pks if pk not in masks]
+        if not missing:
+            return masks
+        masks.update(dict.fromkeys(missing, 0))
+        masks.update(
+            acl_model.objects.filter(uzytkownik=self.user, **{f'{field}__in': missing})
+            .values_list(field, 'uprawnienia')
+        )
+        return masks
+
+    def has_perm(self, perm, obj):
+        """Object-level permission check, equivalent to ``user.has_perm(perm, obj)``."""
+        if self._checker is None or not self.user.is_active:
+            return False
+        if self.is_superuser:
+            return True
+        acl = _acl_for_model(type(obj))
+        bit = acl[0].PERMISSION_BITS.get(perm.split('.')[-1]) if acl else None
+        if bit is not None:
+            masks = self._acl_masks.get(type(obj))
+            if masks is None or obj.pk not in masks:
+                masks = self._load_acl_masks(type(obj), [obj.pk])
+            if masks[obj.pk] & bit:
+                return True
+            if not self._uses_group_permissions():
+                return False
+        return self._checker.has_perm(perm, obj)
+
+    def _is_owner(self, obj):
+        return self.is_authenticated and obj.wlasciciel_id == self.user.pk
+
+    # Document permissions
+
+    def can_view_document(self, document):
+        if not self.is_authenticated:
+            return False
+        # Administratorzy i Edytorzy widzą wszystko
+        if self.is_superuser or self.is_admin or self.is_editor:
+            return True
+        # Właściciel zawsze może przeglądać swoje dokumenty
+        if self._is_owner(document):
+            return True
+        # Dla wszystkich innych - tylko jawnie nadane uprawnienia przez administratora
+        return self.has_perm('browse_document', document)
+
+    def can_create_document(self, folder=None):
+        if not self.is_authenticated:
+            return False
+        return self.is_superuser or self.is_admin or self.is_editor
+
+    def can_edit_document(self, document):
+        if not self.is_authenticated:
+            return False
+        return self.is_superuser or self.is_admin or self.is_editor
+
+    def can_delete_document(self, document):
+        if not self.is_authenticated:
+            return False
+        return self.is_superuser or self.is_admin or self.is_editor
+
+    def can_comment_on_document(self, document):
+        if not self.is_authenticated:
+            return False
+        # Najpierw sprawdź czy może przeglądać dokument
+        if not self.can_view_document(document):
+            return False
+        # Sprawdź czy profil jest aktywny
+        if not self.profile_active:
+            return False
+        # Administratorzy i Edytorzy mogą komentować wszystko co widzą
+        if self.is_superuser or self.is_admin or self.is_editor:
+            return True
+        # Właściciel może komentować swoje dokumenty
+        if self._is_owner(document):
+            return True
+        # Dla innych - sprawdź jawnie nadane uprawnienie do komentowania
+        return self.has_perm('comment_document', document)
+
+    def can_share_document(self, document):
+        if not self.is_authenticated:
+            return False
+        if self.is_superuser or self.is_admin:
+            return True
+        if self._is_owner(document) and self.is_editor:
+            return True
+        return self.is_editor and self.has_perm('share_document', document)
+
+    def can_download_document(self, document):
+        return self.has_perm('documents.download_document', document)
+
+    # Folder permissions
+
+    def can_view_folder(self, folder):
+        if not self.is_authenticated:
+            return False
+        if self.is_superuser or self.is_admin:
+            return True
+        if self._is_owner(folder): # Owner can always view
+            return True
+        return self.has_perm('browse_folder', folder)
+
+    def can_create_folder(self, folder=None):
+        if not self.is_authenticated:
+            return False
+        if self.is_superuser or self.is_admin or self.is_editor:
+            return True
+        # Allow users with the general 'add_folder' permission to create folders
+        return self.user.has_perm('documents.add_folder')
+
+    def can_edit_folder(self, folder):
+        if not self.is_authenticated:
+            return False
+        return self.is_superuser or self.is_admin or self._is_owner(folder) or self.is_editor
+
+    def can_delete_folder(self, folder):
+        if not self.is_authenticated:
+            return False
+        return self.is_superuser or self.is_admin or self._is_owner(folder) or self.is_editor
+
+
+def _acl_for_model(model):
+    from documents.acl import acl_for_model
+    return acl_for_model(model)
+
+
+def get_permission_resolver(request):
+    """Return the PermissionResolver for this request, creating it on first use."""
+    resolver = getattr(request, '_permission_resolver', None)
+    if resolver is None or resolver.user is not request.user:
+        resolver = PermissionResolver(request.user)
+        request._permission_resolver = resolver
+    return resolver
+
+
+# --- Browseable object index ---
+
+PERMISSION_GENERATION_KEY = 'permissions:generation'
+PERMISSION_INDEX_TIMEOUT = 60 * 60
+# Above this many ids a pk__in list costs more to compile and bind on every
+# query than the indexed ACL, so the index falls back to an EXISTS on that.
+PERMISSION_INDEX_MAX_IDS = 1000
+
+
+def get_permission_generation():
+    """Current permission generation; bumped on every object permission change."""
+    from documents.models import CacheGeneration
+    return CacheGeneration.current(PERMISSION_GENERATION_KEY)
+
+
+def bump_permission_generation():
+    """Invalidate every cached PermissionIndex, in every process."""
+    # The counter lives in the database rather than in Django's cache, which
+    # is per process unless a shared backend is configured. The bump is part
+    # of the permission change's transaction, so it is undone with it.
+    from documents.models import CacheGeneration
+    CacheGeneration.bump(PERMISSION_GENERATION_KEY)
+
+
+class PermissionIndex:
+    """
+    Sets of document and folder ids a user may browse.
+
+    Each set is read once from the typed DocumentACL/FolderACL tables (or
+    from guardian for users in groups, whose group permissions are not
+    mirrored) and kept in the cache under the user id and the permission
+    generation, so listing views filter with a plain ``pk__in`` instead of
+    joining guardian's generic tables on every request. The generation is
+    read from the database once per index, so a change made by any process
+    is seen by the next request everywhere. ``None`` means the
+    user is not restricted (superuser or a global permission), mirroring
+    get_objects_for_user.
+    """
 
-    # Dla wszystkich innych - tylko jawnie nadane uprawnienia przez administratora
-    return user.has_perm('browse_document', document)
+    def __init__(self, user):
+        self.user = user
+        self._ids = {}
+        self._has_groups = None
+        self._generation = None
+
+    def _uses_group_permissions(self):
+        if self._has_groups is None:
+            self._has_groups = self.user.groups.exists()
+        return self._has_groups
+
+    def _permitted(self, perm, model):
+        """Subquery of the pks of ``model`` for which the user holds ``perm``."""
+        if self._uses_group_permissions():
+            return get_objects_for_user(
+                self.user, perm, klass=model, accept_global_perms=False
+            ).values_list('pk', flat=True)
+        from documents.acl import acl_object_ids
+        return acl_object_ids(self.user, model, perm.split('.')[-1])
+
+    def _permitted_exists(self, perm, model):
+        """
+        _permitted as a condition correlated with the outer pk. Unlike
+        ``pk__in``, which SQLite first collects in full, it is checked with an
+        index lookup per row, so a query that stops early (a page, the search
+        candidates) only pays for the rows it reads.
+        """
+        if self._uses_group_permissions():
+            return Exists(get_objects_for_user(
+                self.user, perm, klass=model, accept_global_perms=False
+            ).filter(pk=OuterRef('pk')))
+        from documents.acl import acl_for_model, acl_object_ids
+        _, field = acl_for_model(model)
+        return Exists(acl_object_ids(self.user, model, perm.split('.')[-1]).filter(**{field: OuterRef('pk')}))
+
+    def _load_ids(self, perm, model):
+        if perm in self._ids:
+            return self._ids[perm]
+        user = self.user
+        if not user.is_authenticated:
+            ids = frozenset()
+        elif user.is_superuser or user.has_perm(perm):
+            ids = None
+        else:
+            if self._generation is None:
+                self._generation = get_permission_generation()
+            key = f'permissions:index:{user.pk}:{self._generation}:{perm}'
+            ids = cache.get(key)
+            if ids is None:
+                ids = frozenset(self._permitted(perm, model))
+                cache.set(key, ids, PERMISSION_INDEX_TIMEOUT)
+        self._ids[perm] = ids
+        return ids
+
+    def _filter(self, queryset, perm):
+        ids = self._load_ids(perm, queryset.model)
+        if ids is None:
+            return queryset
+        if len(ids) > PERMISSION_INDEX_MAX_IDS:
+            return queryset.filter(self._permitted_exists(perm, queryset.model))
+        return queryset.filter(pk__in=ids)
+
+    def document_ids(self):
+        from documents.models import Document
+        return self._load_ids('documents.browse_document', Document)
+
+    def folder_ids(self):
+        from documents.models import Folder
+        return self._load_ids('documents.browse_folder', Folder)
+
+    def filter_documents(self, queryset):
+        return self._filter(queryset, 'documents.browse_document')
+
+    def filter_folders(self, queryset):
+        return self._filter(queryset, 'documents.browse_folder')
+
+
+def get_permission_index(request):
+    """Return the PermissionIndex for this request, creating it on first use."""
+    index = getattr(request, '_permission_index', None)
+    if index is None or index.user is not request.user:
+        index = PermissionIndex(request.user)
+        request._permission_index = index
+    return index
+
+
+# --- Document Permissions ---
+
+def user_can_view_document(user, document):
+    """Check if user can view specific document."""
+    return PermissionResolver(user).can_view_document(document)
 
 
 def user_can_create_document(user, folder=None):
     """Check if user can create new documents."""
-    if not user.is_authenticated:
-        return False
-    if user.is_superuser or (hasattr(user, 'profile') and (user.profile.is_admin or user.profile.is_editor)):
-        return True
-    return False
+    return PermissionResolver(user).can_create_document(folder)
 
 
 def user_can_edit_document(user, document):
     """Check if user can edit specific document metadata or upload new versions."""
-    if not user.is_authenticated:
-        return False
-
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if hasattr(user, 'profile') and user.profile.is_editor:
-        return True
-
-    return False
+    return PermissionResolver(user).can_edit_document(document)
 
 
 def user_can_delete_document(user, document):
     """Check if user can delete specific document."""
-    if not user.is_authenticated:
-        return False
-
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if hasattr(user, 'profile') and user.profile.is_editor:
-        return True
-
-    return False
+    return PermissionResolver(user).can_delete_document(document)
 
 
 def user_can_comment_on_document(user, document):
     """Check if user can comment on a document."""
-    if not user.is_authenticated:
-        return False
-
-    # Najpierw sprawdź czy może przeglądać dokument
-    if not user_can_view_document(user, document):
-        return False
-    
-    # Sprawdź czy profil jest aktywny
-    if hasattr(user, 'profile') and not user.profile.aktywny:
-        return False
-    
-    # Administratorzy i Edytorzy mogą komentować wszystko co widzą
-    if user.is_superuser or (hasattr(user, 'profile') and (user.profile.is_admin or user.profile.is_editor)):
-        return True
-    
-    # Właściciel może komentować swoje dokumenty
-    if document.wlasciciel == user:
-        return True
-        
-    # Dla innych - sprawdź jawnie nadane uprawnienie do komentowania
-    return user.has_perm('comment_document', document)
+    return PermissionResolver(user).can_comment_on_document(document)
 
 
 def user_can_share_document(user, document):
     """Check if user can share specific document."""
-    if not user.is_authenticated:
-        return False
-
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if document.wlasciciel == user and (hasattr(user, 'profile') and (user.profile.is_admin or user.profile.is_editor)):
-        return True
-    
-    if hasattr(user, 'profile') and user.profile.is_editor and user.has_perm('share_document', document):
-        return True
-
-    return False
+    return PermissionResolver(user).can_share_document(document)
 
 
 def share_document_with_user(document, from_user, to_user_obj, permission_level='browse_document'):
@@ -158,59 +406,23 @@ def get_user_document_permissions(user, document):
 
 def user_can_view_folder(user, folder):
     """Check if user can view specific folder."""
-    if not user.is_authenticated:
-        return False
-
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if folder.wlasciciel == user: # Owner can always view
-        return True
-
-    return user.has_perm('browse_folder', folder)
+    return PermissionResolver(user).can_view_folder(folder)
 
 
 def user_can_create_folder(user, folder=None):
     """Check if user can create new folders."""
-    if not user.is_authenticated:
-        return False
-    if user.is_superuser or (hasattr(user, 'profile') and (user.profile.is_admin or user.profile.is_editor)):
-        return True
-    # Allow users with the general 'add_folder' permission to create folders
-    return user.has_perm('documents.add_folder')
+    return PermissionResolver(user).can_create_folder(folder)
 
 
 def user_can_edit_folder(user, folder):
     """Check if user can edit specific folder's metadata."""
-    if not user.is_authenticated:
-        return False
+    return PermissionResolver(user).can_edit_folder(folder)
 
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if folder.wlasciciel == user:
-        return True
-
-    if hasattr(user, 'profile') and user.profile.is_editor:
-        return True
-        
-    return False
 
 def user_can_delete_folder(user, folder):
     """Check if user can delete specific folder."""
-    if not user.is_authenticated:
-        return False
-
-    if user.is_superuser or (hasattr(user, 'profile') and user.profile.is_admin):
-        return True
-
-    if folder.wlasciciel == user:
-        return True
+    return PermissionResolver(user).can_delete_folder(folder)
 
-    if hasattr(user, 'profile') and user.profile.is_editor:
-        return True
-        
-    return False
 
 def admin_grant_document_access(admin_user, target_user, document, permissions=['browse_document']):
     """
@@ -51,3 +51,24 @@ def create_default_roles(sender, **kwargs):
         print(f"✅ Created {created_count} default roles successfully!")
     else:
         print("All default roles already exist.")
+
+
+def _bump_permission_generation(sender, **kwargs):
+    """Any object, global or group permission change invalidates cached PermissionIndex sets."""
+    from users.permissions import bump_permission_generation
+    bump_permission_generation()
+
+
+def _connect_permission_generation_signals():
+    from django.contrib.auth.models import Group, User
+    from django.db.models.signals import m2m_changed, post_delete, post_save
+    from guardian.models import GroupObjectPermission, UserObjectPermission
+
+    for model in (UserObjectPermission, GroupObjectPermission):
+        post_save.connect(_bump_permission_generation, sender=model, dispatch_uid=f'perm_generation_save_{model.__name__}')
+        post_delete.connect(_bump_permission_generation, sender=model, dispatch_uid=f'perm_generation_delete_{model.__name__}')
+    for through in (User.groups.through, User.user_permissions.through, Group.permissions.through):
+        m2m_changed.connect(_bump_permission_generation, sender=through, dispatch_uid=f'perm_generation_m2m_{through.__name__}')
+
+
+_connect_permission_generation_signals()
@@ -1,3 +1,190 @@
+import io
+from unittest import mock
+
+from django.contrib.auth.models import Group, User
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from guardian.shortcuts import assign_perm, remove_perm
+
+from documents.models import Document, DocumentACL, Folder
+from users.models import Role
+from users.permissions import (PermissionIndex, PermissionResolver,
+                               get_permission_generation,
+                               user_can_comment_on_document,
+                               user_can_share_document, user_can_view_document,
+                               user_can_view_folder)
+
+
+def create_user(username, role=Role.READER, **extra):
+    user = User.objects.create_user(username, f'{username}@example.com', 'haslo12345', **extra)
+    user.profile.rola = Role.objects.get(nazwa=role)
+    user.profile.save()
+    return User.objects.get(pk=user.pk)
+
+
+class PermissionResolverTests(TestCase):
+    def setUp(self):
+        self.owner = create_user('wlasciciel', Role.EDITOR)
+        self.reader = create_user('czytelnik')
+        self.editor = create_user('edytor', Role.EDITOR)
+        self.folder = Folder.objects.create(nazwa='Folder', wlasciciel=self.owner)
+        self.documents = [
+            Document.objects.create(nazwa=f'dok_{i}.txt', wlasciciel=self.owner, folder=self.folder)
+            for i in range(3)
+        ]
+        assign_perm('browse_document', self.reader, self.documents[0])
+        assign_perm('comment_document', self.reader, self.documents[0])
+        assign_perm('browse_folder', self.reader, self.folder)
+        assign_perm('share_document', self.editor, self.documents[1])
+
+    def test_matches_module_helpers(self):
+        for user in (self.owner, self.reader, self.editor):
+            resolver = PermissionResolver(user)
+            resolver.prefetch(self.documents + [self.folder])
+            for document in self.documents:
+                self.assertEqual(resolver.can_view_document(document), user_can_view_document(user, document))
+                self.assertEqual(resolver.can_comment_on_document(document), user_can_comment_on_document(user, document))
+                self.assertEqual(resolver.can_share_document(document), user_can_share_document(user, document))
+            self.assertEqual(resolver.can_view_folder(self.folder), user_can_view_folder(user, self.folder))
+
+    def test_checks_after_prefetch_hit_no_database(self):
+        resolver = PermissionResolver(self.reader)
+        resolver.prefetch(self.documents)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [resolver.can_view_document(d) for d in self.documents],
+                [True, False, False],
+            )
+            self.assertTrue(resolver.can_comment_on_document(self.documents[0]))
+
+
+class ListingQueryCountBenchmark(TestCase):
+    """The home listing must cost the same number of queries for 20 or 200 items."""
+
+    def setUp(self):
+        self.owner = create_user('wlasciciel', Role.EDITOR)
+        self.reader = create_user('czytelnik')
+        self.client.force_login(self.reader)
+
+    def _add_items(self, count):
+        for i in range(count):
+            if i % 10 == 0:
+                item = Folder.objects.create(nazwa=f'folder_{self.created}', wlasciciel=self.owner)
+                assign_perm('browse_folder', self.reader, item)
+            else:
+                item = Document.objects.create(nazwa=f'dok_{self.created}.txt', wlasciciel=self.owner)
+                assign_perm('browse_document', self.reader, item)
+            self.created += 1
+
+    def _count_queries(self):
+        self.client.get(reverse('documents:home'))  # Warm up caches (content types, permission index)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('documents:home'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), len(response.context['folders']) + len(response.context['documents'])
+
+    # One page holds all 200 items, as before listings were paginated
+    @mock.patch('documents.views.HOME_PAGE_SIZE', 250)
+    def test_query_count_is_constant(self):
+        self.created = 0
+        self._add_items(20)
+        small_queries, small_items = self._count_queries()
+        self._add_items(180)
+        large_queries, large_items = self._count_queries()
+
+        self.assertEqual(large_items, 200)
+        self.assertEqual(small_queries, large_queries)
+
+
+class PermissionIndexTests(TestCase):
+    def setUp(self):
+        self.owner = create_user('wlasciciel', Role.EDITOR)
+        self.reader = create_user('czytelnik')
+        self.visible = Document.objects.create(nazwa='widoczny.txt', wlasciciel=self.owner)
+        self.hidden = Document.objects.create(nazwa='ukryty.txt', wlasciciel=self.owner)
+        assign_perm('browse_document', self.reader, self.visible)
+
+    def test_ids_are_cached_per_generation(self):
+        self.assertEqual(PermissionIndex(self.reader).document_ids(), {self.visible.pk})
+        with self.assertNumQueries(1):  # The generation
+            self.assertEqual(PermissionIndex(self.reader).document_ids(), {self.visible.pk})
+
+    def test_permission_change_invalidates_index(self):
+        generation = get_permission_generation()
+        PermissionIndex(self.reader).document_ids()
+        assign_perm('browse_document', self.reader, self.hidden)
+
+        self.assertGreater(get_permission_generation(), generation)
+        self.assertEqual(PermissionIndex(self.reader).document_ids(), {self.visible.pk, self.hidden.pk})
+
+    def test_revoke_reaches_other_processes(self):
+        # Each worker process has its own LocMemCache
+        caches = [LocMemCache(f'worker-{n}', {}) for n in range(2)]
+        for worker_cache in caches:
+            with mock.patch('users.permissions.cache', worker_cache):
+                self.assertEqual(PermissionIndex(self.reader).document_ids(), {self.visible.pk})
+
+        with mock.patch('users.permissions.cache', caches[0]):
+            remove_perm('browse_document', self.reader, self.visible)
+
+        with mock.patch('users.permissions.cache', caches[1]):
+            self.assertEqual(PermissionIndex(self.reader).document_ids(), set())
+
+    def test_filter_matches_guardian(self):
+        index = PermissionIndex(self.reader)
+        self.assertEqual(list(index.filter_documents(Document.objects.all())), [self.visible])
+        superuser = User.objects.create_superuser('admin', 'admin@example.com', 'haslo12345')
+        self.assertEqual(PermissionIndex(superuser).filter_documents(Document.objects.all()).count(), 2)
+
+    @mock.patch('users.permissions.PERMISSION_INDEX_MAX_IDS', 0)
+    def test_large_id_sets_filter_with_a_subquery(self):
+        self.assertEqual(list(PermissionIndex(self.reader).filter_documents(Document.objects.all())), [self.visible])
+        group = Group.objects.create(name='archiwisci')
+        assign_perm('browse_document', group, self.hidden)
+        self.reader.groups.add(group)
+        self.assertEqual(set(PermissionIndex(self.reader).filter_documents(Document.objects.all())), {self.visible, self.hidden})
+
+
+class DocumentACLSyncTests(TestCase):
+    def setUp(self):
+        self.owner = create_user('wlasciciel', Role.EDITOR)
+        self.reader = create_user('czytelnik')
+        self.document = Document.objects.create(nazwa='dok.txt', wlasciciel=self.owner)
+
+    def _mask(self):
+        row = DocumentACL.objects.filter(uzytkownik=self.reader, dokument=self.document).first()
+        return row.uprawnienia if row else 0
+
+    def test_assign_and_remove_update_bitmask(self):
+        assign_perm('browse_document', self.reader, self.document)
+        assign_perm('documents.comment_document', self.reader, self.document)
+        self.assertEqual(self._mask(), DocumentACL.BROWSE | DocumentACL.COMMENT)
+
+        remove_perm('browse_document', self.reader, self.document)
+        self.assertEqual(self._mask(), DocumentACL.COMMENT)
+        remove_perm('comment_document', self.reader, self.document)
+        self.assertFalse(DocumentACL.objects.filter(uzytkownik=self.reader).exists())
+
+    def test_resolver_reads_acl_in_one_query(self):
+        assign_perm('browse_document', self.reader, self.document)
+        resolver = PermissionResolver(self.reader)
+        with self.assertNumQueries(1):
+            self.assertTrue(resolver.has_perm('browse_document', self.document))
+            self.assertTrue(resolver.can_view_document(self.document))
+
+    def test_backfill_command_repairs_acl(self):
+        assign_perm('browse_document', self.reader, self.document)
+        DocumentACL.objects.all().delete()
+
+        out = io.StringIO()
+        call_command('backfill_acl', '--check', stdout=out)
+        self.assertIn('dokument_acl: 1 missing', out.getvalue())
+        self.assertEqual(self._mask(), 0)
 
-# Create your tests here.
+        call_command('backfill_acl', stdout=io.StringIO())
+        self.assertEqual(self._mask(), DocumentACL.BROWSE)
+        self.assertEqual(PermissionIndex(self.reader).document_ids(), {self.document.pk})